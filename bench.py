@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+"""bench [opts]
+
+End-to-end load benchmark: runs rokuweather.main against local
+Soundbridge simulators (sb_sim) and a stub OpenWeather server (ow_stub),
+then reports time to first paint, panel paint latency, commands/bytes per
+cycle, commands/second, device input overruns, reconnect time and
+OpenWeather requests.
+
+-c, --cycles     Panel cycles to run, Default: 3
+-t, --type       Display type (1 or 2), Default: 2
+-p, --panel      Seconds each panel is shown, Default: 0.2
+-l, --latency    Simulated seconds per command
+-b, --bandwidth  Simulated bytes/second
+-d, --drop       Drop the connection after this many commands
+-i, --input      Simulated input buffer bytes (data beyond it is lost)
+-n, --no-flow    Send without waiting for prompts (flow_control = False)
+-f, --fleet      Number of displays driven in --fleet mode (default: single)
+-w, --workers    Worker processes the fleet is sharded over
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import getopt
+import tempfile
+
+from sb_sim import sbSim
+from ow_stub import owStub
+
+
+def percentile(values, p):
+    if (not values):
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def report(sims, stub, t0, elapsed, cycles):
+    panels = [p for sim in sims for p in sim.panels]
+    paint = [p[0] for p in panels]
+    cmds = sum(p[1] for p in panels)
+    nbytes = sum(p[2] for p in panels)
+    ncycles = max(cycles * len(sims), 1)
+    print("Displays: {}, panels: {}, elapsed: {:.2f}s".format(len(sims), len(panels), elapsed))
+    first = [sim.first_paint - t0 for sim in sims if sim.first_paint is not None]
+    if (first):
+        print("First paint    mean: {:.1f}ms  max: {:.1f}ms".format(1000 * sum(first) / len(first), 1000 * max(first)))
+    print("Paint latency  mean: {:.1f}ms  p95: {:.1f}ms  max: {:.1f}ms".format(
+        1000 * sum(paint) / max(len(paint), 1), 1000 * percentile(paint, 95), 1000 * max(paint, default=0)))
+    print("Per cycle      commands: {:.1f}  bytes: {:.1f}".format(cmds / ncycles, nbytes / ncycles))
+    print("Per panel      commands: {:.1f}  bytes: {:.1f}".format(cmds / max(len(panels), 1),
+                                                                  nbytes / max(len(panels), 1)))
+    print("Throughput     commands/s: {:.0f}  input overruns: {}".format(
+        cmds / max(sum(paint), 1e-6), sum(sim.stats['overruns'] for sim in sims)))
+    reconnects = [r for sim in sims for r in sim.reconnects]
+    drops = sum(sim.stats['drops'] for sim in sims)
+    if (drops):
+        print("Reconnects     drops: {}  mean: {:.2f}s  max: {:.2f}s".format(
+            drops, sum(reconnects) / max(len(reconnects), 1), max(reconnects, default=0)))
+    print("OpenWeather    " + ", ".join("{}: {}".format(k, v) for k, v in stub.stats.items()))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "hc:t:p:l:b:d:i:nf:w:", ["help", "cycles=", "type=", "panel=", "latency=",
+                                                                     "bandwidth=", "drop=", "input=", "no-flow",
+                                                                     "fleet=", "workers="])
+    except getopt.error as msg:
+        print(msg)
+        print("for help use --help")
+        return 2
+
+    cycles = 3
+    dpytype = 2
+    panel_delay = 0.2
+    sim_opts = {}
+    fleet_size = None
+    workers = None
+    flow_control = True
+    for o, v in opts:
+        if (o in ["-h", "--help"]):
+            print(__doc__)
+            return 0
+        if (o in ["-c", "--cycles"]):
+            cycles = int(v)
+        if (o in ["-t", "--type"]):
+            dpytype = int(v)
+        if (o in ["-p", "--panel"]):
+            panel_delay = float(v)
+        if (o in ["-l", "--latency"]):
+            sim_opts['latency'] = float(v)
+        if (o in ["-b", "--bandwidth"]):
+            sim_opts['bandwidth'] = float(v)
+        if (o in ["-d", "--drop"]):
+            sim_opts['drop_after'] = int(v)
+        if (o in ["-i", "--input"]):
+            sim_opts['input_buffer'] = int(v)
+        if (o in ["-n", "--no-flow"]):
+            flow_control = False
+        if (o in ["-f", "--fleet"]):
+            fleet_size = int(v)
+        if (o in ["-w", "--workers"]):
+            workers = v
+
+    # Held panels per cycle - type 2 shows date/time and sunrise together,
+    # precipitation is shown (the stub has rain within the hour)
+    held = 6 if (dpytype == 1) else 5
+    stub = owStub().start()
+    sims = [sbSim(dpytype, key_every=cycles * held, **sim_opts).start() for i in range(fleet_size or 1)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Configuration normally found in ow_data.py
+        ow_data = types.ModuleType('ow_data')
+        ow_data.config = dict(appid='bench', location='Boston,MA,US', units='imperial', ow_url=stub.url,
+                              panel_delay=panel_delay, cache_dir=tmp, flow_control=flow_control)
+        sys.modules['ow_data'] = ow_data
+        # Time to first paint includes importing rokuweather
+        t0 = time.monotonic()
+        import rokuweather
+
+        if (fleet_size is None):
+            run_args = ['rokuweather', '-t', str(dpytype), sims[0].address]
+        else:
+            inventory = os.path.join(tmp, 'devices.json')
+            with open(inventory, 'w') as f:
+                json.dump([{'host': sim.address, 'type': dpytype} for sim in sims], f)
+            run_args = ['rokuweather', '-f', inventory]
+            if (workers is not None):
+                run_args += ['-w', workers]
+
+        rokuweather.main(run_args)
+        elapsed = time.monotonic() - t0
+
+    for sim in sims:
+        sim.stop()
+    stub.stop()
+    report(sims, stub, t0, elapsed, cycles)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,57 @@
 # Draw netpbm (P1) weather icon to Roku
+#
+# Icons come in hand-made sets for 16 (type 1) and 32 (type 2) pixel high
+# displays. Other heights are scaled from the next larger set, with numpy
+# when it is installed (imported with the first icon scaled, keeping it off
+# the startup path).
 
 import sys
 import json
+import time
+from operator import itemgetter
+from functools import cached_property
+from collections import OrderedDict
+
+import metrics
+from icon_bundle import iconBundle
+
+
+draws = metrics.icon_draws.labels()
+draw_seconds = metrics.icon_seconds.labels()
 
 
 # Map OWM condition codes to icon
 # 'altid' refers to yahoo/wu weather icons
 class wi_icons(object):
-    def __init__(self):
+    # Max number of scaled icons held in cache - icons of the hand-made sets
+    # (a few hundred at most) are all kept
+    cache_size = 64
+    # Hand-made icon sets: height -> file prefix
+    icon_sets = {16: 's-', 32: ''}
+    # Scaling: samples (each way) per scaled pixel, fraction of them that
+    # must fall on set pixels for it to be set (low enough for 1 pixel
+    # strokes to survive scaling down)
+    samples = 4
+    threshold = 0.3
+
+    # Condition map and icon bundle are loaded on first use
+    def __init__(self, cache_size=None, bundle='icons.bin'):
+        if cache_size is not None:
+            self.cache_size = cache_size
+        # (altid, height) -> (sizex, sizey, rectangles): icons of the hand-made
+        # sets, all kept, and scaled ones, least recently used dropped first
+        self.cache = {}
+        self.scaled = OrderedDict()
+        # (altid, height) -> bytes drawing the icon at 0,0
+        self.sizes = {}
+        self.bundle_name = bundle
+        self.stale_warned = False
+
+    @cached_property
+    def wi_map(self):
         try:
-            icons = open('ow_icons.json')
-            self.wi_map = json.load(icons)
-            icons.close()
+            with open('ow_icons.json') as icons:
+                return json.load(icons)
         except FileNotFoundError:
             print("Cannot find icons.json")
             exit()
@@ -19,8 +59,20 @@ class wi_icons(object):
             print("Error parsing icons file")
             exit()
 
+    # Packed icons (see icon_bundle.py) - else read pbm/ files
+    @cached_property
+    def bundle(self):
+        try:
+            return iconBundle(self.bundle_name)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            print("Ignoring icon bundle = {}".format(err))
+            return None
+
     # Define generator for pbm tokens
-    def tokenize(self, f):
+    @staticmethod
+    def tokenize(f):
         for line in f:
             # skip comments
             if line[0] != '#':
@@ -28,66 +80,268 @@ class wi_icons(object):
                     # return single atom
                     yield t
 
-    def drawItAt(self, sb, code, locx, locy):
-        try:
-            icon = self.wi_map[str(code)]['altid']
-        except KeyError:
-            icon = 3200
-            pass
-
-        # Open PBM file
-        prefix = "s-" if (sb.dpytype == 1) else ""
+    # Parse a PBM file into a list of horizontal runs (x, y, cnt)
+    @staticmethod
+    def parse(fname):
         try:
-            f = open("pbm/" + prefix + icon + ".pbm")
+            f = open(fname)
         except IOError:
-            print("PBM file ({}.pbm) open failure".format(prefix + icon))
+            print("PBM file ({}) open failure".format(fname))
             exit()
 
         try:
-            t = self.tokenize(f)
+            t = wi_icons.tokenize(f)
             nexttoken = lambda: next(t)
             assert ('P1' == nexttoken()), 'Not a P1 PBM file'
             # Get HxW dimensions
             sizex = int(nexttoken())
             sizey = int(nexttoken())
-            # Set display invisible bounding box
-            sb.cmd("sketch -c color 0")
-            sb.cmd("sketch -c rect {} {} {} {}".format(locx, locy, sizex, sizey))
-            sb.cmd("sketch -c color 1")
 
-            # Now plot data
+            segs = []
             for y in range(sizey):
                 x = 0
                 while (x < sizex):
-                    cnt = 1
-                    bit = int(nexttoken())
-                    if (bit == 1):
-                        xpos = locx + x
-                        ypos = locy + y
+                    if (int(nexttoken()) == 1):
                         # Optimize horiz lines
-                        while ((bit == 1) and (x < (sizex - 1))):
-                            bit = int(nexttoken())
-                            x += 1
-                            if (bit == 1):
-                                cnt += 1
-
-                        x2 = xpos + cnt
-                        # Line or point
-                        if (cnt == 1):
-                            sb.cmd("sketch -c point {} {}".format(xpos, ypos))
-                        else:
-                            sb.cmd("sketch -c line {} {} {} {}".format(xpos, ypos, x2, ypos))
+                        cnt = 1
+                        while ((x + cnt) < sizex):
+                            if (int(nexttoken()) != 1):
+                                break
+                            cnt += 1
+                        segs.append((x, y, cnt))
+                        x += cnt
                     x += 1
 
             # Close tokenizer
             t.close()
 
         except Exception:
-            print("Problem processing {}.pbm file. Err = {}".format(prefix + code, sys.exc_info()[0]))
+            print("Problem processing {} file. Err = {}".format(fname, sys.exc_info()[0]))
             f.close()
             raise
 
         else:
             f.close()
 
-        return
+        return (sizex, sizey, tuple(segs))
+
+    # Map condition code to icon id
+    def altid(self, code):
+        try:
+            return self.wi_map[str(code)]['altid']
+        except KeyError:
+            return '3200'
+
+    # Cover the 1-bits of an icon given as horizontal runs with few
+    # rectangles (x, y, w, h). Greedy: from the first uncovered pixel
+    # take the rectangle covering most uncovered pixels (covered ones may
+    # be overlapped), then drop rectangles made redundant by later ones.
+    @staticmethod
+    def cover(sizex, sizey, segs):
+        bitmap = [[0] * sizex for y in range(sizey)]
+        for x, y, cnt in segs:
+            bitmap[y][x:x + cnt] = [1] * cnt
+        covered = [[0] * sizex for y in range(sizey)]
+
+        rects = []
+        for y0 in range(sizey):
+            for x0 in range(sizex):
+                if (not bitmap[y0][x0] or covered[y0][x0]):
+                    continue
+                best = None
+                # Widest run first, then narrower ones that may reach deeper
+                width = 0
+                while (x0 + width < sizex and bitmap[y0][x0 + width]):
+                    width += 1
+                for w in range(width, 0, -1):
+                    h = 1
+                    while (y0 + h < sizey and all(bitmap[y0 + h][x0:x0 + w])):
+                        h += 1
+                    gain = sum(w - sum(covered[y][x0:x0 + w]) for y in range(y0, y0 + h))
+                    if (best is None or gain > best[0]):
+                        best = (gain, w, h)
+                gain, w, h = best
+                for y in range(y0, y0 + h):
+                    covered[y][x0:x0 + w] = [c + 1 for c in covered[y][x0:x0 + w]]
+                rects.append((x0, y0, w, h))
+
+        # Remove rectangles whose pixels are all covered by others
+        for r in reversed(rects[:]):
+            x0, y0, w, h = r
+            if (all(min(covered[y][x0:x0 + w]) > 1 for y in range(y0, y0 + h))):
+                rects.remove(r)
+                for y in range(y0, y0 + h):
+                    covered[y][x0:x0 + w] = [c - 1 for c in covered[y][x0:x0 + w]]
+        return tuple(rects)
+
+    # Sketch command drawing rectangle at offset (line end points are drawn)
+    @staticmethod
+    def command(x, y, w, h):
+        if (w == 1 and h == 1):
+            return "sketch -c point {} {}".format(x, y)
+        if (h == 1):
+            return "sketch -c line {} {} {} {}".format(x, y, x + w - 1, y)
+        if (w == 1):
+            return "sketch -c line {} {} {} {}".format(x, y, x, y + h - 1)
+        return "sketch -c rect {} {} {} {}".format(x, y, w, h)
+
+    # Icon height for a display type - the display height
+    @staticmethod
+    def height(dpytype):
+        return 16 * dpytype
+
+    # Horizontal runs of an icon file (pbm/<name>.pbm), from the bundle if
+    # packed from the file as it is now
+    def runs(self, name):
+        fname = "pbm/" + name + ".pbm"
+        if (self.bundle is not None and name in self.bundle):
+            if (self.bundle.current(name, fname)):
+                return self.bundle.runs(name)
+            if (not self.stale_warned):
+                print("Icon bundle {} is older than {} - re-run icon_bundle.py".format(self.bundle_name, fname))
+                self.stale_warned = True
+        return self.parse(fname)
+
+    # Scale icon runs to height, keeping the aspect ratio - a pixel is set
+    # when enough of the samples spread over it fall on set pixels
+    #  vectorize := with numpy, if installed
+    @classmethod
+    def scale(cls, sizex, sizey, segs, height, vectorize=True):
+        width = max(1, round(sizex * height / sizey))
+        k = cls.samples
+        need = cls.threshold * k * k
+        if (vectorize):
+            try:
+                import numpy
+            except ImportError:
+                vectorize = False
+        if (not vectorize):
+            return (width, height, cls.scale_runs(sizex, sizey, segs, width, height))
+
+        bitmap = numpy.zeros((sizey, sizex), dtype=bool)
+        for x, y, cnt in segs:
+            bitmap[y, x:x + cnt] = True
+        ys = ((numpy.arange(height * k) + 0.5) * sizey / (height * k)).astype(int)
+        xs = ((numpy.arange(width * k) + 0.5) * sizex / (width * k)).astype(int)
+        hits = bitmap[numpy.ix_(ys, xs)].reshape(height, k, width, k).sum(axis=(1, 3))
+        # Runs start/end where a row (padded with 0s) steps up/down
+        scaled = numpy.zeros((height, width + 2), dtype=numpy.int8)
+        scaled[:, 1:-1] = hits >= need
+        edges = numpy.diff(scaled, axis=1)
+        rows, starts = numpy.nonzero(edges == 1)
+        ends = numpy.nonzero(edges == -1)[1]
+        return (width, height, tuple(zip(starts.tolist(), rows.tolist(), (ends - starts).tolist())))
+
+    # scale() without numpy - same samples, same result. Sample columns are
+    # picked and summed a whole row at a time (itemgetter, zip, map)
+    @classmethod
+    def scale_runs(cls, sizex, sizey, segs, width, height):
+        k = cls.samples
+        need = cls.threshold * k * k
+        bitmap = [[0] * sizex for y in range(sizey)]
+        for x, y, cnt in segs:
+            bitmap[y][x:x + cnt] = [1] * cnt
+        ys = [int((i + 0.5) * sizey / (height * k)) for i in range(height * k)]
+        pick = itemgetter(*[int((i + 0.5) * sizex / (width * k)) for i in range(width * k)])
+
+        out = []
+        for y in range(height):
+            # Set samples per sample column, then per k columns
+            cols = map(sum, zip(*[pick(bitmap[v]) for v in ys[y * k:(y + 1) * k]]))
+            bits = [n >= need for n in map(sum, zip(*[cols] * k))] + [False]
+            start = None
+            for x, bit in enumerate(bits):
+                if (bit and start is None):
+                    start = x
+                elif (not bit and start is not None):
+                    out.append((start, y, x - start))
+                    start = None
+        return tuple(out)
+
+    # Return parsed icon, loading (or scaling) it on first use
+    #  height := display height for dpytype when None
+    def load(self, icon, dpytype, height=None):
+        if (height is None):
+            height = self.height(dpytype)
+        key = (icon, height)
+        if (height in self.icon_sets):
+            try:
+                return self.cache[key]
+            except KeyError:
+                pass
+            sizex, sizey, segs = self.runs(self.icon_sets[height] + icon)
+            entry = self.cache[key] = (sizex, sizey, self.cover(sizex, sizey, segs))
+            return entry
+
+        try:
+            self.scaled.move_to_end(key)
+            return self.scaled[key]
+        except KeyError:
+            pass
+        # From the next larger hand-made set, else the largest
+        master = min((h for h in self.icon_sets if h > height), default=max(self.icon_sets))
+        sizex, sizey, segs = self.scale(*self.runs(self.icon_sets[master] + icon), height)
+        entry = self.scaled[key] = (sizex, sizey, self.cover(sizex, sizey, segs))
+        if (len(self.scaled) > self.cache_size):
+            self.scaled.popitem(last=False)
+        return entry
+
+    # Parse every mapped icon ahead of time
+    def preload(self, dpytype):
+        for icon in set(self.altid(code) for code in self.wi_map):
+            self.load(icon, dpytype)
+
+    def drawItAt(self, sb, code, locx, locy, height=None):
+        self.drawIconAt(sb, self.altid(code), locx, locy, height)
+
+    # Draw icon commands to sb - number of commands
+    def drawIconAt(self, sb, icon, locx, locy, height=None):
+        t0 = time.perf_counter()
+        sizex, sizey, rects = self.load(icon, sb.dpytype, height)
+
+        # Set display invisible bounding box
+        sb.cmd("sketch -c color 0")
+        sb.cmd("sketch -c rect {} {} {} {}".format(locx, locy, sizex, sizey))
+        sb.cmd("sketch -c color 1")
+
+        # Now plot data
+        for x, y, w, h in rects:
+            sb.cmd(self.command(locx + x, locy + y, w, h))
+
+        draws.inc()
+        draw_seconds.observe(time.perf_counter() - t0)
+        return 3 + len(rects)
+
+    # Bytes of drawIconAt commands for an icon at 0,0 (to compare draw plans)
+    def size(self, icon, dpytype, height=None):
+        key = (icon, self.height(dpytype) if (height is None) else height)
+        if (key not in self.sizes):
+            sizex, sizey, rects = self.load(icon, dpytype, height)
+            box = "sketch -c color 0\nsketch -c rect 0 0 {} {}\nsketch -c color 1\n".format(sizex, sizey)
+            self.sizes[key] = len(box) + sum(len(self.command(*r)) + 1 for r in rects)
+        return self.sizes[key]
+
+    # Commands and bytes per icon (drawn at 0,0): horizontal runs vs cover
+    def stats(self, dpytype):
+        prefix = "s-" if (dpytype == 1) else ""
+        size = lambda cmds: sum(len(c) + 1 for c in cmds)
+        report = []
+        for icon in sorted(set(self.altid(code) for code in self.wi_map), key=int):
+            sizex, sizey, rects = self.load(icon, dpytype)
+            segs = self.parse("pbm/" + prefix + icon + ".pbm")[2]
+            runs = [self.command(x, y, cnt, 1) for x, y, cnt in segs]
+            cover = [self.command(*r) for r in rects]
+            report.append((prefix + icon, len(runs), size(runs), len(cover), size(cover)))
+        return report
+
+
+if __name__ == "__main__":
+    # Report icon draw cost
+    icon_map = wi_icons()
+    for dpytype in (1, 2):
+        report = icon_map.stats(dpytype)
+        print("{:>8} {:>10} {:>10} {:>10} {:>10}".format("icon", "run cmds", "run bytes", "cmds", "bytes"))
+        for row in report:
+            print("{:>8} {:>10} {:>10} {:>10} {:>10}".format(*row))
+        totals = [sum(r[i] for r in report) for i in range(1, 5)]
+        print("{:>8} {:>10} {:>10} {:>10} {:>10}\n".format("total", *totals))
@@ -0,0 +1,267 @@
+# Drive many Roku Soundbridges from one process
+#
+# Devices are listed in a JSON inventory file, e.g.
+#
+# [
+#     {"host": "192.168.1.20", "type": 2, "location": "Boston,MA,US"},
+#     {"host": "kitchen-sb", "type": 1, "lat": 42.36, "lon": -71.06, "units": "metric"}
+# ]
+#
+# Missing fields default to the command-line/config values. Weather is
+# fetched once per distinct (lat, lon, units), in the background as
+# scheduled by ow_schedule, and every display is driven by its own task on
+# a single asyncio event loop.
+
+import time
+import json
+import asyncio
+import traceback
+
+import roku_aio
+import ow_weather
+import ow_schedule
+import sb_session
+import panels
+import metrics
+import ir_keys
+from draw_icon import wi_icons
+from sketch_frame import sketchFrame, frameRenderer
+from ow_weather import eprint
+
+
+getowdata = "Getting weather data from OpenWeather..."
+connecting = "Connecting..."
+
+
+def load_inventory(fname, defaults):
+    try:
+        with open(fname) as f:
+            entries = json.load(f)
+    except (OSError, json.JSONDecodeError) as err:
+        eprint("Cannot read device inventory '{}' = {}".format(fname, err))
+        return None
+
+    devices = []
+    for entry in entries:
+        if ('host' not in entry):
+            eprint("Inventory entry without host: {}".format(entry))
+            return None
+        dev = dict(defaults)
+        dev.update(entry)
+        # Explicit location overrides default coordinates
+        if ('location' in entry and 'lat' not in entry):
+            dev['lat'] = dev['lon'] = None
+        dev['type'] = int(dev['type'])
+        dev['units'] = dev['units'].lower()
+        devices.append(dev)
+    return devices
+
+
+# (lat, lon) of each inventory entry - raises ValueError when one cannot be located
+def locate_all(inventory, client, geocache=None):
+    locations = {}
+    coords = []
+    for entry in inventory:
+        lat, lon = entry.get('lat'), entry.get('lon')
+        if (lat is None or lon is None):
+            location = entry.get('location')
+            if (location is None):
+                raise ValueError("{}: either lat/lon or location must be specified".format(entry['host']))
+            # Resolve each distinct location once
+            if (location not in locations):
+                locations[location] = ow_weather.locate(location, client, geocache)
+            if (locations[location] is None):
+                raise ValueError("{}: cannot locate '{}'".format(entry['host'], location))
+            lat, lon = locations[location]
+        coords.append((lat, lon))
+    return coords
+
+
+class fleetDevice:
+    def __init__(self, host, dpytype, where, icon_map, flow_control=True):
+        self.host = host
+        self.sb = roku_aio.aioRokuSB(dpytype, flow_control)
+        self.renderer = frameRenderer(self.sb, icon_map)
+        self.timer = metrics.panelTimer(host)
+        # Connections so far - later ones count as reconnects
+        self.opened = 0
+        self.backoff = sb_session.backoff()
+        # Delay after errors other than lost connections
+        self.error_backoff = sb_session.backoff(1.0, 60.0)
+        # Last time the connection was known to be alive
+        self.checked = 0
+        # Weather key - (lat, lon, units)
+        self.where = where
+        # Panel shown, moved by IR keys
+        self.cursor = ir_keys.panelCursor(len(panels.display_panels))
+
+
+class fleet:
+    def __init__(self, inventory, client, cache, geocache=None, panel_delay=10, debug_output=False,
+                 policy=ow_schedule.fixedPolicy, budget=None, keys=None):
+        self.client = client
+        self.cache = cache
+        self.panel_delay = panel_delay
+        self.debug_output = debug_output
+        self.icon_map = wi_icons()
+        self.policy = policy
+        self.budget = ow_schedule.callBudget() if (budget is None) else budget
+        self.keys = ir_keys.keymap() if (keys is None) else keys
+        # (lat, lon, units) -> ow_schedule.refresher
+        self.weather = {}
+        # (lat, lon, units) -> future of fetch in progress
+        self.fetching = {}
+        # Display types with icons still to be parsed
+        self.preload_types = set()
+
+        self.devices = []
+        for entry, (lat, lon) in zip(inventory, locate_all(inventory, client, geocache)):
+            where = (lat, lon, entry['units'])
+            if (where not in self.weather):
+                self.weather[where] = ow_schedule.refresher(where, client, cache, policy(cache.ttl),
+                                                            self.budget, debug_output)
+            self.preload_types.add(entry['type'])
+            self.devices.append(fleetDevice(entry['host'], entry['type'], where, self.icon_map,
+                                            entry.get('flow_control', True)))
+
+    # Start a background fetch for location when due (once per location)
+    def refresh(self, where):
+        weather = self.weather[where]
+        fut = self.fetching.get(where)
+        if (fut is None and weather.due <= time.time()):
+            fut = asyncio.get_running_loop().run_in_executor(None, weather.fetch)
+            self.fetching[where] = fut
+            fut.add_done_callback(lambda f: self.fetching.pop(where, None))
+        return fut
+
+    # Forecast for device - waits for a fetch only when there is nothing to show
+    async def weather_for(self, dev):
+        weather = self.weather[dev.where]
+        fut = self.refresh(dev.where)
+        if (weather.wx is None and fut is not None):
+            # Announce our intentions
+            if (not self.cache.fresh(self.cache.key(*dev.where))):
+                dev.renderer.render(panels.message(dev.sb.dpytype, getowdata))
+                await dev.sb.drain()
+        # Parse icons while the first forecasts are fetched
+        while (self.preload_types):
+            self.icon_map.preload(self.preload_types.pop())
+        if (weather.wx is None and fut is not None):
+            await asyncio.shield(fut)
+        return weather
+
+    # (Re-)open display with backoff - the first time show we are alive,
+    # after that show the last frame again
+    async def connect(self, dev):
+        while (not await dev.sb.open(dev.host)):
+            await asyncio.sleep(dev.backoff.next())
+        dev.backoff.reset()
+        dev.checked = time.monotonic()
+        if (dev.opened):
+            metrics.sb_reconnects.inc(host=dev.host)
+            metrics.log('reconnect', host=dev.host)
+            dev.renderer.repaint()
+        else:
+            dev.renderer.invalidate()
+            dev.renderer.render(panels.message(dev.sb.dpytype, connecting))
+        dev.opened += 1
+        await dev.sb.drain()
+
+    # Before drawing: probe a connection that has been idle - False if it is gone
+    async def check(self, dev):
+        now = time.monotonic()
+        if (now - max(dev.checked, dev.sb.heard()) >= self.panel_delay + sb_session.sbSession.probe_idle):
+            if (not await dev.sb.probe()):
+                metrics.log('disconnect', host=dev.host, reason='probe')
+                await dev.sb.abort()
+                return False
+        dev.checked = now
+        return True
+
+    # Act on an IR key (or timeout) - False when the display is handed back
+    async def key(self, dev, ir_cmd):
+        action = ir_keys.action(ir_cmd, self.keys)
+        if (self.debug_output and ir_cmd != 'TIMEOUT'):
+            print("{} IR key {}: {}".format(dev.host, ir_cmd, action))
+        if (action == 'exit'):
+            dev.sb.release(ir_cmd)
+            await dev.sb.close()
+            print("{} released by IR key {}".format(dev.host, ir_cmd))
+            return False
+        if (action == 'refresh'):
+            self.weather[dev.where].refresh()
+            fut = self.refresh(dev.where)
+            if (fut is not None):
+                dev.renderer.render(panels.message(dev.sb.dpytype, getowdata))
+                await dev.sb.drain()
+                await asyncio.shield(fut)
+        dev.cursor.move(action)
+        return True
+
+    # Run one display until its user takes it back with an IR key
+    async def drive(self, dev):
+        while (True):
+            try:
+                if (not dev.sb.is_open()):
+                    await self.connect(dev)
+
+                weather = await self.weather_for(dev)
+                # Latest forecast, kept while a refresh fails
+                wx = weather.wx
+                if (wx is None):
+                    # Show the error until a fetch succeeds (or an IR key)
+                    etext = "Weather query returned error = {}".format(weather.code)
+                    if (dev.renderer.render(panels.message(dev.sb.dpytype, etext))):
+                        print("{}: {}".format(dev.host, etext))
+                    await dev.sb.drain()
+                    if (not await self.key(dev, await dev.sb.keyproc(self.panel_delay))):
+                        return
+                    continue
+
+                panel = panels.display_panels[dev.cursor.index]
+                if (self.debug_output):
+                    print("{} screen {}: {}".format(dev.host, dev.cursor.index, time.ctime()[11:19]))
+                if (not await self.check(dev)):
+                    continue
+                dev.timer.start()
+                frame = sketchFrame(dev.sb.dpytype)
+                show = panel(frame, wx, self.icon_map)
+                dev.renderer.render(frame)
+                await dev.sb.drain()
+                dev.timer.stop(panel.__name__)
+                dev.error_backoff.reset()
+                if (not show):
+                    dev.cursor.skip()
+                    continue
+                # Hold the panel - an IR key ends the wait right away
+                if (not await self.key(dev, await dev.sb.keyproc(self.panel_delay))):
+                    return
+
+            except asyncio.CancelledError:
+                raise
+            except (EOFError, OSError) as err:
+                # Connection lost - reopen right away
+                eprint("-->Lost connection to {} = {}".format(dev.host, err))
+                metrics.log('disconnect', host=dev.host, reason=type(err).__name__)
+                await dev.sb.abort()
+            except Exception:
+                eprint("-->{}: caught network or other error:".format(dev.host))
+                traceback.print_exc()
+                await dev.sb.abort()
+                await asyncio.sleep(dev.error_backoff.next())
+
+    async def drive_all(self):
+        try:
+            await asyncio.gather(*(self.drive(dev) for dev in self.devices))
+        finally:
+            for dev in self.devices:
+                await dev.sb.close()
+
+    def run(self):
+        try:
+            asyncio.run(self.drive_all())
+        except KeyboardInterrupt:
+            eprint("Exiting...")
+            return 0
+        print("All displays released - exiting")
+        return 0
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""icon_bundle [pbm-dir [bundle]]
+
+Pack every PBM icon (default pbm/) into one binary bundle
+(default icons.bin) that wi_icons memory-maps at startup. The size and
+modification time of each PBM file are kept, so an icon changed since it
+was packed is read from its PBM file instead.
+
+Layout (little-endian):
+  header  'RWIC', version u16, count u16
+  index   count x (name 16s, width u16, height u16, offset u32,
+                   PBM size u32, PBM mtime (ns) i64)
+  rows    per icon, height rows of ceil(width / 8) bytes, MSB first
+"""
+
+import os
+import re
+import sys
+import mmap
+import struct
+
+
+magic = b'RWIC'
+version = 2
+header = struct.Struct('<4sHH')
+entry = struct.Struct('<16sHHIIq')
+
+
+class iconBundle:
+    def __init__(self, fname):
+        with open(fname, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.data)
+        tag, ver, count = header.unpack_from(self.data, 0)
+        if (tag != magic or ver != version):
+            raise ValueError("{}: not an icon bundle (version {})".format(fname, version))
+
+        # name -> (width, height, offset), (PBM size, mtime)
+        self.index = {}
+        self.sources = {}
+        for i in range(count):
+            name, width, height, offset, size, mtime = entry.unpack_from(self.data, header.size + i * entry.size)
+            name = name.rstrip(b'\0').decode('ascii')
+            self.index[name] = (width, height, offset)
+            self.sources[name] = (size, mtime)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    # Icon packed from the PBM file as it is now (or the file is gone)
+    def current(self, name, fname):
+        try:
+            st = os.stat(fname)
+        except FileNotFoundError:
+            return True
+        return self.sources[name] == (st.st_size, st.st_mtime_ns)
+
+    # Packed rows of icon, without copying
+    def rows(self, name):
+        width, height, offset = self.index[name]
+        stride = (width + 7) // 8
+        return [self.view[offset + y * stride:offset + (y + 1) * stride] for y in range(height)]
+
+    # Horizontal runs of 1-bits (x, y, cnt), as wi_icons.parse returns
+    def runs(self, name):
+        width, height, offset = self.index[name]
+        segs = []
+        for y, row in enumerate(self.rows(name)):
+            bits = format(int.from_bytes(row, 'big'), '0{}b'.format(len(row) * 8))[:width]
+            for m in re.finditer('1+', bits):
+                segs.append((m.start(), y, m.end() - m.start()))
+        return (width, height, tuple(segs))
+
+    def close(self):
+        self.view.release()
+        self.data.close()
+
+
+def pack(pbm_dir='pbm', fname='icons.bin'):
+    # Reuse the PBM parser - icons come back as runs
+    from draw_icon import wi_icons
+
+    names = sorted(f[:-4] for f in os.listdir(pbm_dir) if f.endswith('.pbm'))
+    index = b''
+    rows = b''
+    offset = header.size + len(names) * entry.size
+    for name in names:
+        pbm = os.path.join(pbm_dir, name + '.pbm')
+        st = os.stat(pbm)
+        width, height, segs = wi_icons.parse(pbm)
+        stride = (width + 7) // 8
+        bits = [0] * height
+        for x, y, cnt in segs:
+            bits[y] |= ((1 << cnt) - 1) << (stride * 8 - x - cnt)
+        index += entry.pack(name.encode('ascii'), width, height, offset + len(rows), st.st_size, st.st_mtime_ns)
+        rows += b''.join(b.to_bytes(stride, 'big') for b in bits)
+
+    with open(fname, 'wb') as f:
+        f.write(header.pack(magic, version, len(names)) + index + rows)
+    print("Packed {} icons into {} ({} bytes)".format(len(names), fname, offset + len(rows)))
+
+
+if __name__ == "__main__":
+    sys.exit(pack(*sys.argv[1:3]))
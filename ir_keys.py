@@ -0,0 +1,65 @@
+# IR remote key bindings and panel navigation
+#
+# A display intercepts the remote for as long as it is connected, and
+# keys are delivered as soon as they are pressed. Each key maps to an
+# action:
+#
+#   next      - show the next screen now
+#   previous  - back to the screen shown before this one
+#   refresh   - fetch the forecast now, then show this screen again
+#   ignore    - nothing
+#   exit      - hand the display back to the Soundbridge (it gets the key too)
+#
+# Keys without a binding exit. Config 'ir_keys' adds to or overrides the
+# default bindings, e.g. ir_keys = {'CK_MENU': 'refresh'}.
+
+from collections import deque
+
+
+actions = ('next', 'previous', 'refresh', 'ignore', 'exit')
+
+bindings = {'CK_EAST': 'next', 'CK_NEXT': 'next', 'CK_SOUTH': 'next',
+            'CK_WEST': 'previous', 'CK_PREVIOUS': 'previous', 'CK_NORTH': 'previous',
+            'CK_SELECT': 'refresh', 'CK_PLAY': 'refresh'}
+
+
+# Default bindings with overrides - raises ValueError for unknown actions
+def keymap(overrides=None):
+    keys = dict(bindings)
+    for key, act in (overrides or {}).items():
+        if (act not in actions):
+            raise ValueError("IR key {}: unknown action '{}'".format(key, act))
+        keys[key] = act
+    return keys
+
+
+# Action for a keyproc() result
+def action(key, keys):
+    if (key == 'TIMEOUT'):
+        return 'next'
+    return keys.get(key, 'exit')
+
+
+# Position in the panel list
+#  A screen is the panels drawn up to and including one that is held on
+#  the display (e.g. date/time and sunrise/sunset share a type 2 display).
+class panelCursor:
+    def __init__(self, count):
+        self.count = count
+        self.index = 0
+        # First panel of the current screen, and of the screens shown before it
+        self.start = 0
+        self.history = deque(maxlen=count)
+
+    # Panel was not held - draw the next one on the same screen
+    def skip(self):
+        self.index = (self.index + 1) % self.count
+
+    # After a held panel
+    def move(self, act):
+        if (act == 'next'):
+            self.history.append(self.start)
+            self.start = (self.index + 1) % self.count
+        elif (act == 'previous' and self.history):
+            self.start = self.history.pop()
+        self.index = self.start
@@ -0,0 +1,318 @@
+# Runtime metrics for rokuweather
+#
+# Counters, gauges and histograms kept in process, optionally exposed on
+# a local HTTP endpoint in Prometheus text format (serve()) and/or logged
+# as JSON lines (open_log()). Signals toggle on-demand profiling:
+#
+#   SIGUSR1  start/stop cProfile, stats written to <dir>/profile-<pid>-<time>.prof
+#   SIGUSR2  start/stop tracemalloc, snapshot written to <dir>/tracemalloc-<pid>-<time>.snap
+#
+# Instrumented code keeps a metric child per label set, e.g.
+#
+#   cmds = metrics.sb_commands.labels(host=host)
+#   cmds.inc()
+
+import os
+import sys
+import time
+import json
+import signal
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import startup
+
+
+class counterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name):
+        return [(name, (), self.value)]
+
+
+class gaugeValue(counterValue):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+
+class histogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, le in enumerate(self.buckets):
+            if (value <= le):
+                self.counts[i] += 1
+                break
+
+    def samples(self, name):
+        out = []
+        total = 0
+        for le, n in zip(self.buckets, self.counts):
+            total += n
+            out.append((name + '_bucket', (('le', str(le)),), total))
+        out.append((name + '_bucket', (('le', '+Inf'),), self.count))
+        out.append((name + '_sum', (), self.sum))
+        out.append((name + '_count', (), self.count))
+        return out
+
+
+class metric:
+    def __init__(self, name, help, kind, buckets=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.buckets = buckets
+        # label tuple -> value
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, **labels):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        child = self.children.get(key)
+        if (child is None):
+            with self.lock:
+                child = self.children.setdefault(key, self.new())
+        return child
+
+    def new(self):
+        if (self.kind == 'histogram'):
+            return histogramValue(self.buckets)
+        if (self.kind == 'gauge'):
+            return gaugeValue()
+        return counterValue()
+
+    # Unlabelled use
+    def inc(self, n=1, **labels):
+        self.labels(**labels).inc(n)
+
+    def set(self, value, **labels):
+        self.labels(**labels).set(value)
+
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+
+    # Sum over all label sets (observations, for histograms)
+    def total(self):
+        return sum(c.count if (self.kind == 'histogram') else c.value for c in list(self.children.values()))
+
+    def expose(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        for key, child in list(self.children.items()):
+            for name, extra, value in child.samples(self.name):
+                labels = ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+                                  for k, v in key + extra)
+                lines.append("{}{} {}".format(name, '{' + labels + '}' if labels else '', value))
+        return lines
+
+
+registry = []
+
+
+def define(name, help, kind, buckets=None):
+    m = metric(name, help, kind, buckets)
+    registry.append(m)
+    return m
+
+
+panel_seconds = define('rokuweather_panel_render_seconds', "Time to build and send one panel", 'histogram',
+                       (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+panel_commands = define('rokuweather_panel_commands', "Sketch commands sent per panel", 'histogram',
+                        (5, 10, 20, 50, 100, 200, 500, 1000))
+panel_bytes = define('rokuweather_panel_bytes', "Bytes sent per panel", 'histogram',
+                     (100, 250, 500, 1000, 2500, 5000, 10000, 25000))
+sb_commands = define('rokuweather_sb_commands_total', "Commands sent to Soundbridge", 'counter')
+sb_bytes = define('rokuweather_sb_bytes_total', "Bytes sent to Soundbridge", 'counter')
+sb_rate = define('rokuweather_sb_commands_per_second', "Commands/second answered by Soundbridge while busy",
+                 'gauge')
+sb_window = define('rokuweather_sb_window', "Soundbridge commands allowed awaiting a prompt", 'gauge')
+sb_reconnects = define('rokuweather_sb_reconnects_total', "Soundbridge connections re-opened", 'counter')
+icon_draws = define('rokuweather_icon_draws_total', "Weather icons drawn", 'counter')
+icon_seconds = define('rokuweather_icon_draw_seconds', "Time to build icon draw commands", 'histogram',
+                      (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01))
+api_seconds = define('rokuweather_api_request_seconds', "OpenWeather request latency", 'histogram',
+                     (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+api_responses = define('rokuweather_api_responses_total', "OpenWeather responses by status code", 'counter')
+gateway_requests = define('rokuweather_gateway_requests_total', "Gateway requests by path and result "
+                          "(hit, miss, coalesced, stale, error)", 'counter')
+shard_devices = define('rokuweather_shard_devices', "Displays driven by shard worker", 'gauge')
+shard_cpu = define('rokuweather_shard_cpu_cores', "CPU used by shard worker (cores)", 'gauge')
+shard_panels = define('rokuweather_shard_panels_per_second', "Panels drawn per second by shard worker", 'gauge')
+shard_rss = define('rokuweather_shard_resident_memory_bytes', "Shard worker resident set size", 'gauge')
+shard_restarts = define('rokuweather_shard_restarts_total', "Shard workers restarted", 'counter')
+rss_bytes = define('rokuweather_resident_memory_bytes', "Process resident set size", 'gauge')
+
+
+# Resident set size - peak RSS where /proc is not available
+def rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    if (resource is None):
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return maxrss if (sys.platform == 'darwin') else maxrss * 1024
+
+
+def expose():
+    rss_bytes.set(rss())
+    lines = []
+    for m in registry:
+        lines.extend(m.expose())
+    return '\n'.join(lines) + '\n'
+
+
+# Prometheus endpoint - http://host:port/metrics
+def serve(port, host='127.0.0.1'):
+    # Only needed with metrics_port set
+    with startup.timed('http.server'):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if (self.path.split('?')[0] not in ('/metrics', '/')):
+                self.send_error(404)
+                return
+            body = expose().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as err:
+        print("Cannot serve metrics on {}:{} = {}".format(host, port, err))
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# JSON lines log of panels, fetches and reconnects
+log_file = None
+log_lock = threading.Lock()
+
+
+def open_log(fname):
+    global log_file
+    try:
+        log_file = open(fname, 'a', buffering=1)
+    except OSError as err:
+        print("Cannot open metrics log '{}' = {}".format(fname, err))
+
+
+def log(event, **fields):
+    if (log_file is None):
+        return
+    record = dict(ts=round(time.time(), 3), event=event, **fields)
+    line = json.dumps(record, default=str) + '\n'
+    with log_lock:
+        log_file.write(line)
+
+
+# Time and commands/bytes sent per panel - start() before building it, stop() once sent
+class panelTimer:
+    def __init__(self, host):
+        self.host = host
+        self.cmds = sb_commands.labels(host=host)
+        self.bytes = sb_bytes.labels(host=host)
+        self.seconds = panel_seconds.labels(host=host)
+        self.ncmds = panel_commands.labels(host=host)
+        self.nbytes = panel_bytes.labels(host=host)
+
+    def start(self):
+        self.t0 = time.perf_counter()
+        self.c0 = self.cmds.value
+        self.b0 = self.bytes.value
+
+    def stop(self, panel):
+        seconds = time.perf_counter() - self.t0
+        cmds = self.cmds.value - self.c0
+        nbytes = self.bytes.value - self.b0
+        self.seconds.observe(seconds)
+        self.ncmds.observe(cmds)
+        self.nbytes.observe(nbytes)
+        log('panel', host=self.host, panel=panel, seconds=round(seconds, 6), commands=cmds, bytes=nbytes,
+            rss=rss())
+
+
+# On-demand profiling
+profile_dir = '.'
+profiler = None
+
+
+def dump_name(kind, ext):
+    return os.path.join(profile_dir, "{}-{}-{}.{}".format(kind, os.getpid(), time.strftime('%Y%m%d-%H%M%S'), ext))
+
+
+def toggle_profile(signum=None, frame=None):
+    global profiler
+    import cProfile
+    if (profiler is None):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        print("cProfile started", file=sys.stderr)
+        return
+    profiler.disable()
+    fname = dump_name('profile', 'prof')
+    try:
+        profiler.dump_stats(fname)
+        print("cProfile stats written to {}".format(fname), file=sys.stderr)
+    except OSError as err:
+        print("Cannot write {} = {}".format(fname, err), file=sys.stderr)
+    profiler = None
+
+
+def toggle_tracemalloc(signum=None, frame=None):
+    import tracemalloc
+    if (not tracemalloc.is_tracing()):
+        tracemalloc.start(25)
+        print("tracemalloc started", file=sys.stderr)
+        return
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    fname = dump_name('tracemalloc', 'snap')
+    try:
+        snapshot.dump(fname)
+        print("tracemalloc snapshot written to {}".format(fname), file=sys.stderr)
+    except OSError as err:
+        print("Cannot write {} = {}".format(fname, err), file=sys.stderr)
+    for stat in snapshot.statistics('lineno')[:10]:
+        print("  {}".format(stat), file=sys.stderr)
+
+
+def install_signals(dirname=None):
+    global profile_dir
+    if (dirname is not None):
+        profile_dir = dirname
+    # No SIGUSR1/2 on Windows, handlers only from the main thread
+    if (hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread()):
+        signal.signal(signal.SIGUSR1, toggle_profile)
+        signal.signal(signal.SIGUSR2, toggle_tracemalloc)
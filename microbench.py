@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+"""microbench [opts]
+
+Offline microbenchmarks of the drawing hot path, against a rokuSB that
+records what it would send instead of sending it:
+
+  icon.load   parse (tokenize) and cover every PBM icon in pbm/
+  icon.draw   drawIconAt of every icon, both display types
+  icon.scale  scale and cover every icon to other heights, with numpy
+              (icon.scale.numpy, if installed) and without (.python)
+  msg         rokuSB.msg text/font/clear formatting
+  parse       ow_model.parse of each onecall fixture
+  panel       every panel for each fixture and display type, full render
+
+Each case records wall time, peak memory allocated and commands/bytes
+emitted. Times are measured in units of a fixed reference workload, timed
+throughout the run, so they do not depend (much) on the machine. The
+baseline (see --save) keeps the commands/bytes of each case and the time
+of each group in those units: more commands or bytes in any case, or a
+group slower than the tolerance allows, is a regression and the exit
+status is 1. Peak memory, and the time of groups taking less than one
+reference workload, are reported only.
+
+-s, --save       Store results as the new baseline
+-b, --baseline   Baseline file, Default: microbench.json
+-t, --tolerance  Allowed growth of group time and memory (fraction), Default: 0.25
+-r, --repeat     Timing repeats (best is taken), Default: 5
+-v, --verbose    Print every case
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import getopt
+import tracemalloc
+import importlib.util
+
+import ow_stub
+import ow_model
+import panels
+from roku_tn import rokuSB
+from draw_icon import wi_icons
+from sketch_frame import sketchFrame, frameRenderer
+
+
+# Commands and bytes may grow this much (fraction, and absolute) without
+# a regression - today's date and time are drawn, fixtures move with it
+count_slack = (0.01, {'commands': 1, 'bytes': 16})
+# Groups taking less (in reference workloads) are too quick to time reliably -
+# their time is reported, not checked
+min_timed = 1.0
+
+
+# Records commands instead of sending them
+class recordingSB(rokuSB):
+    def __init__(self, dtype):
+        super().__init__(dtype)
+        self.commands = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.commands += data.count(b'\n')
+        self.bytes += len(data)
+
+
+# Canned onecall responses - (name, body, units), timed around now
+def fixtures():
+    now = time.time()
+    out = []
+    for units in ('imperial', 'metric'):
+        # Stub default: scattered clouds, rain in 30 minutes
+        showers = ow_stub.onecall(42.36, -71.06, units, now)
+        dry = ow_stub.onecall(42.36, -71.06, units, now)
+        for m in dry['minutely']:
+            m['precipitation'] = 0.0
+        storm = ow_stub.onecall(42.36, -71.06, units, now)
+        storm['current']['weather'][0].update(id=211, description='thunderstorm')
+        for i, m in enumerate(storm['minutely']):
+            m['precipitation'] = 2.0 + (i % 7)
+        # As cached before hourly/minutely were kept
+        trimmed = ow_stub.onecall(42.36, -71.06, units, now)
+        del trimmed['hourly'], trimmed['minutely']
+        for name, data in (('showers', showers), ('dry', dry), ('storm', storm), ('trimmed', trimmed)):
+            out.append(("{}-{}".format(name, units), json.dumps(data).encode('utf-8'), units))
+    return out
+
+
+# Best seconds per call of f(), over repeat runs of enough calls for ~5ms
+#  (without garbage collection, like the timeit module)
+def timeit(f, repeat):
+    t0 = time.perf_counter()
+    f()
+    once = time.perf_counter() - t0
+    number = max(1, int(0.005 / max(once, 1e-7)))
+    best = None
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for r in range(repeat):
+            t0 = time.perf_counter()
+            for i in range(number):
+                f()
+            t = (time.perf_counter() - t0) / number
+            best = t if (best is None) else min(best, t)
+    finally:
+        if (gc_was_enabled):
+            gc.enable()
+    return best
+
+
+# Heights icons are scaled to (no hand-made set)
+scale_heights = (24, 48)
+
+
+# Fixed pure Python work - formatting, containers, small JSON
+def reference():
+    cmds = ["sketch -c rect {} {} {} {}".format(x, x % 7, x % 13, 2) for x in range(200)]
+    counts = {}
+    for c in cmds:
+        counts[c[10:14]] = counts.get(c[10:14], 0) + len(c)
+    return json.loads(json.dumps(counts))
+
+
+# Peak bytes allocated during one call of f()
+def peak(f):
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class suite:
+    def __init__(self, repeat=5):
+        self.repeat = repeat
+        # name -> {'group', 'seconds', 'peak', 'commands', 'bytes', 'ref'}
+        #  ref := reference workload seconds timed last before the case
+        self.results = {}
+        self.ref = None
+
+    # Measure f(sb), which draws on the recording rokuSB sb
+    def case(self, group, name, f, dpytype=2):
+        sb = recordingSB(dpytype)
+        f(sb)
+        commands, nbytes = sb.commands, sb.bytes
+        self.results[name] = {'group': group,
+                              'seconds': timeit(lambda: f(sb), self.repeat),
+                              'peak': peak(lambda: f(sb)),
+                              'commands': commands,
+                              'bytes': nbytes,
+                              'ref': self.ref}
+
+    # Time the reference workload between groups (for the cases that
+    # follow), keeping the best
+    def calibrate(self):
+        t = self.ref = timeit(reference, self.repeat)
+        r = self.results.setdefault('reference', {'group': 'reference', 'seconds': t, 'peak': peak(reference),
+                                                  'commands': 0, 'bytes': 0})
+        r['seconds'] = min(r['seconds'], t)
+
+    def run(self):
+        self.calibrate()
+        icon_map = wi_icons()
+        icons = sorted((f[:-4] for f in os.listdir('pbm') if f.endswith('.pbm') and not f.startswith('s-')),
+                       key=int)
+
+        for icon in icons:
+            for dpytype in (1, 2):
+                fname = "pbm/{}{}.pbm".format("s-" if (dpytype == 1) else "", icon)
+                if (not os.path.exists(fname)):
+                    continue
+                self.case('icon.load', "icon.load {}".format(fname),
+                          lambda sb: wi_icons.cover(*wi_icons.parse(fname)))
+                self.case('icon.draw', "icon.draw {} type {}".format(icon, dpytype),
+                          lambda sb: icon_map.drawIconAt(sb, icon, 0, 0), dpytype)
+            self.calibrate()
+
+        has_numpy = importlib.util.find_spec('numpy') is not None
+        backends = ('numpy', 'python') if (has_numpy) else ('python',)
+        if (not has_numpy):
+            print("icon.scale.numpy skipped - numpy is not installed")
+        for backend in backends:
+            group = 'icon.scale.' + backend
+            for icon in icons:
+                runs = icon_map.runs(icon)
+                for height in scale_heights:
+                    self.case(group, "{} {} to {}".format(group, icon, height),
+                              lambda sb: wi_icons.cover(*wi_icons.scale(*runs, height, backend == 'numpy')))
+                self.calibrate()
+
+        for dpytype in (1, 2):
+            self.case('msg', "msg type {}".format(dpytype),
+                      lambda sb: sb.msg(text="scattered clouds, Humidity: 62%", font=2, x=90, y=0, clear=True),
+                      dpytype)
+
+        for name, body, units in fixtures():
+            self.case('parse', "parse {}".format(name), lambda sb: ow_model.parse(body, units))
+            wx = ow_model.parse(body, units)
+            for dpytype in (1, 2):
+                for panel in panels.display_panels:
+                    self.case('panel', "panel {} {} type {}".format(panel.__name__, name, dpytype),
+                              lambda sb: self.render(sb, panel, wx, icon_map), dpytype)
+            self.calibrate()
+        return self.results
+
+    # Panel drawn in full, as on a new connection
+    @staticmethod
+    def render(sb, panel, wx, icon_map):
+        frame = sketchFrame(sb.dpytype)
+        panel(frame, wx, icon_map)
+        frameRenderer(sb, icon_map).render(frame)
+
+
+# Group times in reference workloads, each case's timed next to it (evens
+# out changes in machine load during the run)
+def relative(results):
+    times = {}
+    for r in results.values():
+        if (r['group'] != 'reference'):
+            times[r['group']] = times.get(r['group'], 0.0) + r['seconds'] / r['ref']
+    return times
+
+
+# Baseline of results - no absolute times or sizes, which depend on the machine
+def baseline_of(results):
+    return {'groups': {g: {'cases': t['cases'], 'time': float('{:.3g}'.format(relative(results)[g]))}
+                       for g, t in groups(results).items() if g != 'reference'},
+            'cases': {name: [r['commands'], r['bytes']] for name, r in results.items() if name != 'reference'}}
+
+
+# Baseline as JSON, one group or case per line
+def baseline_json(baseline):
+    parts = []
+    for part in ('groups', 'cases'):
+        items = sorted(baseline[part].items())
+        parts.append(' "{}": {{\n{}\n }}'.format(part, ',\n'.join(
+            '  {}: {}'.format(json.dumps(k), json.dumps(v, sort_keys=True)) for k, v in items)))
+    return '{\n' + ',\n'.join(parts) + '\n}\n'
+
+
+# Commands and bytes of a group's cases, in the baseline
+def baseline_counts(results, baseline, group):
+    cases = [baseline['cases'][n] for n, r in results.items() if (r['group'] == group and n in baseline['cases'])]
+    return sum(c[0] for c in cases), sum(c[1] for c in cases)
+
+
+# Sum of results by group
+def groups(results):
+    totals = {}
+    for r in results.values():
+        t = totals.setdefault(r['group'], {'cases': 0, 'seconds': 0.0, 'peak': 0, 'commands': 0, 'bytes': 0})
+        t['cases'] += 1
+        for k in ('seconds', 'peak', 'commands', 'bytes'):
+            t[k] += r[k]
+    return totals
+
+
+# Regressions against baseline - list of messages
+def compare(results, baseline, tolerance):
+    failed = []
+    for name, r in sorted(results.items()):
+        b = baseline['cases'].get(name)
+        if (b is None):
+            continue
+        for k, base in zip(('commands', 'bytes'), b):
+            if (r[k] > base * (1 + count_slack[0]) + count_slack[1][k]):
+                failed.append("{}: {} {} > baseline {}".format(name, k, r[k], base))
+
+    now = relative(results)
+    for group, t in sorted(groups(results).items()):
+        b = baseline['groups'].get(group)
+        if (group == 'reference' or b is None or b['cases'] != t['cases'] or b['time'] < min_timed):
+            continue
+        if (now[group] > b['time'] * (1 + tolerance)):
+            failed.append("{}: time {:.3g} > baseline {:.3g} reference workloads (+{:.0f}%)".format(
+                group, now[group], b['time'], 100 * (now[group] / b['time'] - 1)))
+    return failed
+
+
+def report(results, baseline, verbose):
+    fmt = "{:<48} {:>10} {:>10} {:>9} {:>9}"
+    print(fmt.format("case", "us", "peak KB", "commands", "bytes"))
+    rows = sorted(results.items()) if (verbose) else []
+    rows += [("{} ({} cases)".format(g, t['cases']), t) for g, t in sorted(groups(results).items())]
+    for name, r in rows:
+        print(fmt.format(name, "{:.1f}".format(r['seconds'] * 1e6), "{:.1f}".format(r['peak'] / 1024),
+                         r['commands'], r['bytes']))
+    if (baseline):
+        now = relative(results)
+        print("\nvs baseline (reference workload {:.1f}us)".format(results['reference']['seconds'] * 1e6))
+        print(fmt.format("group", "time", "", "commands", "bytes"))
+        for g in sorted(set(baseline['groups']) - set(now)):
+            print("{:<48} {:>10}".format(g, "not run"))
+        for g, t in sorted(groups(results).items()):
+            b = baseline['groups'].get(g)
+            if (g == 'reference' or b is None):
+                continue
+            commands, nbytes = baseline_counts(results, baseline, g)
+            print(fmt.format(g, "{:+.0f}%".format(100 * (now[g] / b['time'] - 1)), "",
+                             "{:+d}".format(t['commands'] - commands), "{:+d}".format(t['bytes'] - nbytes)))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "hsb:t:r:v", ["help", "save", "baseline=", "tolerance=", "repeat=",
+                                                          "verbose"])
+    except getopt.error as msg:
+        print(msg)
+        print("for help use --help")
+        return 2
+
+    save = False
+    fname = 'microbench.json'
+    tolerance = 0.25
+    repeat = 5
+    verbose = False
+    for o, v in opts:
+        if (o in ["-h", "--help"]):
+            print(__doc__)
+            return 0
+        if (o in ["-s", "--save"]):
+            save = True
+        if (o in ["-b", "--baseline"]):
+            fname = v
+        if (o in ["-t", "--tolerance"]):
+            tolerance = float(v)
+        if (o in ["-r", "--repeat"]):
+            repeat = int(v)
+        if (o in ["-v", "--verbose"]):
+            verbose = True
+
+    baseline = None
+    if (not save):
+        try:
+            with open(fname) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print("No baseline '{}' - save one with --save".format(fname))
+        except (OSError, ValueError) as err:
+            print("Cannot read baseline '{}' = {}".format(fname, err))
+            return 2
+        if (baseline is not None and set(baseline) != {'groups', 'cases'}):
+            print("Baseline '{}' is in an older format - save a new one with --save".format(fname))
+            return 2
+
+    results = suite(repeat).run()
+    report(results, baseline, verbose)
+
+    if (save):
+        with open(fname, 'w') as f:
+            f.write(baseline_json(baseline_of(results)))
+        print("\nBaseline saved to {}".format(fname))
+        return 0
+    if (baseline is None):
+        return 0
+    failed = compare(results, baseline, tolerance)
+    if (failed):
+        print("\nRegressions:")
+        for msg in failed:
+            print("  " + msg)
+        return 1
+    print("\nNo regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
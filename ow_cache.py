@@ -0,0 +1,122 @@
+# On-disk caches of OpenWeather responses and geocoded locations
+#
+# Entries are kept in memory and saved as JSON under the cache
+# directory, so a restart needs no network round trip for them.
+
+import os
+import json
+import time
+import tempfile
+import threading
+
+
+# Default cache location (XDG)
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'rokuweather')
+
+
+# Dictionary persisted as a JSON file
+class jsonCache:
+    def __init__(self, path=None):
+        # None := memory only
+        self.path = path
+        self.entries = {}
+        # Fetches may run on executor threads
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if (self.path is None):
+            return
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as err:
+            print("Ignoring cache file '{}' = {}".format(self.path, err))
+
+    def save(self):
+        if (self.path is None):
+            return
+        tmp = None
+        try:
+            entries = json.dumps(self.entries)
+            folder, name = os.path.split(self.path)
+            os.makedirs(folder, exist_ok=True)
+            # A temporary file of its own - other threads and processes (fleet
+            # workers) may save the same cache at the same time
+            with tempfile.NamedTemporaryFile('w', dir=folder, prefix=name + '.', suffix='.tmp', delete=False) as f:
+                tmp = f.name
+                f.write(entries)
+            os.replace(tmp, self.path)
+        except OSError as err:
+            print("Cannot save cache file '{}' = {}".format(self.path, err))
+            if (tmp is not None and os.path.exists(tmp)):
+                os.remove(tmp)
+
+
+class weatherCache(jsonCache):
+    def __init__(self, ttl=20 * 60, path=None):
+        self.ttl = ttl
+        # key -> {'time', 'body', 'etag', 'modified'}
+        super().__init__(path)
+
+    @staticmethod
+    def key(lat, lon, units):
+        return "{:.4f},{:.4f},{}".format(float(lat), float(lon), units)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    # ttl overrides the default time to live
+    def fresh(self, key, ttl=None):
+        entry = self.entries.get(key)
+        return entry is not None and time.time() < entry['time'] + (self.ttl if ttl is None else ttl)
+
+    # Time when entry should be fetched again
+    def expires(self, key, ttl=None):
+        entry = self.entries.get(key)
+        return 0 if (entry is None) else entry['time'] + (self.ttl if ttl is None else ttl)
+
+    # Headers for a conditional request revalidating the cached entry
+    def validators(self, key):
+        entry = self.entries.get(key)
+        headers = {}
+        if (entry is not None):
+            if (entry.get('etag')):
+                headers['If-None-Match'] = entry['etag']
+            if (entry.get('modified')):
+                headers['If-Modified-Since'] = entry['modified']
+        return headers
+
+    def put(self, key, body, etag=None, modified=None):
+        with self.lock:
+            self.entries[key] = {'time': time.time(), 'body': body, 'etag': etag, 'modified': modified}
+            self.save()
+
+    # Server says cached entry is still current (304)
+    def touch(self, key):
+        with self.lock:
+            self.entries[key]['time'] = time.time()
+            self.save()
+
+
+# Location string (City,State,Country or zip-code) to lat/lon
+class geoCache(jsonCache):
+    # Entries: normalized location -> [lat, lon]
+
+    # 'Boston, MA,US' and 'boston,ma,us' are the same place
+    @staticmethod
+    def key(location):
+        return ','.join(' '.join(part.split()) for part in location.lower().split(','))
+
+    def get(self, location):
+        coords = self.entries.get(self.key(location))
+        return None if (coords is None) else tuple(coords)
+
+    def put(self, location, lat, lon):
+        with self.lock:
+            self.entries[self.key(location)] = [lat, lon]
+            self.save()
@@ -0,0 +1,163 @@
+# HTTP client for the OpenWeather API
+#
+# One keep-alive session per thread making queries (a fleet fetches on
+# executor threads), connect/read timeouts, and jittered exponential
+# backoff (honouring Retry-After) on failures. requests is imported with
+# the first query, keeping it off the startup path.
+
+import time
+import random
+import threading
+
+import metrics
+import startup
+
+
+ow_base = "https://api.openweathermap.org"
+
+
+# requests.RequestException, for except clauses - only evaluated once
+# something is raised, so requests is not imported before the first query
+def request_error():
+    import requests
+    return requests.RequestException
+
+
+# Status codes worth retrying
+retry_status = (429, 500, 502, 503, 504)
+
+
+class owClient:
+    def __init__(self, appid, base=ow_base, timeout=(5, 15), retries=3, backoff=2.0, max_retry=60,
+                 max_pause=31 * 60):
+        self.appid = appid
+        # Scheme and host queries are sent to
+        self.base = base.rstrip('/')
+        # (connect, read) seconds
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # Longest in-line wait before a retry
+        self.max_retry = max_retry
+        # Longest wait after a failed query
+        self.max_pause = max_pause
+        # Per thread session, created by its first query
+        self.local = threading.local()
+        # Consecutive failed queries, server requested delay (under lock)
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.retry_after = None
+        self.stats = {'requests': 0, 'failures': 0, 'retries': 0,
+                      'latency_last': 0.0, 'latency_max': 0.0, 'latency_total': 0.0}
+        # Daily call budget (ow_schedule.callBudget) charged for every attempt,
+        # retries included (None := not counted)
+        self.budget = None
+
+    # Full jitter: uniform in [0, backoff * 2^n], capped
+    def jitter(self, n):
+        return random.uniform(0, min(self.max_pause, self.backoff * (2 ** n)))
+
+    # Retry-After is either seconds or an HTTP date
+    @staticmethod
+    def parse_retry_after(value):
+        if (value is None):
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        import email.utils
+        try:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    # How long to wait before querying again after a failed query
+    def pause(self):
+        with self.lock:
+            retry_after, failures = self.retry_after, self.failures
+        if (retry_after is not None):
+            return min(retry_after, self.max_pause)
+        return min(self.max_pause, self.backoff * 30 * (2 ** max(failures - 1, 0)) * random.uniform(0.5, 1.5))
+
+    # Response (status code or error name) to an attempt started at t0
+    #  failure := counted as a failed attempt
+    def record(self, t0, status, failure):
+        if (self.budget is not None):
+            self.budget.record(time.time())
+        latency = time.monotonic() - t0
+        metrics.api_seconds.observe(latency)
+        metrics.api_responses.inc(status=status)
+        metrics.log('fetch', url=self.base, status=status, seconds=round(latency, 3))
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['failures'] += failure
+            self.stats['latency_last'] = latency
+            self.stats['latency_total'] += latency
+            self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+
+    # No retry once the day's budget is spent
+    def spent(self):
+        return self.budget is not None and self.budget.wait(time.time()) > 0
+
+    # Outcome of a query: succeeded or not, server requested delay
+    def outcome(self, ok, retry_after=None):
+        with self.lock:
+            self.failures = 0 if (ok) else self.failures + 1
+            self.retry_after = retry_after
+
+    # Session of the calling thread - requests.Session is not thread-safe
+    def session(self):
+        with startup.timed('requests'):
+            import requests
+        session = getattr(self.local, 'session', None)
+        if (session is None):
+            session = self.local.session = requests.Session()
+        return session
+
+    # GET with retries - returns response (maybe an error status) or raises
+    # requests.RequestException when the server cannot be reached.
+    #  With stream the body is read by the caller (resp.iter_content()),
+    #  who closes the response.
+    def get(self, path, params, headers=None, stream=False):
+        # Imports requests (timed) on the first query
+        session = self.session()
+        import requests
+        url = self.base + path
+        params = dict(params, appid=self.appid)
+        attempt = 0
+        while (True):
+            t0 = time.monotonic()
+            try:
+                resp = session.get(url, params=params, headers=headers, timeout=self.timeout, stream=stream)
+            except requests.RequestException as err:
+                self.record(t0, type(err).__name__, True)
+                if (attempt >= self.retries or self.spent()):
+                    self.outcome(False)
+                    raise
+                delay = self.jitter(attempt)
+            else:
+                self.record(t0, resp.status_code, resp.status_code >= 400)
+                if (resp.status_code < 400):
+                    self.outcome(True)
+                    return resp
+                retry_after = self.parse_retry_after(resp.headers.get('Retry-After'))
+                delay = self.jitter(attempt) if (retry_after is None) else retry_after
+                retry = resp.status_code in retry_status and attempt < self.retries and delay <= self.max_retry
+                if (not retry or self.spent()):
+                    self.outcome(False, retry_after)
+                    return resp
+                # Release the connection of a streamed response
+                resp.close()
+
+            with self.lock:
+                self.stats['retries'] += 1
+            attempt += 1
+            time.sleep(delay)
+
+    def summary(self):
+        with self.lock:
+            st = dict(self.stats)
+        return "requests: {}, failures: {}, retries: {}, latency last/max/avg: {:.2f}/{:.2f}/{:.2f}s".format(
+            st['requests'], st['failures'], st['retries'], st['latency_last'], st['latency_max'],
+            st['latency_total'] / max(st['requests'], 1))
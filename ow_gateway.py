@@ -0,0 +1,160 @@
+# Local OpenWeather gateway
+#
+# One process fetches and caches onecall data and serves it over HTTP to
+# any number of rokuweather instances (set their ow_url to the gateway,
+# e.g. "http://127.0.0.1:8042"). Identical concurrent requests share one
+# upstream query, so upstream calls grow with the number of locations,
+# not devices. Clients' appid is ignored - the gateway uses its own.
+#
+#   /data/2.5/onecall  full response fetched upstream, client 'exclude' applied
+#   /data/2.5/weather  location lookup (only 'coord' and 'name' returned)
+
+import json
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import metrics
+import ow_weather
+from ow_weather import eprint
+
+
+class owGateway:
+    def __init__(self, client, cache, geocache=None, host='127.0.0.1', port=8042, debug_output=False):
+        self.client = client
+        self.cache = cache
+        self.geocache = geocache
+        self.debug_output = debug_output
+        # Cache key -> fetch in progress: {'done': Event set when it completes,
+        # 'code': its status, also served to requests that waited for it}
+        self.inflight = {}
+        self.lock = threading.Lock()
+        # (cache key, exclude) -> (cache entry time, body) with exclude applied (under lock)
+        self.views = {}
+
+        gateway = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                gateway.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def run(self):
+        print("OpenWeather gateway on {}".format(self.url))
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            eprint("Exiting...")
+        finally:
+            self.server.server_close()
+        return 0
+
+    def reply(self, req, status, body=b'', headers=()):
+        req.send_response(status)
+        for k, v in headers:
+            req.send_header(k, v)
+        req.send_header('Content-Type', 'application/json; charset=utf-8')
+        req.send_header('Content-Length', str(len(body)))
+        req.end_headers()
+        req.wfile.write(body)
+
+    def error(self, req, status, message):
+        headers = []
+        if (status in (429, 503)):
+            headers.append(('Retry-After', str(int(self.client.pause()))))
+        self.reply(req, status, json.dumps({'cod': status, 'message': message}).encode(), headers)
+
+    def handle(self, req):
+        url = urlparse(req.path)
+        q = {k: v[0] for k, v in parse_qs(url.query).items()}
+        try:
+            if (url.path == ow_weather.ow_url):
+                self.onecall(req, q)
+            elif (url.path == ow_weather.ow_url_current):
+                self.locate(req, q)
+            else:
+                metrics.gateway_requests.inc(path=url.path, result='error')
+                self.error(req, 404, "Not found")
+        except (KeyError, ValueError) as err:
+            metrics.gateway_requests.inc(path=url.path, result='error')
+            self.error(req, 400, "Bad request: {}".format(err))
+
+    # Fresh data from cache, else one upstream query per key at a time
+    def fetch(self, lat, lon, units):
+        key = self.cache.key(lat, lon, units)
+        if (self.cache.fresh(key)):
+            return ('hit', 200)
+
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if (leader):
+                flight = self.inflight[key] = {'done': threading.Event(), 'code': 503}
+        if (not leader):
+            flight['done'].wait()
+            return ('coalesced', flight['code'])
+
+        try:
+            code, body = ow_weather.onecall(lat, lon, units, self.client, self.debug_output, self.cache, exclude='')
+            if (body is None and self.cache.get(key) is not None):
+                # Serve stale data while upstream fails
+                eprint("Upstream query for {} returned error = {}, serving cached data".format(key, code))
+                result = ('stale', 200)
+            else:
+                result = ('miss', code if (body is None) else 200)
+            flight['code'] = result[1]
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight['done'].set()
+        return result
+
+    def onecall(self, req, q):
+        lat, lon = float(q['lat']), float(q['lon'])
+        units = q.get('units', 'standard').lower()
+        exclude = ','.join(sorted(p for p in q.get('exclude', '').split(',') if p))
+        result, code = self.fetch(lat, lon, units)
+        metrics.gateway_requests.inc(path=ow_weather.ow_url, result=result)
+        if (code != 200):
+            self.error(req, code if isinstance(code, int) else 503, "Upstream error {}".format(code))
+            return
+
+        key = self.cache.key(lat, lon, units)
+        entry = self.cache.get(key)
+        with self.lock:
+            view = self.views.get((key, exclude))
+        if (view is None or view[0] != entry['time']):
+            data = json.loads(entry['body'])
+            for part in exclude.split(','):
+                data.pop(part, None)
+            view = (entry['time'], json.dumps(data).encode('utf-8'))
+            with self.lock:
+                self.views[(key, exclude)] = view
+
+        etag = '"{}-{}"'.format(int(entry['time'] * 1000), exclude or 'all')
+        if (req.headers.get('If-None-Match') == etag):
+            self.reply(req, 304, headers=[('ETag', etag)])
+            return
+        self.reply(req, 200, view[1], [('ETag', etag)])
+
+    def locate(self, req, q):
+        location = q.get('q', q.get('zip'))
+        if (location is None):
+            raise KeyError('q')
+        coords = ow_weather.locate(location, self.client, self.geocache)
+        metrics.gateway_requests.inc(path=ow_weather.ow_url_current, result='miss' if (coords is None) else 'hit')
+        if (coords is None):
+            self.error(req, 404, "city not found")
+            return
+        body = {'coord': {'lat': coords[0], 'lon': coords[1]}, 'name': location}
+        self.reply(req, 200, json.dumps(body).encode('utf-8'))
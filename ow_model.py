@@ -0,0 +1,163 @@
+# Forecast data used by the display panels
+#
+# Only the fields the panels show are kept, already formatted for
+# display, so a forecast is formatted once per fetch rather than on
+# every panel draw.
+
+import time
+from array import array
+
+import ow_stream
+
+
+wind_vector = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+               'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+
+
+# Temperature and speed labels for units
+def unit_labels(units):
+    if units == 'imperial':
+        return ('F', 'mph')
+    elif units == 'metric':
+        return ('C', 'm/s')
+    return ('K', 'm/s')
+
+
+class CurrentConditions:
+    __slots__ = ('code', 'temp', 'conditions', 'wind', 'sunrise', 'sunset', 'time', 'pressure', 'daylight')
+
+    def __init__(self, ccond, temp_units, speed_units, debug_output=False):
+        descr = ccond['weather'][0]['description']
+        self.code = ccond['weather'][0]['id']
+        ctemp = int(round(ccond['temp']))
+        wspeed = int(round(ccond['wind_speed']))
+        wchill = int(round(ccond['feels_like']))
+        wdir = ccond['wind_deg']
+        humidity = ccond['humidity']
+        wvector = wind_vector[int((float(wdir) / 22.5) + 0.5) % 16]
+
+        self.temp = "{}\xb0{}".format(ctemp, temp_units)
+        self.conditions = "{}, Humidity: {}%".format(descr, humidity)
+        self.wind = "Wind: {} at {}{}, Chill: {}\xb0{}".format(wvector, wspeed, speed_units, wchill, temp_units)
+        # We want am/pm in lowercase, no leading zero
+        self.sunrise = time.strftime("%-I:%M %P", time.localtime(ccond['sunrise']))
+        self.sunset = time.strftime("%-I:%M %P", time.localtime(ccond['sunset']))
+        # Raw values for the refresh scheduler
+        self.time = ccond['dt']
+        self.pressure = ccond['pressure']
+        self.daylight = ccond['sunrise'] <= ccond['dt'] < ccond['sunset']
+
+        if (debug_output):
+            vis = ccond['visibility']
+            pressure = ccond['pressure']
+            print("Current conditions: ({})\nTemp: {}\xb0{} {}, ".format(self.code, ctemp, temp_units, descr),
+                  end='')
+            print("Feels like:", wchill, "Wind:", wvector, "Direction: {}deg".format(wdir))
+            print("Humidity {}%, visibility {:2.1f}mi, ".format(humidity, float(vis) / 1609.344), end='')
+            print("Pressure {:4.1f}mb".format(float(pressure)))
+            print("Sunrise:", self.sunrise, "Sunset:", self.sunset)
+
+
+class DailyForecast:
+    __slots__ = ('code', 'day', 'date', 'high', 'low')
+
+    def __init__(self, daily, temp_units, debug_output=False):
+        high = int(round(daily['temp']['max']))
+        low = int(round(daily['temp']['min']))
+        day_time = time.localtime(daily['dt'])
+        self.code = daily['weather'][0]['id']
+        self.day = time.strftime("%a", day_time)
+        self.date = time.strftime("%e.%b", day_time)
+        self.high = "{}\xb0{}".format(high, temp_units)
+        self.low = "{}\xb0{}".format(low, temp_units)
+
+        if (debug_output):
+            print("{} {}".format(self.day, self.date),
+                  "({}) {}".format(self.code, daily['weather'][0]['description']), end='')
+            print(", High: {}, Low: {}".format(high, low))
+
+
+# Evenly spaced values from time 'start', 'step' seconds apart
+class series:
+    __slots__ = ('start', 'step')
+
+    # Index of the value for time 'now'
+    def index(self, now):
+        return max(0, int((now - self.start) // self.step))
+
+
+class HourlyForecast(series):
+    __slots__ = ('temps', 'pops', 'temp_units')
+
+    def __init__(self, hourly, temp_units, debug_output=False):
+        self.start = hourly[0]['dt']
+        self.step = 3600
+        self.temps = array('f', (h['temp'] for h in hourly))
+        # Probability of precipitation, 0 .. 1
+        self.pops = array('f', (h.get('pop', 0) for h in hourly))
+        self.temp_units = temp_units
+
+        if (debug_output):
+            print("Hourly: {} hours, {:.0f} .. {:.0f}\xb0{}".format(len(self.temps), min(self.temps),
+                                                                    max(self.temps), temp_units))
+
+
+class MinutelyPrecipitation(series):
+    __slots__ = ('rates',)
+
+    def __init__(self, minutely, debug_output=False):
+        self.start = minutely[0]['dt']
+        self.step = 60
+        # mm/h
+        self.rates = array('f', (m.get('precipitation', 0) for m in minutely))
+
+        if (debug_output):
+            print("Minutely: {} minutes, peak {:.1f}mm/h".format(len(self.rates), max(self.rates)))
+
+
+class Forecast:
+    __slots__ = ('current', 'today', 'tomorrow', 'hourly', 'minutely')
+
+    def __init__(self, current, today, tomorrow, hourly=None, minutely=None):
+        self.current = current
+        self.today = today
+        self.tomorrow = tomorrow
+        # Not in every response (excluded, or not available for the location)
+        self.hourly = hourly
+        self.minutely = minutely
+
+
+# Parts of a onecall response used - see ow_stream
+#  Only need today and tomorrow (1st 2) of daily
+used = {'current': None,
+        'daily': (None, 2),
+        'hourly': (('dt', 'temp', 'pop'), None),
+        'minutely': (('dt', 'precipitation'), None)}
+
+
+# Read the used parts of a onecall response body: bytes, str or an iterable of chunks
+def read(body):
+    if (isinstance(body, (bytes, str))):
+        body = (body,)
+    return ow_stream.read(body, used)
+
+
+# Build forecast from the used parts of a onecall response
+def build(wdata, units, debug_output=False):
+    temp_units, speed_units = unit_labels(units)
+    current = CurrentConditions(wdata['current'], temp_units, speed_units, debug_output)
+    hourly = wdata.get('hourly')
+    minutely = wdata.get('minutely')
+    if (debug_output):
+        print("\nForecast:")
+    daily = wdata['daily']
+    return Forecast(current,
+                    DailyForecast(daily[0], temp_units, debug_output),
+                    DailyForecast(daily[1], temp_units, debug_output),
+                    HourlyForecast(hourly, temp_units, debug_output) if hourly else None,
+                    MinutelyPrecipitation(minutely, debug_output) if minutely else None)
+
+
+# Build forecast from onecall response body
+def parse(body, units, debug_output=False):
+    return build(read(body), units, debug_output)
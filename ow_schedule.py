@@ -0,0 +1,220 @@
+# Weather refresh scheduling
+#
+# A refresher holds the latest forecast for one location and decides
+# when to query OpenWeather again using a refresh policy:
+#
+#   fixed     - every cache_ttl seconds
+#   adaptive  - sooner while there is precipitation or the pressure changes
+#               fast, later overnight and while conditions stay the same
+#
+# All refreshers share a daily API call budget. With start() fetches run
+# on a background thread (fleet mode runs fetch() on the event loop's
+# executor instead), so panels keep showing the last forecast while a
+# new one is fetched.
+
+import time
+import threading
+from collections import deque
+
+import metrics
+import ow_weather
+from ow_weather import eprint
+
+
+day = 24 * 3600
+
+
+# Condition codes with precipitation: thunderstorm, drizzle, rain, snow
+def precipitation(code):
+    return 200 <= code < 700
+
+
+class fixedPolicy:
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    # Seconds until forecast wx (fetched at now) should be fetched again
+    def interval(self, wx, now):
+        return self.ttl
+
+
+class adaptivePolicy(fixedPolicy):
+    # Interval while conditions are volatile, and longest interval
+    fast = 5 * 60
+    slow = 60 * 60
+    # Pressure change (hPa/hour) taken as volatile
+    pressure_rate = 1.0
+    # Interval multiplier for each unchanged fetch (up to max_stable), and overnight
+    stable_factor = 1.5
+    max_stable = 4
+    night_factor = 2.0
+
+    def __init__(self, ttl):
+        super().__init__(ttl)
+        # Previous observation, fetches with unchanged conditions
+        self.last = None
+        self.stable = 0
+
+    def interval(self, wx, now):
+        cur = wx.current
+        volatile = precipitation(cur.code)
+        # Cached or revalidated data repeats the last observation
+        if (self.last is not None and cur.time > self.last.time):
+            rate = abs(cur.pressure - self.last.pressure) * 3600 / (cur.time - self.last.time)
+            volatile = volatile or rate >= self.pressure_rate
+            if (cur.code == self.last.code and cur.temp == self.last.temp):
+                self.stable += 1
+            else:
+                self.stable = 0
+        if (self.last is None or cur.time > self.last.time):
+            self.last = cur
+
+        if (volatile):
+            self.stable = 0
+            return min(self.fast, self.ttl)
+        interval = self.ttl * self.stable_factor ** min(self.stable, self.max_stable)
+        if (not cur.daylight):
+            interval *= self.night_factor
+        return min(interval, max(self.slow, self.ttl))
+
+
+# Policies by config name
+policies = {'fixed': fixedPolicy, 'adaptive': adaptivePolicy}
+
+
+# OpenWeather queries allowed per day, shared by all refreshers
+class callBudget:
+    def __init__(self, per_day=1000):
+        self.per_day = per_day
+        # Times of queries in the last day
+        self.calls = deque()
+        # Refreshers sharing the budget
+        self.users = 0
+        self.lock = threading.Lock()
+
+    def record(self, now):
+        with self.lock:
+            self.calls.append(now)
+
+    # Seconds until a query is allowed (0 := now)
+    def wait(self, now):
+        with self.lock:
+            while (self.calls and self.calls[0] <= now - day):
+                self.calls.popleft()
+            if (len(self.calls) < self.per_day):
+                return 0
+            return self.calls[0] + day - now
+
+    # Shortest interval that spreads the budget over the day
+    def floor(self):
+        return day * max(self.users, 1) / self.per_day
+
+
+class refresher:
+    # Keep showing a forecast this old while queries fail
+    max_stale = 3 * 3600
+
+    def __init__(self, where, client, cache, policy, budget, debug_output=False):
+        # (lat, lon, units)
+        self.where = where
+        self.client = client
+        self.cache = cache
+        self.policy = policy
+        self.budget = budget
+        budget.users += 1
+        # Every query attempt of client, retries included, counts against budget
+        client.budget = budget
+        self.debug_output = debug_output
+        self.interval = policy.ttl
+        # Latest forecast and result code of the last fetch
+        self.wx = None
+        self.code = None
+        self.fetched = 0
+        # Completed fetches, time of the next one
+        self.fetches = 0
+        self.due = 0
+        # Next fetch bypasses the cache
+        self.forced = False
+        self.updated = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    # Query (or take from cache) the forecast and schedule the next fetch
+    def fetch(self):
+        lat, lon, units = self.where
+        key = None if (self.cache is None) else self.cache.key(lat, lon, units)
+        with self.updated:
+            forced, self.forced = self.forced, False
+        max_age = 0 if (forced) else self.interval
+        now = time.time()
+        if (key is None or not self.cache.fresh(key, max_age)):
+            wait = self.budget.wait(now)
+            if (wait > 0):
+                self.done('BudgetExhausted', None, now, wait)
+                return
+
+        try:
+            code, wx = ow_weather.forecast(lat, lon, units, self.client, self.debug_output, self.cache,
+                                           max_age)
+        except Exception as err:
+            import traceback
+            eprint("-->Forecast for {},{} failed:".format(lat, lon))
+            traceback.print_exc()
+            code, wx = type(err).__name__, None
+        now = time.time()
+        if (wx is None):
+            self.done(code, None, now, self.client.pause())
+            return
+        self.interval = max(self.policy.interval(wx, now), self.budget.floor())
+        due = now + self.interval if (key is None) else self.cache.expires(key, self.interval)
+        self.done(code, wx, now, max(due - now, 0))
+
+    def done(self, code, wx, now, delay):
+        with self.updated:
+            self.code = code
+            if (wx is not None):
+                self.wx = wx
+                self.fetched = now
+            elif (self.wx is not None and now - self.fetched > self.max_stale):
+                self.wx = None
+            self.due = now + delay
+            self.fetches += 1
+            self.updated.notify_all()
+        metrics.log('refresh', where=self.where, code=code, next=round(delay))
+        if (self.debug_output):
+            print("Weather {} for {},{}: next fetch in {}s".format(code, self.where[0], self.where[1], int(delay)))
+
+    # Fetch now (budget permitting), revalidating any cached forecast
+    def refresh(self):
+        with self.updated:
+            self.forced = True
+            self.due = 0
+            self.updated.notify_all()
+
+    # Wait until more than 'after' fetches have completed
+    def wait(self, after=0, timeout=None):
+        with self.updated:
+            return self.updated.wait_for(lambda: self.fetches > after, timeout)
+
+    # Fetch on a background thread whenever due
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while (True):
+            with self.updated:
+                delay = self.due - time.time()
+                if (not self.stopped and delay > 0):
+                    self.updated.wait(delay)
+                if (self.stopped):
+                    return
+                if (time.time() < self.due):
+                    continue
+            self.fetch()
+
+    def stop(self):
+        with self.updated:
+            self.stopped = True
+            self.updated.notify_all()
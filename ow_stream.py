@@ -0,0 +1,131 @@
+# Incremental reader for OpenWeather JSON responses
+#
+# A full onecall response (48 hourly and 61 minutely entries) is several
+# times the size of the parts the panels use, and json.loads() of it
+# builds every entry as a dict. read() takes the body in chunks (e.g.
+# resp.iter_content()), decodes one array item at a time and keeps only
+# the fields asked for, so memory stays at one item plus what is kept.
+#
+#   keep = {'current': None,                  # whole value
+#           'daily': (None, 2),               # first 2 items, whole
+#           'hourly': (('dt', 'temp'), None)}  # all items, these fields
+#
+# Top-level keys not in keep are skipped.
+
+import json
+import codecs
+
+
+decoder = json.JSONDecoder()
+blank = ' \t\n\r'
+delimiters = blank + ',:]}'
+
+
+class reader:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    # Append at least size more characters (what is left at end of input)
+    # to the buffer - False at end of input
+    def more(self, size=1):
+        if (self.eof):
+            return False
+        # Text already read is not needed again
+        parts = [self.buf[self.pos:]]
+        self.pos = 0
+        for chunk in self.chunks:
+            text = chunk if isinstance(chunk, str) else self.utf8.decode(chunk)
+            parts.append(text)
+            size -= len(text)
+            if (size <= 0):
+                break
+        else:
+            parts.append(self.utf8.decode(b'', True))
+            self.eof = True
+        self.buf = ''.join(parts)
+        return True
+
+    # Next non-blank character, not consumed
+    def peek(self):
+        while (True):
+            while (self.pos < len(self.buf) and self.buf[self.pos] in blank):
+                self.pos += 1
+            if (self.pos < len(self.buf)):
+                return self.buf[self.pos]
+            if (not self.more()):
+                raise ValueError("Unexpected end of JSON document")
+
+    def expect(self, chars):
+        c = self.peek()
+        if (c not in chars):
+            raise ValueError("Expected {!r} in JSON document, found {!r}".format(chars, c))
+        self.pos += 1
+        return c
+
+    # Next complete JSON value
+    def value(self):
+        self.peek()
+        while (True):
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # Value continues in the next chunks - at least double what
+                # is buffered before decoding it again, so a large value
+                # read in small chunks is not decoded over and over
+                if (not self.more(len(self.buf) - self.pos)):
+                    raise
+                continue
+            # So may a number ('1', '1.', '1e' ...) not followed by a delimiter
+            if (isinstance(value, (int, float)) and not isinstance(value, bool) and
+                    (end == len(self.buf) or self.buf[end] not in delimiters) and self.more()):
+                continue
+            self.pos = end
+            return value
+
+    # Items of a JSON array, one at a time
+    def items(self):
+        self.expect('[')
+        if (self.peek() == ']'):
+            self.pos += 1
+            return
+        while (True):
+            yield self.value()
+            if (self.expect(',]') == ']'):
+                return
+
+
+# Read a JSON object from chunks (bytes or str) - returns a dict of the parts in keep
+def read(chunks, keep):
+    r = reader(chunks)
+    doc = {}
+    r.expect('{')
+    if (r.peek() == '}'):
+        return doc
+    while (True):
+        key = r.value()
+        r.expect(':')
+        spec = keep.get(key, False)
+        if (spec is False):
+            # Not wanted - arrays are dropped an item at a time
+            if (r.peek() == '['):
+                for item in r.items():
+                    pass
+            else:
+                r.value()
+        elif (spec is None or r.peek() != '['):
+            doc[key] = r.value()
+        else:
+            fields, limit = spec
+            items = doc[key] = []
+            for item in r.items():
+                if (limit is not None and len(items) >= limit):
+                    continue
+                if (fields is not None and isinstance(item, dict)):
+                    item = {k: item[k] for k in fields if k in item}
+                items.append(item)
+        if (r.expect(',}') == '}'):
+            return doc
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""ow_stub [port]
+
+Stub OpenWeather API for testing without an API key. Serves
+/data/2.5/weather (location lookup) and /data/2.5/onecall with canned
+but current data, honours If-None-Match, and counts requests.
+"""
+
+import sys
+import json
+import time
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Canned onecall response around time 'now'
+def onecall(lat, lon, units, now=None):
+    now = int(time.time() if now is None else now)
+    # Kelvin, Celsius or Fahrenheit
+    t = {'imperial': lambda c: c * 9 / 5 + 32, 'metric': lambda c: c}.get(units, lambda c: c + 273.15)
+    day = 24 * 3600
+
+    def weather(code, descr):
+        return [{'id': code, 'main': descr.title(), 'description': descr, 'icon': '01d'}]
+
+    return {
+        'lat': float(lat), 'lon': float(lon), 'timezone': 'America/New_York', 'timezone_offset': -14400,
+        'current': {'dt': now, 'sunrise': now - 4 * 3600, 'sunset': now + 6 * 3600, 'temp': t(16.3),
+                    'feels_like': t(15.8), 'pressure': 1016, 'humidity': 62, 'dew_point': t(9.0), 'uvi': 2.1,
+                    'clouds': 40, 'visibility': 10000, 'wind_speed': 4.6, 'wind_deg': 230,
+                    'weather': weather(802, 'scattered clouds')},
+        'minutely': [{'dt': now + 60 * i, 'precipitation': 0.0 if i < 30 else 0.2 * (i - 30)}
+                     for i in range(61)],
+        'hourly': [{'dt': now + 3600 * i, 'temp': t(16.3 - 0.4 * i), 'feels_like': t(15.8 - 0.4 * i),
+                    'pressure': 1016 - i, 'humidity': 62, 'wind_speed': 4.6, 'wind_deg': 230,
+                    'pop': min(1.0, 0.02 * i), 'weather': weather(500 if i > 30 else 802, 'light rain')}
+                   for i in range(48)],
+        'daily': [{'dt': now + day * i, 'sunrise': now - 4 * 3600 + day * i, 'sunset': now + 6 * 3600 + day * i,
+                   'temp': {'day': t(17 - i), 'min': t(9 - i), 'max': t(19 - i), 'night': t(10 - i),
+                            'eve': t(14 - i), 'morn': t(10 - i)},
+                   'humidity': 60, 'wind_speed': 5.0, 'wind_deg': 220, 'pop': 0.1 * i,
+                   'weather': weather([802, 500, 800, 600, 211, 741, 804, 300][i], 'mixed')}
+                  for i in range(8)],
+    }
+
+
+class owStub:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, ttl=10 * 60):
+        self.latency = latency
+        # New forecast data every ttl seconds (changes the ETag)
+        self.ttl = ttl
+        # Status code to answer with instead of data (e.g. 429, 503)
+        self.status = None
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'onecall': 0, 'weather': 0, 'not_modified': 0, 'errors': 0}
+
+        stub = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def reply(self, req, status, body=b'', headers=()):
+        req.send_response(status)
+        for k, v in headers:
+            req.send_header(k, v)
+        req.send_header('Content-Type', 'application/json; charset=utf-8')
+        req.send_header('Content-Length', str(len(body)))
+        req.end_headers()
+        req.wfile.write(body)
+
+    def handle(self, req):
+        self.count('requests')
+        if (self.latency):
+            time.sleep(self.latency)
+        url = urlparse(req.path)
+        q = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if (self.status is not None):
+            self.count('errors')
+            self.reply(req, self.status, json.dumps({'cod': self.status, 'message': 'stub error'}).encode(),
+                       [('Retry-After', '1')])
+            return
+
+        if ('appid' not in q):
+            self.count('errors')
+            self.reply(req, 401, b'{"cod": 401, "message": "Invalid API key"}')
+            return
+
+        if (url.path == '/data/2.5/weather'):
+            self.count('weather')
+            body = {'coord': {'lat': 42.3601, 'lon': -71.0589}, 'name': q.get('q', q.get('zip', ''))}
+            self.reply(req, 200, json.dumps(body).encode())
+            return
+
+        if (url.path == '/data/2.5/onecall'):
+            self.count('onecall')
+            epoch = int(time.time() // self.ttl) * self.ttl
+            etag = '"{}-{}-{}-{}"'.format(q.get('lat'), q.get('lon'), q.get('units'), epoch)
+            if (req.headers.get('If-None-Match') == etag):
+                self.count('not_modified')
+                self.reply(req, 304, headers=[('ETag', etag)])
+                return
+            data = onecall(q.get('lat', 0), q.get('lon', 0), q.get('units', 'standard'), epoch)
+            for part in q.get('exclude', '').split(','):
+                data.pop(part, None)
+            self.reply(req, 200, json.dumps(data).encode(), [('ETag', etag)])
+            return
+
+        self.count('errors')
+        self.reply(req, 404, b'{"cod": "404", "message": "Not found"}')
+
+
+if __name__ == "__main__":
+    stub = owStub(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080).start()
+    print("OpenWeather stub on {}".format(stub.url))
+    try:
+        stub.thread.join()
+    except KeyboardInterrupt:
+        stub.stop()
@@ -0,0 +1,114 @@
+# OpenWeather location and forecast queries
+
+import sys
+import json
+
+import ow_model
+import ow_client
+from ow_cache import weatherCache
+
+
+ow_url = "/data/2.5/onecall"
+ow_url_current = "/data/2.5/weather"
+# Bytes read at a time from a streamed response
+chunk_size = 8192
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+# Find lat/lon from location (City,State,Country or zip-code)
+#  A location found before is answered from the geocode cache.
+def locate(location, client, cache=None):
+    if (cache is not None):
+        coords = cache.get(location)
+        if (coords is not None):
+            return coords
+
+    # Determing if zip code or city,state given
+    if location.isdigit():
+        qloc = {'zip': location}
+    else:
+        qloc = {'q': location}
+    try:
+        resp = client.get(ow_url_current, qloc)
+    except ow_client.request_error() as err:
+        eprint("Location query failed = {}".format(err))
+        return None
+    if (resp.status_code != 200):
+        eprint("Location query returned error = {}", resp.status_code)
+        eprint("Try appending 2-character country code to location.")
+        return None
+
+    current_info = json.loads(resp.text)
+    lat = current_info['coord']['lat']
+    lon = current_info['coord']['lon']
+    print("{} is located at lat: {}, lon: {}".format(location, lat, lon))
+    if (cache is not None):
+        cache.put(location, lat, lon)
+    return (lat, lon)
+
+
+# Send onecall query - returns (status code or error name, response or None)
+#  A stale cached response is revalidated with a conditional request where
+#  the server supports it.
+def query(lat, lon, units, client, debug_output, cache, exclude, stream=False):
+    key = weatherCache.key(lat, lon, units)
+    qforecast = {'lat': lat, 'lon': lon, 'units': units, 'exclude': exclude}
+    headers = {} if (cache is None) else cache.validators(key)
+    try:
+        resp = client.get(ow_url, qforecast, headers, stream)
+    except ow_client.request_error() as err:
+        return (type(err).__name__, None)
+    if (debug_output):
+        print("OpenWeather", client.summary())
+    return (resp.status_code, resp)
+
+
+# Get onecall response body - returns (status code or error name, body or None)
+#  A fresh cached response (younger than max_age, default cache TTL) is
+#  used without a query.
+def onecall(lat, lon, units, client, debug_output=False, cache=None, max_age=None, exclude='alerts'):
+    key = weatherCache.key(lat, lon, units)
+    if (cache is not None and cache.fresh(key, max_age)):
+        return (200, cache.get(key)['body'])
+
+    code, resp = query(lat, lon, units, client, debug_output, cache, exclude)
+    if (code == 304 and cache is not None and cache.get(key) is not None):
+        cache.touch(key)
+        return (200, cache.get(key)['body'])
+    if (code != 200):
+        return (code, None)
+    body = resp.content
+    if (cache is not None):
+        cache.put(key, body.decode('utf-8'), resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
+    return (200, body)
+
+
+# Get forecast - returns (status code or error name, ow_model.Forecast or None)
+#  The response is read as it arrives, keeping only what the panels use
+#  (see ow_model.used) - that is also what is cached.
+def forecast(lat, lon, units, client, debug_output=False, cache=None, max_age=None):
+    key = weatherCache.key(lat, lon, units)
+    if (cache is not None and cache.fresh(key, max_age)):
+        return (200, ow_model.parse(cache.get(key)['body'], units, debug_output))
+
+    code, resp = query(lat, lon, units, client, debug_output, cache, 'alerts', stream=True)
+    if (resp is None):
+        return (code, None)
+    try:
+        if (code == 304 and cache is not None and cache.get(key) is not None):
+            cache.touch(key)
+            return (200, ow_model.parse(cache.get(key)['body'], units, debug_output))
+        if (code != 200):
+            return (code, None)
+        try:
+            wdata = ow_model.read(resp.iter_content(chunk_size))
+        except ow_client.request_error() as err:
+            return (type(err).__name__, None)
+    finally:
+        resp.close()
+    if (cache is not None):
+        cache.put(key, json.dumps(wdata), resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
+    return (200, ow_model.build(wdata, units, debug_output))
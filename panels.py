@@ -0,0 +1,133 @@
+# Weather display panels
+#
+# Each panel draws forecast 'wx' (ow_model.Forecast) into a sketchFrame
+# 'sb' and returns True when it should be held on the display for the
+# panel delay.
+
+import time
+
+from sketch_frame import sketchFrame
+
+
+# Precipitation rate (mm/h) drawn at full height
+heavy_rain = 7.6
+
+
+def current_conditions(sb, wx, icon_map):
+    # Roku current weather to display
+    fnt = 1 if (sb.dpytype == 1) else 2
+    xoff = 80 if (sb.dpytype == 1) else 90
+    cur = wx.current
+    sb.msg(text=cur.temp, font=10 if (sb.dpytype == 1) else 3, x=34, y=0, clear=True)
+    sb.msg(text=cur.conditions, font=fnt, x=xoff, y=0)
+    sb.msg(text=cur.wind, font=fnt, x=xoff, y=8 if (sb.dpytype == 1) else 16)
+    sb.icon(icon_map, cur.code, 0, 0)
+    return True
+
+
+def weather_preview(sb, wx, icon_map):
+    # Roku weather preview to display
+    #  rest of today
+    fnt = 1 if (sb.dpytype == 1) else 2
+    ymax = 15 if (sb.dpytype == 1) else 31
+    yoff = 8 if (sb.dpytype == 1) else 16
+    today = wx.today
+    sb.msg(text=today.day, font=fnt, x=0, y=0, clear=True)  # day
+    sb.msg(text=today.date, x=0, y=yoff)  # date
+    sb.msg(text=today.high, x=82, y=0)  # max temp
+    sb.msg(text=today.low, x=82, y=yoff)  # min temp
+    # Clear second half and  draw border line
+    sb.rect(139, 0, 141, ymax, color=0)
+    sb.line(140, 0, 140, ymax)
+    # tomorrow
+    xoff = 227 if (sb.dpytype == 1) else 233
+    tomorrow = wx.tomorrow
+    sb.msg(text=tomorrow.day, font=fnt, x=145, y=0)  # day
+    sb.msg(text=tomorrow.date, x=145, y=yoff)  # date
+    sb.msg(text=tomorrow.high, x=xoff, y=0)  # max temp
+    sb.msg(text=tomorrow.low, x=xoff, y=yoff)  # min temp
+
+    sb.icon(icon_map, today.code, 47 if (sb.dpytype == 1) else 49, 0)
+    sb.icon(icon_map, tomorrow.code, 188 if (sb.dpytype == 1) else 194, 0)
+    return True
+
+
+# Temperature over the next 24 hours
+def hourly_trend(sb, wx, icon_map):
+    hourly = wx.hourly
+    if (hourly is None):
+        return False
+    first = hourly.index(time.time())
+    # 24 hours, 8 pixels apart, fit right of the labels
+    temps = hourly.temps[first:first + 24]
+    if (len(temps) < 2):
+        return False
+    fnt = 1 if (sb.dpytype == 1) else 2
+    ymax = 15 if (sb.dpytype == 1) else 31
+    yoff = 8 if (sb.dpytype == 1) else 16
+    high, low = max(temps), min(temps)
+    sb.msg(text="High {}\xb0{}".format(int(round(high)), hourly.temp_units), font=fnt, x=0, y=0, clear=True)
+    sb.msg(text="Low {}\xb0{}".format(int(round(low)), hourly.temp_units), x=0, y=yoff)
+    # High at the top
+    scale = ymax / max(high - low, 1.0)
+    xoff = 88
+    points = [(xoff + 8 * i, ymax - int(round((t - low) * scale))) for i, t in enumerate(temps)]
+    for (x1, y1), (x2, y2) in zip(points, points[1:]):
+        sb.line(x1, y1, x2, y2)
+    return True
+
+
+# Precipitation rate over the next hour - skipped while it stays dry
+def precipitation_hour(sb, wx, icon_map):
+    minutely = wx.minutely
+    if (minutely is None):
+        return False
+    now = time.time()
+    first = minutely.index(now)
+    rates = minutely.rates[first:first + 60]
+    if (not any(rates)):
+        return False
+    fnt = 1 if (sb.dpytype == 1) else 2
+    ymax = 15 if (sb.dpytype == 1) else 31
+    yoff = 8 if (sb.dpytype == 1) else 16
+    if (rates[0] == 0):
+        start = next(i for i, r in enumerate(rates) if r)
+        summary = "Precip. in {} min".format(start)
+    elif (all(rates)):
+        summary = "Precip. all hour"
+    else:
+        summary = "Precip. for {} min".format(rates.index(0))
+    sb.msg(text=summary, font=fnt, x=0, y=0, clear=True)
+    sb.msg(text="Peak {:.1f}mm/h".format(max(rates)), x=0, y=yoff)
+    # One minute every 2 pixels, full height at heavy_rain
+    xoff = 140
+    sb.line(xoff, ymax, xoff + 2 * 60 - 1, ymax)
+    for i, r in enumerate(rates):
+        h = min(ymax, int(round(ymax * min(r / heavy_rain, 1.0))))
+        if (h):
+            sb.rect(xoff + 2 * i, ymax - h, 2, h)
+    return True
+
+
+def local_datetime(sb, wx, icon_map):
+    sb.msg(text=time.strftime('%H:%M   %A, %b %-d'),
+           clear=True, font=10 if (sb.dpytype == 1) else 2, x=60, y=0)
+    return True if (sb.dpytype == 1) else False
+
+
+def sun_rise_set(sb, wx, icon_map):
+    fnt = 10 if (sb.dpytype == 1) else 2
+    yoff = 0 if (sb.dpytype == 1) else 16
+    sb.msg(text="Sunrise: " + wx.current.sunrise, font=fnt, x=8, y=yoff, clear=True if (sb.dpytype == 1) else False)
+    sb.msg(text="Sunset: " + wx.current.sunset, font=fnt, x=148, y=yoff)
+    return True
+
+
+# Dispatch for each screen display
+display_panels = [current_conditions, precipitation_hour, weather_preview, hourly_trend, local_datetime,
+                  sun_rise_set]
+
+
+# Single line status/error message
+def message(dpytype, text):
+    return sketchFrame(dpytype).msg(text=text, clear=True, font=1, x=25, y=5 if (dpytype == 1) else 10)
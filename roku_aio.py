@@ -0,0 +1,205 @@
+# Asyncio comms to Roku Soundbridge
+#
+# Same operations as roku_tn.rokuSB on asyncio streams. Drawing calls
+# (msg, cmd, clear, batch) only queue data on the transport, so sketch
+# code and frameRenderer work unchanged; await drain() to wait for it to
+# be sent. A reader task per connection answers telnet negotiation and
+# queues IR codes, so many devices share one event loop. As with rokuSB,
+# IR keys are intercepted for as long as the connection is open, and with
+# flow control commands are sent only a window ahead of their prompts
+# (sb_session.sbFlow): the rest wait in a backlog that prompts release.
+
+import sys
+import time
+import socket
+import asyncio
+from collections import deque
+
+from sb_session import keepalive, telnet, escape, split_host, scan, sbFlow, sbCommands
+
+
+class aioRokuSB(sbCommands):
+    # flow_control := send commands ahead of their prompts only within a window
+    def __init__(self, dtype, flow_control=True):
+        super().__init__(dtype)
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.keys = asyncio.Queue()
+        self.prompt = asyncio.Event()
+        # When anything was last received (time.monotonic)
+        self.last_heard = 0.0
+        self.flow_control = flow_control
+        self.flow = None
+        # Commands waiting for room in the window, set when prompts make room
+        self.backlog = deque()
+        self.acks = asyncio.Event()
+
+    def is_open(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    # host may be given as host:port (default port 4444)
+    async def open(self, host):
+        addr, port = split_host(host)
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(addr, port), 10)
+            keepalive(self.writer.get_extra_info('socket'))
+        except (ConnectionError, socket.error, asyncio.TimeoutError) as err:
+            print("SoundBridge '{}', not found or connect failure = {}".format(host, err))
+            return False
+
+        self.keys = asyncio.Queue()
+        self.prompt = asyncio.Event()
+        self.backlog.clear()
+        self.flow = sbFlow(host, self.flow) if (self.flow_control) else None
+        self.task = asyncio.ensure_future(self.listen())
+        try:
+            await asyncio.wait_for(self.prompt.wait(), 2)
+        except asyncio.TimeoutError:
+            print("SB not responding")
+            await self.abort()
+            return False
+
+        # Save host for reopen()
+        self.host = host
+        self.count_as(host)
+        # Set character encoding default, keep IR keys until closed
+        with self.batch():
+            self.msg(encoding='utf8')
+            self.cmd("irman echo")
+            self.intercept()
+        return True
+
+    async def reopen(self):
+        if (self.host is None):
+            return False
+        assert(not self.is_open())
+        return await self.open(self.host)
+
+    async def close(self):
+        if (not self.is_open()):
+            return
+        try:
+            with self.batch():
+                self.cmd("sketch -c exit")
+                self.cmd("irman off")
+                self.cmd("exit")
+            await self.drain()
+        except socket.error:
+            print("Socket error in close = {}", sys.exc_info())
+        finally:
+            await self.abort()
+
+    # Drop connection without goodbyes
+    async def abort(self):
+        self.backlog.clear()
+        if (self.flow is not None):
+            self.flow.close()
+        self.acks.set()
+        if (self.task is not None):
+            self.task.cancel()
+            self.task = None
+        if (self.writer is not None):
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, socket.error):
+                pass
+            self.writer = None
+            self.reader = None
+
+    # Reader task - strip telnet negotiation, note prompts, queue IR codes
+    async def listen(self):
+        buf = b''
+        try:
+            while (True):
+                data = await self.reader.read(4096)
+                if (not data):
+                    break
+                self.last_heard = time.monotonic()
+                data, replies = telnet(data)
+                if (replies):
+                    self.writer.write(replies)
+                n, keys, buf = scan(buf + data)
+                if (n):
+                    self.prompt.set()
+                    if (self.flow is not None):
+                        self.flow.acked(n, self.last_heard)
+                        self.pump()
+                for key in keys:
+                    self.keys.put_nowait(key)
+        except (ConnectionError, socket.error):
+            pass
+        # EOF - wake any waiter
+        if (self.flow is not None):
+            self.flow.close()
+        self.acks.set()
+        self.keys.put_nowait(None)
+
+    def write(self, data):
+        if (not self.is_open()):
+            print("Socket error in write = connection closed")
+            raise ConnectionResetError("SoundBridge '{}' connection closed".format(self.host))
+        data = escape(data)
+        if (self.flow is None):
+            self.writer.write(data)
+            return
+        self.backlog.extend(line + b'\n' for line in data.split(b'\n'))
+        # Not a whole command - no prompt to wait for
+        tail = self.backlog.pop()[:-1]
+        if (tail):
+            self.backlog.append(tail)
+        self.pump()
+
+    # Send backlog commands while the window has room
+    def pump(self):
+        n = self.flow.free()
+        out = []
+        while (self.backlog and n > 0):
+            out.append(self.backlog.popleft())
+            n -= out[-1].endswith(b'\n')
+        if (out and self.is_open()):
+            self.flow.sending(sum(d.endswith(b'\n') for d in out), time.monotonic())
+            self.writer.write(b''.join(out))
+        self.acks.set()
+
+    # Wait for queued data (and any backlog) to be sent
+    async def drain(self):
+        while (self.backlog and self.is_open()):
+            self.acks.clear()
+            try:
+                await asyncio.wait_for(self.acks.wait(), self.flow.ack_timeout)
+            except asyncio.TimeoutError:
+                self.flow.expire()
+                self.pump()
+        if (not self.is_open()):
+            raise ConnectionResetError("SoundBridge '{}' connection closed".format(self.host))
+        await self.writer.drain()
+
+    def heard(self):
+        return self.last_heard
+
+    # Liveness probe - a harmless command must be answered by a prompt
+    async def probe(self, timeout=2):
+        if (not self.is_open() or self.task is None or self.task.done()):
+            return False
+        self.prompt.clear()
+        try:
+            self.write(b"sketch -c encoding utf8\n")
+            await self.drain()
+            await asyncio.wait_for(self.prompt.wait(), timeout)
+        except (ConnectionError, socket.error, asyncio.TimeoutError):
+            return False
+        return True
+
+    # Wait up to timeout for an IR key - 'TIMEOUT' if none was pressed
+    async def keyproc(self, timeout):
+        try:
+            ir_cmd = await asyncio.wait_for(self.keys.get(), timeout)
+        except asyncio.TimeoutError:
+            return 'TIMEOUT'
+
+        if (ir_cmd is None):
+            await self.abort()
+            raise EOFError("SoundBridge '{}' closed connection".format(self.host))
+        return ir_cmd
@@ -1,53 +1,169 @@
 # Telnet comms to Roku Soundbridge
+#
+# IR keys are intercepted for as long as the connection is open. Once the
+# first prompt has been read, a reader thread per connection is the only
+# reader of its socket: it takes everything the Soundbridge sends,
+# counting prompts (for probe and flow control) and queueing IR keys, so
+# keyproc() gets a key the moment it is pressed without any commands per
+# panel. Until then open() reads the greeting itself, refusing any telnet
+# options the Soundbridge asks for.
+#
+# Flow control: the Soundbridge answers every command with a prompt, and
+# only a window of commands is sent ahead of their prompts, so a burst
+# (a panel with icons) cannot overrun its input. The window tunes itself
+# per device to keep a few commands queued in it (as TCP Vegas does with
+# round trip times): larger while prompts come back promptly, smaller
+# when they lag, halved if they stop.
 
 import sys
+import time
+import queue
+import select
 import socket
-from telnetlib import Telnet
+import threading
 
+from sb_session import keepalive, telnet, escape, prompts, split_host, scan, sbFlow, sbCommands
 
-# Font List for costumization:
-#  1 - Fixed8
-#  2 - Fixed16 (UFT8 font with japanese charachters)
-#  3 - ZurichBold32
-#  10 - ZurichBold16
-#  11 - ZurichLite16
-#  12 - Fixed16
-#  14 - SansSerif16
 
-class rokuSB:
-    def __init__(self, dtype):
-        self.sb = Telnet()
-        self.dpytype = dtype
-        self.host = None
+# Reader thread - all input of one connection, until EOF or close()
+class sbReader:
+    # Seconds between checks for close()
+    poll = 0.5
 
+    def __init__(self, sock, flow, reply, data=b''):
+        self.sock = sock
+        self.flow = flow
+        # Sends telnet replies (under the writer's lock)
+        self.reply = reply
+        # IR keys (None := connection closed) and prompts
+        self.keys = queue.Queue()
+        self.prompt = threading.Event()
+        # When anything was last received
+        self.heard = time.monotonic()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(data,), daemon=True)
+        self.thread.start()
+
+    def run(self, data):
+        buf = b''
+        try:
+            while (not self.stop.is_set()):
+                if (data):
+                    buf = self.take(buf, data)
+                if (not select.select([self.sock], [], [], self.poll)[0]):
+                    data = b''
+                    continue
+                data = self.sock.recv(4096)
+                if (not data):
+                    break
+        except OSError:
+            # Connection reset
+            pass
+        self.flow.close()
+        self.keys.put(None)
+
+    # Count prompts, queue IR keys - returns what is left of buf
+    def take(self, buf, data):
+        self.heard = time.monotonic()
+        data, replies = telnet(data)
+        if (replies):
+            self.reply(replies)
+        n, keys, buf = scan(buf + data)
+        if (n):
+            self.prompt.set()
+            self.flow.acked(n, self.heard)
+        for key in keys:
+            self.keys.put(key)
+        return buf
+
+    # Stop reading - waits for the thread so the socket can be closed after
+    def close(self):
+        self.stop.set()
+        if (self.thread is not threading.current_thread()):
+            self.thread.join(2 * self.poll)
+
+
+class rokuSB(sbCommands):
+    # flow_control := send commands ahead of their prompts only within a window
+    def __init__(self, dtype, flow_control=True):
+        super().__init__(dtype)
+        # Connected socket (None := closed)
+        self.sock = None
+        # IR keys (None := connection closed) and prompts seen by the reader thread
+        self.keys = queue.Queue()
+        self.prompt = threading.Event()
+        self.reader = None
+        # Writes come from the caller and telnet replies from the reader
+        self.write_lock = threading.Lock()
+        self.flow_control = flow_control
+        self.flow = None
+
+    # host may be given as host:port (default port 4444)
     def open(self, host):
+        addr, port = split_host(host)
+        sock = None
         try:
-            self.sb.open(host, 4444, 10)
-            prompt = self.sb.expect([b'SoundBridge> ', b'sketch> '], 2)
-            if (prompt[0] == -1):
+            sock = socket.create_connection((addr, port), 10)
+            keepalive(sock)
+            if (self.flow_control):
+                # Window refills are a command or two - send them without waiting for an ACK (Nagle)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            data = self.greet(sock, 2)
+            if (data is None):
                 print("SB not responding")
-                self.sb.close()
+                sock.close()
                 return False
 
-        except (ConnectionError, socket.error) as err:
+        except (ConnectionError, socket.error, EOFError) as err:
             print("SoundBridge '{}', not found or connect failure = {}".format(host, err))
+            if (sock is not None):
+                sock.close()
             return False
 
         # Save host for reopen()
         self.host = host
-        # Set character encoding default
-        self.msg(encoding='utf8')
-        self.cmd("irman echo")
+        self.count_as(host)
+        # From here on the reader thread has the connection's input
+        self.flow = sbFlow(host, self.flow)
+        self.sock = sock
+        self.reader = sbReader(sock, self.flow, self.reply, data)
+        self.keys = self.reader.keys
+        self.prompt = self.reader.prompt
+        # Set character encoding default, keep IR keys until closed
+        with self.batch():
+            self.msg(encoding='utf8')
+            self.cmd("irman echo")
+            self.intercept()
         return True
 
+    # Wait for the first prompt - returns the text after it (for the reader),
+    # None if none came within timeout
+    def greet(self, sock, timeout):
+        end = time.monotonic() + timeout
+        text = b''
+        while (True):
+            for p in prompts:
+                if (p in text):
+                    return text[text.find(p) + len(p):]
+            left = end - time.monotonic()
+            if (left <= 0 or not select.select([sock], [], [], left)[0]):
+                return None
+            data = sock.recv(4096)
+            if (not data):
+                raise EOFError("connection closed")
+            data, replies = telnet(data)
+            if (replies):
+                sock.sendall(replies)
+            text += data
+
     def reopen(self):
         if (self.host is None):
             return False
-        assert(self.sb.get_socket() is None)
+        assert(self.sock is None)
         return self.open(self.host)
 
     def close(self):
-        if (self.sb.get_socket() is None):
+        if (self.sock is None):
             return
         try:
             # self.cmd("sketch -c clear")
@@ -57,67 +173,88 @@ class rokuSB:
         except socket.error:
             print("Socket error in close = {}", sys.exc_info())
         finally:
-            if (self.sb.get_socket() is not None):
-                self.sb.close()
-
-    # Optional args to msg (soundbridge display)
-    #
-    # text          - default none - can be omitted to just set font and encoding
-    # x,y  location - default 0,0
-    # font          -
-    # clear         - 0/1 force the display to clear first (default 0)
-    # encoding      - set roku text encoding
-    #
-    def msg(self, **kwargs):
-        x = kwargs.get('x', 0)
-        y = kwargs.get('y', 0)
-        text = kwargs.get('text')
-        clear = kwargs.get('clear', False)
-        font = kwargs.get('font')
-        encoding = kwargs.get('encoding')
-
-        if (encoding is not None):
-            self.cmd("sketch -c encoding " + str(encoding))
-
-        if (font is not None):
-            self.cmd("sketch -c font " + str(font))
-
-        if (text is None):
+            self.abort()
+
+    # Drop connection without goodbyes
+    def abort(self):
+        sock = self.sock
+        if (sock is None):
             return
+        # Wakes the reader thread, which is done with the socket before it is closed
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if (self.reader is not None):
+            self.reader.close()
+            self.reader = None
+        with self.write_lock:
+            self.sock = None
+        sock.close()
 
-        if (clear):
-            self.clear()
+    # When anything was last received from the Soundbridge (time.monotonic)
+    def heard(self):
+        return 0.0 if (self.reader is None) else self.reader.heard
 
-        self.cmd('sketch -c text {} {} "{}"'.format(x, y, text))
-        return
+    # Send data, a window of commands at a time with flow control
+    def write(self, data):
+        if (not self.flow_control or self.flow is None):
+            self.send(data)
+            return
+        lines = data.split(b'\n')
+        # Not a whole command - no prompt to wait for
+        tail = lines.pop()
+        while (lines):
+            n = self.flow.room()
+            self.flow.sending(len(lines[:n]), time.monotonic())
+            self.send(b''.join(line + b'\n' for line in lines[:n]))
+            del lines[:n]
+        if (tail):
+            self.send(tail)
 
-    def cmd(self, text):
+    def send(self, data):
         try:
-            self.sb.write(text.encode('utf-8') + b'\n')
+            with self.write_lock:
+                if (self.sock is None):
+                    raise ConnectionResetError("SoundBridge '{}' connection closed".format(self.host))
+                self.sock.sendall(escape(data))
         except socket.error:
             print("Socket error in write = {}", sys.exc_info())
-            if (self.sb.get_socket() is not None):
-                self.sb.close()
+            self.abort()
             raise
 
-    def clear(self):
-        self.cmd("sketch -c clear")
+    # Telnet replies from the reader thread, as they are (no IAC doubling)
+    def reply(self, data):
+        with self.write_lock:
+            if (self.sock is None):
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                # Connection lost - the reader sees EOF next
+                pass
 
-    # Handle input and look for IR commands between panels
-    def keyproc(self, timeout):
-        self.cmd("irman intercept")
+    # Liveness probe - a harmless command must be answered by a prompt
+    def probe(self, timeout=2):
+        if (self.sock is None):
+            return False
+        self.prompt.clear()
         try:
-            msg = self.sb.expect([b'irman: (.*)$'], timeout)
-        except EOFError:
-            if (self.sb.get_socket() is not None):
-                self.sb.close()
-            raise
+            self.write(b"sketch -c encoding utf8\n")
+        except socket.error:
+            return False
+        if (not self.prompt.wait(timeout)):
+            self.abort()
+            return False
+        return True
 
-        # Got an IR code - pass it on to SB and exit app
-        self.cmd("irman off")
-        if (msg[0] == -1):
+    # Wait up to timeout for an IR key - 'TIMEOUT' if none was pressed
+    def keyproc(self, timeout):
+        try:
+            ir_cmd = self.keys.get(timeout=timeout)
+        except queue.Empty:
             return 'TIMEOUT'
-        self.cmd("sketch -c exit")
-        ir_cmd = msg[1].group(1)
-        self.cmd("irman dispatch {}".format(ir_cmd))
-        return ir_cmd
\ No newline at end of file
+        if (ir_cmd is None):
+            self.abort()
+            raise EOFError("SoundBridge '{}' closed connection".format(self.host))
+        return ir_cmd
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
 """rokuweather [opts] RokuSB
+   rokuweather [opts] --fleet devices.json
+   rokuweather [opts] --gateway [host:]port
 
-Hostname or IP of RokuSB required argument
+Hostname or IP of RokuSB required argument (unless --fleet is given),
+optionally followed by :port
 
 Command-line opts:
 
@@ -12,20 +15,36 @@ Command-line opts:
 -u, --units     Units of measurement (Standard, Metric or Imperial)
 -t, --type      Display type (1 := M1000/1, 2 := R1000)
 -r, --reset     Reset Soundbridge and exit sketch
+-f, --fleet     Drive every display listed in a JSON inventory file
+-w, --workers   With --fleet, shard the displays over this many worker
+                processes (0 := one per core)
+-g, --gateway   Serve cached OpenWeather data to other instances (their
+                ow_url := http://host:port) instead of driving a display
 
 """
+# First, so startup times are measured from here
+import startup
+
+import os
 import sys
-import traceback
 import time
 import getopt
-import requests
-import json
 
 import roku_tn
+import ow_weather
+import ow_cache
+import ow_client
+import ow_schedule
+import sb_session
+import panels
+import metrics
+import ir_keys
 from draw_icon import wi_icons
+from sketch_frame import sketchFrame, frameRenderer
+from ow_weather import eprint
 
-# OpenWeather API credentials (supply your own)
-from ow_data import config
+# OpenWeather API credentials (supply your own) are imported from ow_data
+# when main() starts
 
 # Example file ow_data.py contents
 # Application credentials for OpenWeather API
@@ -37,21 +56,62 @@ from ow_data import config
 #    units = "Imperial",
 #    #lat = "",
 #    #lon = "",
+#    #cache_ttl = 20 * 60,     # seconds a forecast is reused
+#    #refresh = "adaptive",     # or "fixed" (every cache_ttl)
+#    #api_budget = 1000,        # OpenWeather queries per day
+#    #cache_dir = "",           # forecast and geocode caches, default ~/.cache/rokuweather
+#    #ow_url = "https://api.openweathermap.org",
+#    #panel_delay = 10,         # seconds each panel is shown
+#    #ir_keys = {"CK_MENU": "refresh"},  # IR key bindings, see ir_keys.py
+#    #flow_control = True,      # pace commands by Soundbridge prompts, see roku_tn.py
+#    #metrics_port = 9105,      # Prometheus endpoint on localhost
+#    #metrics_log = "",         # JSON lines log of panels and fetches
 # )
 
 
-def eprint(*args, **kwargs):
-    print(*args, file=sys.stderr, **kwargs)
-
-
 class Usage(Exception):
     def __init__(self, msg):
         self.msg = msg
 
 
+# Fleet sharded over worker processes, sharing forecasts through a local gateway
+def run_shards(inventory, workers, config, client, cache, geocache, cache_dir, panel_delay, refresh, keys,
+               debug_output):
+    with startup.timed('asyncio'):
+        import fleet
+    with startup.timed('http.server'):
+        import ow_gateway
+    import supervisor
+    try:
+        coords = fleet.locate_all(inventory, client, geocache)
+    except ValueError as err:
+        eprint(err)
+        return 2
+    devices = [dict(entry, lat=lat, lon=lon) for entry, (lat, lon) in zip(inventory, coords)]
+    gcache = ow_cache.weatherCache(cache.ttl, os.path.join(cache_dir, 'gateway.json'))
+    try:
+        gateway = ow_gateway.owGateway(client, gcache, geocache, '127.0.0.1', 0, debug_output)
+    except OSError as err:
+        eprint("Cannot start OpenWeather gateway = {}".format(err))
+        return 1
+    api_budget = config.get('api_budget', 1000)
+    if (workers > api_budget):
+        eprint("Only {0} workers - api_budget = {0} queries a day".format(max(api_budget, 1)))
+    # Workers' queries reach OpenWeather only through the gateway, so
+    # their shares keep it within the budget
+    shards, share = supervisor.split_budget(devices, workers, api_budget)
+    options = {'appid': config['appid'], 'ttl': cache.ttl, 'panel_delay': panel_delay, 'refresh': refresh,
+               'api_budget': share, 'keys': keys,
+               'debug_output': debug_output, 'metrics_log': config.get('metrics_log')}
+    return supervisor.supervisor(shards, options, gateway, debug_output).run()
+
+
 def main(argv=None):
+    from ow_data import config
+
     # Some constant defs
     getowdata = "Getting weather data from OpenWeather..."
+    connecting = "Connecting..."
     ow_appid = config['appid']
     try:
         ow_lat = config['lat']
@@ -60,30 +120,27 @@ def main(argv=None):
         ow_lat = ow_lon = None
         pass
 
-    ow_url = "https://api.openweathermap.org/data/2.5/onecall"
-    ow_url_current = "https://api.openweathermap.org/data/2.5/weather"
     try:
         location = config['location']
     except KeyError:
         location = None
         pass
 
-    wind_vector = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
-                   'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
     # Type 1 := 280x16, 2 := 280x32
     display_type = 1
     sb_open = False
 
     # Single panel display time
-    panel_delay = 10
+    panel_delay = config.get('panel_delay', 10)
 
     # Parse any command-line args
     if argv is None:
         argv = sys.argv
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "hvl:t:ru:", ["help", "verbose", "location=",
-                                                               "type=", "reset", "units="])
+            opts, args = getopt.getopt(argv[1:], "hvl:t:ru:f:g:w:", ["help", "verbose", "location=", "type=",
+                                                                     "reset", "units=", "fleet=", "gateway=",
+                                                                     "workers="])
         except getopt.error as msg:
             raise Usage(msg)
 
@@ -91,6 +148,9 @@ def main(argv=None):
         debug_output = False
         reset_sb = False
         units = None
+        fleet_file = None
+        gateway = None
+        workers = None
         for o, v in opts:
             if (o == '-v'):
                 debug_output = True
@@ -100,24 +160,89 @@ def main(argv=None):
             if (o in ["-l", "--location"]):
                 location = v
             if (o in ["-t", "--type"]):
-                display_type = v
+                try:
+                    display_type = int(v)
+                except ValueError:
+                    raise Usage("Display type must be 1 or 2")
             if (o in ["-r", "--reset"]):
                 reset_sb = True
             if (o in ["-u", "--units"]):
-                units = v.lower()
-
-        if units is None:
-            units = 'imperial'
+                units = v
+            if (o in ["-f", "--fleet"]):
+                fleet_file = v
+            if (o in ["-g", "--gateway"]):
+                host, _, port = v.rpartition(':')
+                try:
+                    gateway = (host or '127.0.0.1', int(port))
+                except ValueError:
+                    raise Usage("Gateway port must be a number")
+            if (o in ["-w", "--workers"]):
+                try:
+                    workers = int(v) or os.cpu_count() or 1
+                except ValueError:
+                    raise Usage("Workers must be a number")
+
+        units = 'imperial' if units is None else units.lower()
+        # Forecasts and locations survive restarts
+        cache_dir = config.get('cache_dir', ow_cache.cache_dir())
+        cache = ow_cache.weatherCache(config.get('cache_ttl', 20 * 60), os.path.join(cache_dir, 'onecall.json'))
+        geocache = ow_cache.geoCache(os.path.join(cache_dir, 'geocode.json'))
+        client = ow_client.owClient(ow_appid, config.get('ow_url', ow_client.ow_base))
+        refresh = config.get('refresh', 'adaptive')
+        if (refresh not in ow_schedule.policies):
+            raise Usage("Unknown refresh policy '{}'".format(refresh))
+        budget = ow_schedule.callBudget(config.get('api_budget', 1000))
+        try:
+            keys = ir_keys.keymap(config.get('ir_keys'))
+        except ValueError as err:
+            raise Usage(str(err))
+
+        # Instrumentation - SIGUSR1/SIGUSR2 toggle cProfile/tracemalloc dumps to cache_dir
+        if (config.get('metrics_port')):
+            metrics.serve(int(config['metrics_port']))
+        if (config.get('metrics_log')):
+            metrics.open_log(config['metrics_log'])
+        metrics.install_signals(cache_dir)
+
+        # OpenWeather data for other instances
+        if (gateway is not None):
+            if (len(args) != 0 or fleet_file is not None):
+                raise Usage("Display host or fleet not allowed with --gateway")
+            with startup.timed('http.server'):
+                import ow_gateway
+            # Full responses - kept apart from this instance's own cache
+            gcache = ow_cache.weatherCache(cache.ttl, os.path.join(cache_dir, 'gateway.json'))
+            try:
+                server = ow_gateway.owGateway(client, gcache, geocache, gateway[0], gateway[1], debug_output)
+            except OSError as err:
+                eprint("Cannot serve on {}:{} = {}".format(gateway[0], gateway[1], err))
+                return 1
+            return server.run()
+
+        # Many displays, one process
+        if (fleet_file is not None):
+            if (len(args) != 0):
+                raise Usage("Display host not allowed with --fleet")
+            with startup.timed('asyncio'):
+                import fleet
+            inventory = fleet.load_inventory(fleet_file, {'type': display_type, 'units': units,
+                                                          'location': location, 'lat': ow_lat, 'lon': ow_lon,
+                                                          'flow_control': config.get('flow_control', True)})
+            if (inventory is None):
+                return 2
+            if (workers is not None):
+                return run_shards(inventory, workers, config, client, cache, geocache, cache_dir, panel_delay,
+                                  refresh, keys, debug_output)
+            try:
+                displays = fleet.fleet(inventory, client, cache, geocache, panel_delay, debug_output,
+                                       ow_schedule.policies[refresh], budget, keys)
+            except ValueError as err:
+                eprint(err)
+                return 2
+            return displays.run()
 
-        if units == 'imperial':
-            temp_units = 'F'
-            speed_units = 'mph'
-        elif units == 'metric':
-            temp_units = 'C'
-            speed_units = 'm/s'
-        else:
-            temp_units = 'K'
-            speed_units = 'm/s'
+        if (workers is not None):
+            raise Usage("--workers needs --fleet")
 
         # Remaining arg is display host
         if (len(args) != 1):
@@ -125,70 +250,9 @@ def main(argv=None):
 
         sb_host = args[0]
 
-        # Local display panel functions
-        def current_conditions(sb):
-            # Roku current weather to display
-            fnt = 1 if (sb.dpytype == 1) else 2
-            xoff = 80 if (sb.dpytype == 1) else 90
-            sb.msg(text="{}\xb0{}".format(ctemp, temp_units), font=10 if (sb.dpytype == 1) else 3,
-                                                                x=34, y=0, clear=True)
-            sb.msg(text="{}, Humidity: {}%".format(cdescr, humidity), font=fnt, x=xoff, y=0)
-            sb.msg(text="Wind: {} at {}{}, Chill: {}\xb0{}".format(wvector, wspeed, speed_units, wchill, temp_units),
-                                                                font=fnt, x=xoff, y=8 if (sb.dpytype == 1) else 16)
-            icon_map.drawItAt(sb, ccode, 0, 0)
-            return True
-
-        def weather_preview(sb):
-            # Roku weather preview to display
-            #  rest of today
-            fnt = 1 if (sb.dpytype == 1) else 2
-            ymax = 15 if (sb.dpytype == 1) else 31
-            yoff = 8 if (sb.dpytype == 1) else 16
-            sb.msg(text=today_day, font=fnt, x=0, y=0, clear=True)  # day
-            sb.msg(text=today_date, x=0, y=yoff)  # date
-            sb.msg(text="{}\xb0{}".format(today_high, temp_units), x=82, y=0)  # max temp
-            sb.msg(text="{}\xb0{}".format(today_low, temp_units), x=82, y=yoff)  # min temp
-            # Clear second half and  draw border line
-            sb.cmd("sketch -c color 0")
-            sb.cmd("sketch -c rect 139 0 141 {}".format(ymax))
-            sb.cmd("sketch -c color 1")
-            sb.cmd("sketch -c line 140 0 140 {}".format(ymax))
-            # tomorrow
-            xoff = 227 if (sb.dpytype == 1) else 233
-            sb.msg(text=tomorrow_day, font=fnt, x=145, y=0)  # day
-            sb.msg(text=tomorrow_date, x=145, y=yoff)  # date
-            sb.msg(text="{}\xb0{}".format(tomorrow_high, temp_units), x=xoff, y=0)  # max temp
-            sb.msg(text="{}\xb0{}".format(tomorrow_low, temp_units), x=xoff, y=yoff)  # min temp
-
-            icon_map.drawItAt(sb, today_code, 47 if (sb.dpytype == 1) else 49, 0)
-            icon_map.drawItAt(sb, tomorrow_code, 188 if (sb.dpytype == 1) else 194, 0)
-            return True
-
-        def local_datetime(sb):
-            sb.msg(text=time.strftime('%H:%M   %A, %b %-d'),
-                   clear=True, font=10 if (sb.dpytype == 1) else 2, x=60, y=0)
-            return True if (sb.dpytype == 1) else False
-
-        def sun_rise_set(sb):
-            fnt = 10 if (sb.dpytype == 1) else 2
-            yoff = 0 if (sb.dpytype == 1) else 16
-            sb.msg(text="Sunrise: " + sunrise, font=fnt, x=8, y=yoff, clear=True if (sb.dpytype == 1) else False)
-            sb.msg(text="Sunset: " + sunset, font=fnt, x=148, y=yoff)
-            return True
-
-        def openweather_error(sb, etext, ecode):
-            sb.msg(text=etext.format(ecode), clear=True, font=1, x=25, y=5 if (sb.dpytype == 1) else 10)
-            print(etext.format(ecode))
-            time.sleep(60)      # Show error for 1min
-            sb.close()          # Revert to normal display for 30min
-            time.sleep(30 * 60)
-            if (not sb.reopen()):
-                exit(1)
-            return
-
         # Main execution starts here
         # Create telnet instance
-        screen = roku_tn.rokuSB(display_type)
+        screen = roku_tn.rokuSB(display_type, config.get('flow_control', True))
 
         if (not screen.open(sb_host)):
             return 1  # message already printed
@@ -202,147 +266,118 @@ def main(argv=None):
         # Init counters, flags, timers, etc.
         sb_open = True
         keepalive = True
-        get_weather_time = 0
-        # Dispatch for each screen display
-        display_panels = {0: current_conditions, 1: weather_preview, 2: local_datetime, 3: sun_rise_set}
+        first_paint = True
+        startup.mark('connected')
+
+        # Show we are alive before locating, fetching and loading icons
+        icon_map = wi_icons()
+        renderer = frameRenderer(screen, icon_map)
+        renderer.render(panels.message(display_type, connecting))
+        startup.mark('connecting')
+        # Reconnects with backoff and repaints after errors
+        session = sb_session.sbSession(screen, sb_host, renderer, connected=True, hold=panel_delay)
+        # Delay after errors other than lost connections
+        error_backoff = sb_session.backoff(1.0, 60.0)
 
         # Find lat/lon from location
-        if ow_lat is None and ow_lon is None:
+        if ow_lat is None or ow_lon is None:
             if location is None:
                 eprint("Either lat/lon or location must be specified")
                 return 2
 
-            # Determing if zip code or city,state given
-            if location.isdigit():
-                qloc = {'zip': location}
-            else:
-                qloc = {'q': location}
-            qloc['appid'] = ow_appid
-            resp = requests.get(ow_url_current, params=qloc)
-            if (resp.status_code != 200):
-                eprint("Location query returned error = {}", resp.status_code)
-                eprint("Try appending 2-character country code to location.")
+            coords = ow_weather.locate(location, client, geocache)
+            if (coords is None):
                 return 1
-
-            current_info = json.loads(resp.text)
-            ow_lat = current_info['coord']['lat']
-            ow_lon = current_info['coord']['lon']
-            print("{} is located at lat: {}, lon: {}".format(location, ow_lat, ow_lon))
-            # cleanup local strings
-            del qloc
-            del resp
-            del current_info
-
-        icon_map = wi_icons()
+            ow_lat, ow_lon = coords
+
+        timer = metrics.panelTimer(sb_host)
+        # Forecasts are fetched in the background
+        weather = ow_schedule.refresher((ow_lat, ow_lon, units), client, cache,
+                                        ow_schedule.policies[refresh](cache.ttl), budget, debug_output).start()
+        # Parse icons while the first forecast is fetched
+        icon_map.preload(display_type)
+        # Panel shown, moved by IR keys
+        cursor = ir_keys.panelCursor(len(panels.display_panels))
         # Loop until external termination request
-        qforecast = {'lat': ow_lat, 'lon': ow_lon, 'units': units, 'exclude': 'hourly,minutely', 'appid': ow_appid}
         while (keepalive):
-            # (Re-)open display
-            if (not sb_open):
-                if (screen.open(sb_host)):
-                    sb_open = True
-                else:
-                    # Snooze a while and try again
-                    time.sleep(30)
-                    continue
             try:
-                now = int(time.time())
-                if (get_weather_time < now):
-                    get_weather_time = now + 20 * 60
+                # (Re-)open display, showing the last frame again
+                if (not session.connected()):
+                    session.connect()
 
+                if (weather.fetches == 0):
                     # Announce our intentions
-                    screen.msg(text=getowdata, clear=True, font=1, x=25, y=5 if (display_type == 1) else 10)
-                    # Get the weather from OpenWeather
-                    resp = requests.get(ow_url, params=qforecast)
-                    if (resp.status_code != 200):
-                        openweather_error(screen, "Weather query returned error = {}", resp.status_code)
-                        del resp
-                        continue   # sleep & retury in loop
-
-                    # JSON returned in text
-                    wdata = json.loads(resp.text)
-                    del resp
-
-                    # Get our info from the JSON returned from OpenWeather
-                    ccond = wdata['current']
-                    cdescr = ccond['weather'][0]['description']
-                    ccode = ccond['weather'][0]['id']
-                    ctemp = int(round(ccond['temp']))
-
-                    wspeed = int(round(ccond['wind_speed']))
-                    wchill = int(round(ccond['feels_like']))
-                    wdir = ccond['wind_deg']
-
-                    humidity = ccond['humidity']
-                    vis = ccond['visibility']
-                    pressure = ccond['pressure']
-
-                    wvector = wind_vector[int((float(wdir) / 22.5) + 0.5) % 16]
-                    if (debug_output):
-                        print("Current conditions: ({})\nTemp: {}\xb0{} {}, ".format(ccode, ctemp, temp_units, cdescr),
-                              end='')
-                        print("Feels like:", wchill, "Wind:", wvector, "Direction: {}deg".format(wdir))
-                        print("Humidity {}%, visibility {:2.1f}mi, ".format(humidity, float(vis) / 1609.344), end='')
-                        print("Pressure {:4.1f}mb".format(float(pressure)))
-
-                    # We want am/pm in lowercase, no leading zero
-                    sunrise = time.strftime("%-I:%M %P", time.localtime(ccond['sunrise']))
-                    sunset = time.strftime("%-I:%M %P", time.localtime(ccond['sunset']))
-
-                    if (debug_output):
-                        print("Sunrise:", sunrise, "Sunset:", sunset)
-
-                    # Only need today and tomorrow (1st 2)
-                    today = wdata['daily'][0]
-                    tomorrow = wdata['daily'][1]
-
-                    today_high = int(round(today['temp']['max']))
-                    today_low = int(round(today['temp']['min']))
-                    today_time = time.localtime(today['dt'])
-                    today_date = time.strftime("%e.%b", today_time)
-                    today_day = time.strftime("%a", today_time)
-                    today_code = today['weather'][0]['id']
-
-                    if (debug_output):
-                        print("\nForecast:")
-                        print("{} {}".format(today_day, today_date), "({}) {}".format(today_code,
-                                                                            today['weather'][0]['description']), end='')
-                        print(", High: {}, Low: {}".format(today_high, today_low))
-
-                    tomorrow_high = int(round(tomorrow['temp']['max']))
-                    tomorrow_low = int(round(tomorrow['temp']['min']))
-                    tomorrow_time = time.localtime(tomorrow['dt'])
-                    tomorrow_date = time.strftime("%e.%b", tomorrow_time)
-                    tomorrow_day = time.strftime("%a", tomorrow_time)
-                    tomorrow_code = tomorrow['weather'][0]['id']
-
-                    if (debug_output):
-                        print("{} {}".format(tomorrow_day, tomorrow_date), "({}) {}".format(tomorrow_code,
-                                                                    tomorrow['weather'][0]['description']), end='')
-                        print(", High: {}, Low: {}".format(tomorrow_high, tomorrow_low))
-                    # Done with response data
-                    del wdata
+                    if (not cache.fresh(cache.key(ow_lat, ow_lon, units))):
+                        renderer.render(panels.message(display_type, getowdata))
+                    weather.wait()
+                # Latest forecast, kept while a refresh fails
+                wx = weather.wx
+                if (wx is None):
+                    # Show the error until a fetch succeeds (or an IR key)
+                    etext = "Weather query returned error = {}".format(weather.code)
+                    if (renderer.render(panels.message(display_type, etext))):
+                        print(etext)
+                    ir_cmd = screen.keyproc(panel_delay)
+                    action = ir_keys.action(ir_cmd, keys)
+                    if (action == 'exit'):
+                        screen.release(ir_cmd)
+                        keepalive = False
+                    elif (action == 'refresh'):
+                        weather.refresh()
+                    continue
 
                 # Update display (select screen)
-                for disp_num in range(4):
+                panel = panels.display_panels[cursor.index]
+                if (debug_output):
+                    print("Screen {}: {}".format(cursor.index, time.ctime()[11:19]))
+                if (not session.check()):
+                    continue
+                timer.start()
+                frame = sketchFrame(display_type)
+                show = panel(frame, wx, icon_map)
+                renderer.render(frame)
+                timer.stop(panel.__name__)
+                error_backoff.reset()
+                if (first_paint):
+                    first_paint = False
+                    startup.mark('first panel')
+                    metrics.log('startup', **dict(startup.marks))
                     if (debug_output):
-                        print("Screen {}: {}".format(disp_num, time.ctime()[11:19]))
-                    if (display_panels[disp_num](screen)):
-                        if (screen.keyproc(panel_delay) != 'TIMEOUT'):
-                            keepalive = False
+                        startup.report()
+                if (not show):
+                    cursor.skip()
+                    continue
 
+                # Hold the panel - an IR key ends the wait right away
+                ir_cmd = screen.keyproc(panel_delay)
+                action = ir_keys.action(ir_cmd, keys)
+                if (debug_output and ir_cmd != 'TIMEOUT'):
+                    print("IR key {}: {}".format(ir_cmd, action))
+                if (action == 'exit'):
+                    screen.release(ir_cmd)
+                    keepalive = False
+                elif (action == 'refresh'):
+                    fetches = weather.fetches
+                    weather.refresh()
+                    renderer.render(panels.message(display_type, getowdata))
+                    weather.wait(fetches, panel_delay)
+                cursor.move(action)
+
+            except (EOFError, OSError) as err:
+                # Connection lost - reopen right away
+                eprint("-->Lost connection to {} = {}".format(sb_host, err))
+                session.lost(type(err).__name__)
             except:
                 exc_type, exc_value, exc_tb = sys.exc_info()
-                if (sb_open):
-                    screen.close()
+                session.lost(exc_type.__name__)
                 if (exc_type == KeyboardInterrupt):
                     eprint("Exiting...")
                     return 0
                 eprint("-->Caught network or other error:")
+                import traceback
                 traceback.print_exception(exc_type, exc_value, exc_tb)
                 # Continue and try re-connect
-                sb_open = False
-                time.sleep(30)
+                time.sleep(error_backoff.next())
 
     except Usage as err:
         if (sb_open):
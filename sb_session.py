@@ -0,0 +1,426 @@
+# Soundbridge connection state machine
+#
+#   connected --(error, failed probe)--> disconnected
+#   disconnected --(open, after backoff)--> connected, last frame repainted
+#
+# Reconnects back off exponentially with jitter from a fraction of a
+# second, so a display is repainted within seconds of a device reboot.
+# Sockets use TCP keepalive, and a liveness probe before drawing after a
+# silence longer than a panel is held finds dead connections before a
+# panel is lost on them.
+
+import re
+import time
+import random
+import socket
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import metrics
+
+
+# Detect a vanished peer on an idle connection in about 25 s
+def keepalive(sock, idle=10, interval=5, count=3):
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Linux (TCP_KEEPIDLE) and macOS (TCP_KEEPALIVE) names
+        if (hasattr(socket, 'TCP_KEEPIDLE')):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        elif (hasattr(socket, 'TCP_KEEPALIVE')):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+        if (hasattr(socket, 'TCP_KEEPINTVL')):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        if (hasattr(socket, 'TCP_KEEPCNT')):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    except OSError as err:
+        print("Cannot set TCP keepalive = {}".format(err))
+
+
+# Telnet protocol bytes
+IAC = 255
+DONT = 254
+DO = 253
+WONT = 252
+WILL = 251
+SB = 250
+SE = 240
+
+
+# Remove telnet commands from data - returns (data, replies refusing any option requests)
+def telnet(data):
+    if (IAC not in data):
+        return (data, b'')
+    out = bytearray()
+    replies = bytearray()
+    i = 0
+    while (i < len(data)):
+        c = data[i]
+        if (c != IAC or i + 1 >= len(data)):
+            out.append(c)
+            i += 1
+            continue
+        op = data[i + 1]
+        if (op == IAC):
+            out.append(IAC)
+            i += 2
+        elif (op in (DO, DONT, WILL, WONT) and i + 2 < len(data)):
+            if (op == DO):
+                replies += bytes([IAC, WONT, data[i + 2]])
+            elif (op == WILL):
+                replies += bytes([IAC, DONT, data[i + 2]])
+            i += 3
+        elif (op == SB):
+            end = data.find(bytes([IAC, SE]), i)
+            i = len(data) if (end < 0) else end + 2
+        else:
+            i += 2
+    return (bytes(out), bytes(replies))
+
+
+# Double IAC bytes in data sent
+def escape(data):
+    return data.replace(bytes([IAC]), bytes([IAC, IAC]))
+
+
+# Soundbridge prompts, and IR keys as echoed by 'irman echo'
+prompts = (b'SoundBridge> ', b'sketch> ')
+ir_line = re.compile(rb'irman: ([^\r\n]*)\r?\n')
+
+
+# host may be given as host:port (default port 4444)
+def split_host(host):
+    if (host.count(':') == 1):
+        addr, port = host.split(':')
+        return (addr, int(port))
+    return (host, 4444)
+
+
+# Prompts and IR keys in received text - returns (prompts, keys, what is left of buf)
+def scan(buf):
+    n = sum(buf.count(p) for p in prompts)
+    keys = [m.group(1).decode('utf-8', 'replace').strip() for m in ir_line.finditer(buf)]
+    # Keep only a possible partial line (prompts end without newline)
+    buf = buf[buf.rfind(b'\n') + 1:]
+    for p in prompts:
+        if (p in buf):
+            buf = buf[buf.rfind(p) + len(p):]
+    return (n, keys, buf)
+
+
+# Font List for costumization:
+#  1 - Fixed8
+#  2 - Fixed16 (UFT8 font with japanese charachters)
+#  3 - ZurichBold32
+#  10 - ZurichBold16
+#  11 - ZurichLite16
+#  12 - Fixed16
+#  14 - SansSerif16
+
+
+# Soundbridge commands of rokuSB and aioRokuSB - they provide write(data),
+# which commands go to as they are made or, while batching, on flush()
+class sbCommands:
+    def __init__(self, dtype):
+        self.dpytype = dtype
+        self.host = None
+        # Pending commands while batching (None := write through)
+        self.pending = None
+        # Commands and bytes sent - counted per host once open
+        self.sent_cmds = metrics.counterValue()
+        self.sent_bytes = metrics.counterValue()
+
+    # Count commands and bytes sent under host in metrics
+    def count_as(self, host):
+        self.sent_cmds = metrics.sb_commands.labels(host=host)
+        self.sent_bytes = metrics.sb_bytes.labels(host=host)
+
+    # Optional args to msg (soundbridge display)
+    #
+    # text          - default none - can be omitted to just set font and encoding
+    # x,y  location - default 0,0
+    # font          -
+    # clear         - 0/1 force the display to clear first (default 0)
+    # encoding      - set roku text encoding
+    #
+    def msg(self, **kwargs):
+        x = kwargs.get('x', 0)
+        y = kwargs.get('y', 0)
+        text = kwargs.get('text')
+        clear = kwargs.get('clear', False)
+        font = kwargs.get('font')
+        encoding = kwargs.get('encoding')
+
+        if (encoding is not None):
+            self.cmd("sketch -c encoding " + str(encoding))
+
+        if (font is not None):
+            self.cmd("sketch -c font " + str(font))
+
+        if (text is None):
+            return
+
+        if (clear):
+            self.clear()
+
+        self.cmd('sketch -c text {} {} "{}"'.format(x, y, text))
+        return
+
+    def cmd(self, text):
+        data = text.encode('utf-8') + b'\n'
+        self.sent_cmds.inc()
+        self.sent_bytes.inc(len(data))
+        if (self.pending is not None):
+            self.pending.append(data)
+            return
+        self.write(data)
+
+    # Send any batched commands in a single write
+    def flush(self):
+        if not self.pending:
+            return
+        data = b''.join(self.pending)
+        self.pending.clear()
+        self.write(data)
+
+    # Collect commands (e.g. a whole panel) and send them together on exit
+    #
+    #   with sb.batch():
+    #       sb.msg(text="...", clear=True)
+    #       icon_map.drawItAt(sb, code, 0, 0)
+    #
+    @contextmanager
+    def batch(self):
+        if (self.pending is not None):
+            # Nested batch - outer one flushes
+            yield self
+            return
+        self.pending = []
+        try:
+            yield self
+            self.flush()
+        finally:
+            self.pending = None
+
+    def clear(self):
+        self.cmd("sketch -c clear")
+
+    def intercept(self):
+        self.cmd("irman intercept")
+
+    # Stop intercepting - an IR code is passed on to SB and sketch exits
+    def release(self, ir_cmd):
+        with self.batch():
+            self.cmd("irman off")
+            if (ir_cmd is not None):
+                self.cmd("sketch -c exit")
+                self.cmd("irman dispatch {}".format(ir_cmd))
+
+
+# Commands in flight on one connection - tuning carries over from 'last'
+#
+#  Only 'window' commands are sent ahead of their prompts. The window is
+#  tuned once per window of prompts from how many commands are queued in
+#  the device, window * (1 - base RTT / smoothed RTT), as TCP Vegas does:
+#  larger below alpha, smaller above beta. The base RTT is the least seen
+#  in the last base_age seconds, so it is measured afresh (as Vegas
+#  re-probes it) rather than pinned by one early sample.
+class sbFlow:
+    window_min = 2
+    window_max = 64
+    # Commands to keep queued in the device: grow below alpha, shrink above beta
+    alpha = 2
+    beta = 6
+    # Seconds without a prompt before the window is halved
+    ack_timeout = 2.0
+    # Seconds a least RTT is kept
+    base_age = 30.0
+
+    def __init__(self, host, last=None):
+        self.cond = threading.Condition()
+        # Send times of commands awaiting their prompt
+        self.sent = deque()
+        # Prompts still due for commands given up on by expire()
+        self.stale = 0
+        self.closed = False
+        self.window = 8 if (last is None) else last.window
+        # Round trip times: least of this and the last period, smoothed
+        self.min_rtt = None if (last is None) else last.min_rtt
+        self.period_min = None
+        self.period_start = time.monotonic()
+        self.srtt = None
+        # Prompts since the window was last tuned
+        self.tuned = 0
+        # Commands/second answered while busy
+        self.rate = 0.0 if (last is None) else last.rate
+        self.busy_since = None
+        self.busy_acks = 0
+        self.rate_gauge = metrics.sb_rate.labels(host=host)
+        self.window_gauge = metrics.sb_window.labels(host=host)
+        self.window_gauge.set(self.window)
+
+    # Commands that may be sent now, without waiting
+    def free(self):
+        with self.cond:
+            if (self.closed):
+                return self.window_max
+            return max(self.window - len(self.sent), 0)
+
+    # Commands that may be sent now - waits for prompts while the window is full
+    def room(self):
+        with self.cond:
+            deadline = time.monotonic() + self.ack_timeout
+            while (not self.closed and len(self.sent) >= self.window):
+                now = time.monotonic()
+                if (now >= deadline):
+                    self.expire()
+                    break
+                self.cond.wait(deadline - now)
+            return self.free()
+
+    # No prompt for ack_timeout - device stalled or prompts lost: halve the
+    # window, and do not take prompts arriving late as newer commands'
+    def expire(self):
+        with self.cond:
+            self.window = max(self.window_min, self.window // 2)
+            self.window_gauge.set(self.window)
+            metrics.log('flow', window=self.window, reason='timeout')
+            # (prompts still owed from an earlier timeout were lost)
+            self.stale = len(self.sent)
+            self.sent.clear()
+            self.srtt = None
+            self.busy_since = None
+            self.cond.notify_all()
+
+    def sending(self, n, now):
+        with self.cond:
+            if (not self.sent):
+                self.busy_since = now
+                self.busy_acks = 0
+            self.sent.extend([now] * n)
+
+    def sample(self, rtt, now):
+        self.period_min = rtt if (self.period_min is None) else min(self.period_min, rtt)
+        self.min_rtt = rtt if (self.min_rtt is None) else min(self.min_rtt, rtt)
+        if (now - self.period_start >= self.base_age):
+            # Older minimum ages out
+            self.min_rtt = self.period_min
+            self.period_min = None
+            self.period_start = now
+        self.srtt = rtt if (self.srtt is None) else 0.875 * self.srtt + 0.125 * rtt
+
+    # n prompts received (reader)
+    def acked(self, n, now):
+        with self.cond:
+            late = min(n, self.stale)
+            self.stale -= late
+            n = min(n - late, len(self.sent))
+            for i in range(n):
+                self.sample(now - self.sent.popleft(), now)
+            self.busy_acks += n
+            if (not self.sent and self.busy_since is not None):
+                # End of a burst - its throughput
+                elapsed = now - self.busy_since
+                if (self.busy_acks >= self.window_min and elapsed > 0):
+                    sample = self.busy_acks / elapsed
+                    self.rate = sample if (self.rate == 0) else 0.7 * self.rate + 0.3 * sample
+                    self.rate_gauge.set(round(self.rate, 1))
+                self.busy_since = None
+
+            # Once per window: commands queued in the device, from how much
+            # longer prompts take than the base RTT
+            self.tuned += n
+            if (self.tuned >= self.window and self.srtt):
+                self.tuned = 0
+                queued = self.window * (1 - self.min_rtt / self.srtt)
+                if (queued < self.alpha):
+                    self.window = min(self.window_max, self.window + 1)
+                elif (queued > self.beta):
+                    self.window = max(self.window_min, self.window - 1)
+                self.window_gauge.set(self.window)
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+# Exponential delays with jitter: (1/2 .. 1) x first x 2^n, capped
+class backoff:
+    def __init__(self, first=0.25, cap=30.0):
+        self.first = first
+        self.cap = cap
+        self.attempt = 0
+
+    def next(self):
+        delay = min(self.cap, self.first * (2 ** self.attempt)) * random.uniform(0.5, 1.0)
+        self.attempt += 1
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+
+class sbSession:
+    # Probe the device before drawing when nothing has been drawn or heard
+    # for this many seconds more than a panel is held
+    probe_idle = 5.0
+
+    # hold := seconds a panel is shown (panel_delay)
+    def __init__(self, sb, host, renderer, connected=False, hold=0):
+        self.sb = sb
+        self.hold = hold
+        self.host = host
+        self.renderer = renderer
+        self.state = 'connected' if connected else 'disconnected'
+        self.backoff = backoff()
+        # Connections so far - later ones count as reconnects
+        self.opened = 1 if connected else 0
+        self.checked = time.monotonic()
+        self.lost_at = None
+
+    def connected(self):
+        return self.state == 'connected'
+
+    # Open the display, retrying until it answers, and redraw what it showed
+    def connect(self):
+        while (not self.sb.open(self.host)):
+            time.sleep(self.backoff.next())
+        self.backoff.reset()
+        self.state = 'connected'
+        self.checked = time.monotonic()
+        if (self.opened):
+            metrics.sb_reconnects.inc(host=self.host)
+            metrics.log('reconnect', host=self.host,
+                        seconds=None if (self.lost_at is None) else round(time.monotonic() - self.lost_at, 3))
+        self.opened += 1
+        self.renderer.repaint()
+
+    def lost(self, reason=None):
+        if (self.state == 'disconnected'):
+            return
+        self.state = 'disconnected'
+        self.lost_at = time.monotonic()
+        metrics.log('disconnect', host=self.host, reason=reason)
+        try:
+            self.sb.close()
+        except (OSError, EOFError):
+            pass
+
+    # Before drawing: probe a connection that has been idle - False if it is gone
+    def check(self):
+        if (not self.connected()):
+            return False
+        now = time.monotonic()
+        if (now - max(self.checked, self.sb.heard()) >= self.hold + self.probe_idle):
+            if (not self.sb.probe()):
+                self.lost('probe')
+                return False
+        self.checked = now
+        return True
+
+    def close(self):
+        if (self.connected()):
+            self.state = 'disconnected'
+            self.sb.close()
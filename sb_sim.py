@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+"""sb_sim [opts] [port]
+
+Fake Roku Soundbridge for testing without hardware. Speaks the shell
+prompts and the sketch/irman commands rokuSB uses, and draws into an
+in-memory framebuffer (text is drawn as character cells, not real fonts).
+Every command is answered by a prompt. A panel ends when no command has
+arrived for 'idle' seconds.
+
+-t, --type       Display type (1 := 280x16, 2 := 280x32), Default: 2
+-l, --latency    Seconds to process each command
+-b, --bandwidth  Bytes/second accepted from the client
+-d, --drop       Drop the connection after this many commands
+-i, --input      Input buffer bytes - data arriving while it is full is lost
+-k, --key        IR key sent after every N panels (N:KEY, e.g. 4:CK_MENU)
+-s, --show       Print the framebuffer after every panel
+"""
+
+import sys
+import time
+import getopt
+import shlex
+import socket
+import threading
+import socketserver
+
+
+# Font cell (width, height) for drawing text
+font_cell = {1: (5, 8), 2: (7, 16), 3: (18, 32), 10: (9, 16), 11: (9, 16), 12: (7, 16), 14: (9, 16)}
+
+
+class sbSim:
+    # Input pause that ends a panel
+    idle = 0.05
+
+    def __init__(self, dpytype=2, host='127.0.0.1', port=0, latency=0.0, bandwidth=None,
+                 drop_after=None, key_every=None, key='CK_EXIT', show=False, input_buffer=None):
+        self.dpytype = dpytype
+        self.width, self.height = 280, 16 * dpytype
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop_after = drop_after
+        self.input_buffer = input_buffer
+        self.key_every = key_every
+        self.key = key
+        self.show = show
+        self.lock = threading.Lock()
+        self.conn = None
+        self.reset_stats()
+        self.clear()
+
+        sim = self
+
+        class handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                sim.serve(self.request)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return "{}:{}".format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if (self.conn is not None):
+            self.drop()
+
+    def reset_stats(self):
+        self.stats = {'commands': 0, 'bytes': 0, 'connects': 0, 'drops': 0, 'overruns': 0}
+        # (paint seconds, commands, bytes) for each panel
+        self.panels = []
+        # Seconds from a drop to the first panel after reconnecting
+        self.reconnects = []
+        self.dropped_at = None
+        # Time of the first sketch command
+        self.first_paint = None
+        self.panel_start = None
+        self.panel_last = None
+        self.panel_cmds = 0
+        self.panel_bytes = 0
+
+    # Framebuffer
+    def clear(self):
+        self.fb = [bytearray(self.width) for y in range(self.height)]
+
+    def plot(self, x, y):
+        if (0 <= x < self.width and 0 <= y < self.height):
+            self.fb[y][x] = self.color
+
+    def fill(self, x, y, w, h):
+        for yy in range(max(y, 0), min(y + h, self.height)):
+            for xx in range(max(x, 0), min(x + w, self.width)):
+                self.fb[yy][xx] = self.color
+
+    def text(self, x, y, text):
+        w, h = font_cell.get(self.font, (7, 16))
+        # Outline each character cell, leaving a gap between characters
+        for i, ch in enumerate(text):
+            if (ch == ' '):
+                continue
+            cx = x + i * w
+            self.fill(cx, y + 1, w - 1, 1)
+            self.fill(cx, y + h - 2, w - 1, 1)
+            self.fill(cx, y + 1, 1, h - 2)
+            self.fill(cx + w - 2, y + 1, 1, h - 2)
+
+    def dump(self):
+        return '\n'.join(''.join('#' if p else '.' for p in row) for row in self.fb)
+
+    # IR key to the connected client (if intercepting)
+    def inject(self, key):
+        with self.lock:
+            if (self.conn is not None and self.intercepting):
+                self.conn.sendall('irman: {}\r\n'.format(key).encode('utf-8'))
+                return True
+        return False
+
+    def drop(self):
+        with self.lock:
+            if (self.conn is None):
+                return
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.conn = None
+            self.stats['drops'] += 1
+            self.dropped_at = time.monotonic()
+
+    def serve(self, conn):
+        with self.lock:
+            if (self.conn is not None):
+                # One client at a time, like the real thing
+                conn.sendall(b'Too many connections\r\n')
+                return
+            self.conn = conn
+            self.stats['connects'] += 1
+        self.color = 1
+        self.font = 1
+        self.intercepting = False
+        self.panel_start = None
+        # Prompts go out as each command is done
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.sendall(b'SoundBridge> ')
+
+        buf = b''
+        conn.settimeout(self.idle)
+        try:
+            while (self.conn is conn):
+                try:
+                    data = conn.recv(4096)
+                except socket.timeout:
+                    self.end_panel(conn)
+                    continue
+                if (not data):
+                    break
+                if (self.bandwidth):
+                    time.sleep(len(data) / self.bandwidth)
+                buf = self.overrun(buf + data)
+                while (b'\n' in buf):
+                    line, buf = buf.split(b'\n', 1)
+                    if (not self.command(conn, line)):
+                        return
+                    conn.sendall(b'sketch> ' if line.startswith(b'sketch') else b'SoundBridge> ')
+                    buf = self.take(conn, buf)
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                if (self.conn is conn):
+                    self.conn = None
+            conn.close()
+
+    # Input that does not fit the input buffer is lost
+    def overrun(self, buf):
+        if (self.input_buffer and len(buf) > self.input_buffer):
+            self.stats['overruns'] += 1
+            return buf[:self.input_buffer]
+        return buf
+
+    # Input that arrived while the last command ran
+    def take(self, conn, buf):
+        if (not self.input_buffer):
+            return buf
+        conn.setblocking(False)
+        try:
+            while (len(buf) <= self.input_buffer):
+                data = conn.recv(4096)
+                if (not data):
+                    break
+                buf += data
+        except BlockingIOError:
+            pass
+        finally:
+            conn.settimeout(self.idle)
+        return self.overrun(buf)
+
+    # Execute one command line - False ends the session
+    def command(self, conn, line):
+        if (self.latency):
+            time.sleep(self.latency)
+        self.stats['commands'] += 1
+        self.stats['bytes'] += len(line) + 1
+        if (self.drop_after and self.stats['commands'] % self.drop_after == 0):
+            self.drop()
+            return False
+
+        try:
+            args = shlex.split(line.decode('utf-8', 'replace'))
+        except ValueError:
+            args = line.decode('utf-8', 'replace').split()
+        if (not args):
+            return True
+
+        if (args[0] == 'exit'):
+            return False
+
+        if (args[0] == 'irman'):
+            if (args[1:2] == ['intercept']):
+                self.intercepting = True
+            elif (args[1:2] == ['off']):
+                self.intercepting = False
+            return True
+
+        if (args[0] != 'sketch' or len(args) < 3 or args[1] != '-c'):
+            return True
+
+        if (self.panel_start is None):
+            self.panel_start = time.monotonic()
+            if (self.first_paint is None):
+                self.first_paint = self.panel_start
+            self.panel_cmds = self.panel_bytes = 0
+            if (self.dropped_at is not None):
+                self.reconnects.append(self.panel_start - self.dropped_at)
+                self.dropped_at = None
+        self.panel_last = time.monotonic()
+        self.panel_cmds += 1
+        self.panel_bytes += len(line) + 1
+
+        op, a = args[2], [int(v) if v.lstrip('-').isdigit() else v for v in args[3:]]
+        with self.lock:
+            if (op == 'clear'):
+                self.clear()
+            elif (op == 'color'):
+                self.color = a[0]
+            elif (op == 'font'):
+                self.font = a[0]
+            elif (op == 'text'):
+                self.text(a[0], a[1], str(a[2]) if len(a) > 2 else '')
+            elif (op == 'point'):
+                self.plot(a[0], a[1])
+            elif (op == 'line'):
+                x1, y1, x2, y2 = a[:4]
+                # Both end points are drawn
+                self.fill(min(x1, x2), min(y1, y2), abs(x2 - x1) + 1, abs(y2 - y1) + 1)
+            elif (op == 'rect'):
+                self.fill(*a[:4])
+        return True
+
+    # Input went quiet - panel drawn (panels counted over all connections, for key_every)
+    def end_panel(self, conn):
+        if (self.panel_start is None):
+            return
+        self.panels.append((self.panel_last - self.panel_start, self.panel_cmds, self.panel_bytes))
+        self.panel_start = None
+        if (self.show):
+            print(self.dump() + '\n')
+        if (self.key_every and len(self.panels) % self.key_every == 0 and self.intercepting):
+            conn.sendall('irman: {}\r\n'.format(self.key).encode('utf-8'))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "ht:l:b:d:i:k:s", ["help", "type=", "latency=", "bandwidth=", "input=",
+                                                             "drop=", "key=", "show"])
+    except getopt.error as msg:
+        print(msg)
+        print("for help use --help")
+        return 2
+
+    kw = {}
+    for o, v in opts:
+        if (o in ["-h", "--help"]):
+            print(__doc__)
+            return 0
+        if (o in ["-t", "--type"]):
+            kw['dpytype'] = int(v)
+        if (o in ["-l", "--latency"]):
+            kw['latency'] = float(v)
+        if (o in ["-b", "--bandwidth"]):
+            kw['bandwidth'] = float(v)
+        if (o in ["-d", "--drop"]):
+            kw['drop_after'] = int(v)
+        if (o in ["-i", "--input"]):
+            kw['input_buffer'] = int(v)
+        if (o in ["-k", "--key"]):
+            n, key = v.split(':', 1)
+            kw['key_every'] = int(n)
+            kw['key'] = key
+        if (o in ["-s", "--show"]):
+            kw['show'] = True
+
+    sim = sbSim(port=int(args[0]) if args else 4444, **kw).start()
+    print("Soundbridge simulator on {}".format(sim.address))
+    try:
+        sim.thread.join()
+    except KeyboardInterrupt:
+        sim.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+# Retained-mode sketch frames for Roku Soundbridge
+#
+# A panel draws into a sketchFrame (a display list of primitives) instead
+# of straight to the device. frameRenderer remembers the last frame sent
+# to its device and only sends the commands needed to reach the new one.
+# Plans keep icons as primitives - their commands are only built when the
+# chosen plan is sent.
+
+from difflib import SequenceMatcher
+
+
+# Display size by type (1 := 280x16, 2 := 280x32)
+dpy_size = {1: (280, 16), 2: (280, 32)}
+
+# Conservative (max advance, height) cell per font, used for text bounds
+font_cell = {1: (6, 8), 2: (8, 16), 3: (24, 32), 10: (12, 16),
+             11: (12, 16), 12: (8, 16), 14: (12, 16)}
+
+
+class sketchFrame:
+    def __init__(self, dpytype):
+        self.dpytype = dpytype
+        # Primitives are tuples:
+        #   ('text', x, y, font, text)
+        #   ('rect', x, y, w, h, color)
+        #   ('line', x1, y1, x2, y2)
+        #   ('point', x, y)
+        #   ('icon', altid, x, y, height)  height None := display height
+        self.prims = []
+        # False := frame is drawn on top of whatever is on the display
+        self.cleared = False
+        self.font = None
+
+    # Same args as rokuSB.msg (encoding is a session setting, not drawn)
+    def msg(self, **kwargs):
+        text = kwargs.get('text')
+        font = kwargs.get('font')
+
+        if (font is not None):
+            self.font = font
+
+        if (text is None):
+            return self
+
+        if (kwargs.get('clear', False)):
+            self.clear()
+
+        self.prims.append(('text', kwargs.get('x', 0), kwargs.get('y', 0), self.font, text))
+        return self
+
+    def clear(self):
+        self.prims = []
+        self.cleared = True
+        return self
+
+    def rect(self, x, y, w, h, color=1):
+        self.prims.append(('rect', x, y, w, h, color))
+        return self
+
+    def line(self, x1, y1, x2, y2):
+        self.prims.append(('line', x1, y1, x2, y2))
+        return self
+
+    def point(self, x, y):
+        self.prims.append(('point', x, y))
+        return self
+
+    def icon(self, icons, code, x, y, height=None):
+        self.prims.append(('icon', icons.altid(code), x, y, height))
+        return self
+
+
+# Collects commands (and icon primitives) for one render plan
+class cmdList(list):
+    def __init__(self, dpytype, icons):
+        super().__init__()
+        self.dpytype = dpytype
+        self.icons = icons
+
+    def cmd(self, text):
+        self.append(text)
+
+    def icon(self, p):
+        self.append(p)
+
+    # Bytes to send - icons as drawn at 0,0
+    def size(self):
+        return sum(self.icons.size(c[1], self.dpytype, c[4]) if (isinstance(c, tuple)) else
+                   len(c.encode('utf-8')) + 1 for c in self)
+
+
+class frameRenderer:
+    def __init__(self, sb, icons):
+        self.sb = sb
+        self.icons = icons
+        self.invalidate()
+
+    # Display contents unknown (new connection, drawn outside renderer)
+    def invalidate(self):
+        self.last = None
+        self.font = None
+        self.color = None
+
+    def bounds(self, p):
+        kind = p[0]
+        if (kind == 'text'):
+            w, h = font_cell.get(p[3], (24, 32))
+            return (p[1], p[2], w * len(p[4]), h)
+        if (kind == 'rect'):
+            return (p[1], p[2], p[3] + 1, p[4] + 1)
+        if (kind == 'line'):
+            return (min(p[1], p[3]), min(p[2], p[4]), abs(p[3] - p[1]) + 1, abs(p[4] - p[2]) + 1)
+        if (kind == 'point'):
+            return (p[1], p[2], 1, 1)
+        sizex, sizey, segs = self.icons.load(p[1], self.sb.dpytype, p[4])
+        return (p[2], p[3], sizex, sizey)
+
+    @staticmethod
+    def overlaps(a, b):
+        return (a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and
+                a[1] < b[1] + b[3] and b[1] < a[1] + a[3])
+
+    # Emit one primitive, tracking device font/color state in 'st'
+    def emit(self, out, st, p):
+        kind = p[0]
+        color = p[5] if (kind == 'rect') else 1
+        if (kind != 'icon' and st['color'] != color):
+            out.cmd("sketch -c color {}".format(color))
+            st['color'] = color
+
+        if (kind == 'text'):
+            if (p[3] is not None and st['font'] != p[3]):
+                out.cmd("sketch -c font {}".format(p[3]))
+                st['font'] = p[3]
+            out.cmd('sketch -c text {} {} "{}"'.format(p[1], p[2], p[4]))
+        elif (kind == 'rect'):
+            out.cmd("sketch -c rect {} {} {} {}".format(*p[1:5]))
+        elif (kind == 'line'):
+            out.cmd("sketch -c line {} {} {} {}".format(*p[1:5]))
+        elif (kind == 'point'):
+            out.cmd("sketch -c point {} {}".format(*p[1:3]))
+        else:
+            out.icon(p)
+            st['color'] = 1
+
+    # Plan: clear screen and draw everything
+    def full(self, prims):
+        out = cmdList(self.sb.dpytype, self.icons)
+        st = {'font': self.font, 'color': self.color}
+        out.cmd("sketch -c clear")
+        for p in prims:
+            self.emit(out, st, p)
+        return out, st
+
+    # Plan: erase removed primitives, redraw what they (or new ones) touched
+    def delta(self, prims):
+        out = cmdList(self.sb.dpytype, self.icons)
+        st = {'font': self.font, 'color': self.color}
+
+        kept = set()
+        removed = set(range(len(self.last)))
+        matcher = SequenceMatcher(None, self.last, prims, autojunk=False)
+        for a, b, n in matcher.get_matching_blocks():
+            kept.update(range(b, b + n))
+            removed.difference_update(range(a, a + n))
+
+        dirty = []
+        for i in sorted(removed):
+            box = self.bounds(self.last[i])
+            self.emit(out, st, ('rect',) + box + (0,))
+            dirty.append(box)
+
+        for i, p in enumerate(prims):
+            box = self.bounds(p)
+            # Text in an unknown font depends on device state - always redraw
+            if (i in kept and not (p[0] == 'text' and p[3] is None) and
+                    not any(self.overlaps(box, d) for d in dirty)):
+                continue
+            self.emit(out, st, p)
+            dirty.append(box)
+        return out, st
+
+    # Text without a font uses the one left by the previous text
+    def resolve(self, prims):
+        font = self.font
+        for i, p in enumerate(prims):
+            if (p[0] != 'text'):
+                continue
+            if (p[3] is None):
+                prims[i] = p[:3] + (font,) + p[4:]
+            else:
+                font = p[3]
+        return prims
+
+    def render(self, frame):
+        prims = self.resolve(list(frame.prims))
+        if (not frame.cleared and self.last is not None):
+            prims = self.last + prims
+
+        if (self.last is None):
+            out, st = self.full(prims)
+        elif (prims == self.last):
+            return 0
+        else:
+            out, st = self.delta(prims)
+            # Clear and redraw when that is cheaper (small frames, big changes)
+            full, fst = self.full(prims)
+            if (full.size() <= out.size()):
+                out, st = full, fst
+        return self.send(out, st, prims)
+
+    # Redraw the last frame in full (new connection to the display)
+    def repaint(self):
+        prims = self.last
+        self.invalidate()
+        if (prims is None):
+            return 0
+        out, st = self.full(prims)
+        return self.send(out, st, prims)
+
+    # Send a plan, drawing its icons - number of commands sent
+    def send(self, out, st, prims):
+        count = 0
+        with self.sb.batch():
+            for c in out:
+                if (isinstance(c, tuple)):
+                    count += self.icons.drawIconAt(self.sb, c[1], c[2], c[3], c[4])
+                else:
+                    self.sb.cmd(c)
+                    count += 1
+
+        self.last = prims
+        self.font = st['font']
+        self.color = st['color']
+        return count
@@ -0,0 +1,48 @@
+# Startup timing
+#
+# rokuweather imports this module first, so t0 is close to process start.
+# mark() records milestones (display connected, first paint). Heavy modules
+# (requests, asyncio, http.server) are imported on first use, inside
+# timed(), so report() shows what each deferred import cost and when it was
+# paid; run under 'python3 -X importtime' for every other import.
+
+import sys
+import time
+from contextlib import contextmanager
+
+
+t0 = time.perf_counter()
+# (milestone, seconds since t0)
+marks = []
+# (module, seconds since t0 when imported, seconds taken) of the deferred imports
+imports = []
+
+
+def mark(event):
+    marks.append((event, time.perf_counter() - t0))
+
+
+# Time the import of module done inside - nothing to time once it is loaded
+#
+#   with startup.timed('requests'):
+#       import requests
+#
+@contextmanager
+def timed(module):
+    if (module in sys.modules):
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        imports.append((module, start - t0, time.perf_counter() - start))
+
+
+# Milestones and deferred imports, in the order they happened
+def report():
+    lines = [(t, "{:<20} {:8.1f}ms".format(event, t * 1000)) for event, t in marks]
+    lines += [(t, "{:<20} {:8.1f}ms, took {:.1f}ms".format('import ' + module, t * 1000, took * 1000))
+              for module, t, took in imports]
+    for t, line in sorted(lines):
+        print("Startup: " + line)
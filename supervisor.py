@@ -0,0 +1,206 @@
+# Sharded fleet - one worker process per shard of the device inventory
+#
+# The inventory is split into shards (by default one per core), each
+# driven as a fleet (fleet.py) by its own worker process. Displays sharing
+# a forecast are kept in the same shard. Workers get their forecasts from
+# a gateway (ow_gateway.py) the supervisor runs on a local port, so
+# OpenWeather is queried once per location whatever the number of
+# workers; locations are resolved once, before the workers start.
+#
+# A worker that dies is restarted with the same displays, after a backoff
+# growing while it keeps failing. A worker that exits normally (all its
+# displays handed back by IR keys) is not restarted. Workers report their
+# load every few seconds, kept as per-shard metrics and printed with -v.
+
+import os
+import sys
+import time
+import queue
+import signal
+import threading
+import multiprocessing
+
+import metrics
+import ow_cache
+import ow_client
+import ow_schedule
+import sb_session
+import fleet
+from ow_weather import eprint
+
+
+# Seconds between load reports
+report_interval = 5
+# Seconds a worker must run before its restart backoff starts over
+stable_after = 60
+# Worker exit status for a configuration error - not restarted
+config_error = 2
+
+
+# Split devices (with lat/lon) into at most count shards, keeping displays
+# with the same forecast together: groups of them, largest first, go to the
+# shard with fewest displays so far
+def shard(devices, count):
+    groups = {}
+    for dev in devices:
+        groups.setdefault((float(dev['lat']), float(dev['lon']), dev['units']), []).append(dev)
+    shards = [[] for i in range(max(count, 1))]
+    for where in sorted(groups, key=lambda w: (-len(groups[w]), w)):
+        min(shards, key=len).extend(groups[where])
+    return [s for s in shards if s]
+
+
+# Shards (see shard()) and each one's share of the daily API budget - no
+# more shards than queries a day, so the shares never add up to more
+def split_budget(devices, count, api_budget):
+    shards = shard(devices, min(count, api_budget))
+    return (shards, max(1, api_budget // max(len(shards), 1)))
+
+
+# Worker process - drive one shard, sending load reports to the supervisor
+#  options['api_budget'] is this worker's share of the daily budget
+def work(index, devices, options, reports):
+    if (options.get('metrics_log')):
+        metrics.open_log(options['metrics_log'])
+    client = ow_client.owClient(options['appid'], options['url'])
+    # The gateway keeps the forecasts on disk
+    cache = ow_cache.weatherCache(options['ttl'])
+    try:
+        displays = fleet.fleet(devices, client, cache, None, options['panel_delay'], options['debug_output'],
+                               ow_schedule.policies[options['refresh']],
+                               ow_schedule.callBudget(options['api_budget']), options['keys'])
+    except ValueError as err:
+        eprint(err)
+        sys.exit(config_error)
+    threading.Thread(target=report, args=(index, len(devices), reports), daemon=True).start()
+    sys.exit(displays.run())
+
+
+def report(index, ndevices, reports):
+    while (True):
+        t = os.times()
+        reports.put((index, os.getpid(), {'devices': ndevices, 'cpu': t.user + t.system,
+                                          'panels': metrics.panel_seconds.total(),
+                                          'commands': metrics.sb_commands.total(), 'rss': metrics.rss()}))
+        time.sleep(report_interval)
+
+
+class supervisor:
+    # options := work() options less the gateway url
+    def __init__(self, shards, options, gateway, debug_output=False):
+        self.shards = shards
+        self.options = dict(options, url=gateway.url)
+        self.gateway = gateway
+        self.debug_output = debug_output
+        # Spawned, not forked - the supervisor runs threads (gateway, metrics)
+        self.mp = multiprocessing.get_context('spawn')
+        self.reports = self.mp.Queue()
+        self.workers = [None] * len(shards)
+        self.started = [0.0] * len(shards)
+        self.restart_at = [0.0] * len(shards)
+        self.backoff = [sb_session.backoff(1.0, 60.0) for s in shards]
+        # Shards whose displays have all been released
+        self.done = set()
+        # shard -> (time, pid, load) of the last report
+        self.last = {}
+
+    def start(self, index):
+        p = self.mp.Process(target=work, args=(index, self.shards[index], self.options, self.reports),
+                            name="shard-{}".format(index), daemon=True)
+        p.start()
+        self.workers[index] = p
+        self.started[index] = time.monotonic()
+        metrics.shard_devices.set(len(self.shards[index]), shard=index)
+        if (self.debug_output):
+            print("Shard {}: {} displays, pid {}".format(index, len(self.shards[index]), p.pid))
+
+    # Restart workers that died, when their backoff is over
+    def check(self):
+        now = time.monotonic()
+        for index, p in enumerate(self.workers):
+            if (index in self.done):
+                continue
+            if (p is None):
+                if (now >= self.restart_at[index]):
+                    self.start(index)
+                continue
+            if (p.is_alive()):
+                if (now - self.started[index] > stable_after):
+                    self.backoff[index].reset()
+                continue
+            p.join()
+            self.workers[index] = None
+            if (p.exitcode == 0):
+                print("Shard {}: all displays released".format(index))
+                self.done.add(index)
+                metrics.shard_devices.set(0, shard=index)
+                continue
+            if (p.exitcode == config_error):
+                eprint("-->Shard {} worker (pid {}) cannot run its displays - not restarted".format(index, p.pid))
+                self.done.add(index)
+                metrics.shard_devices.set(0, shard=index)
+                metrics.log('restart', shard=index, pid=p.pid, exitcode=p.exitcode, fatal=True)
+                continue
+            delay = self.backoff[index].next()
+            eprint("-->Shard {} worker (pid {}) exited with {}, restarting in {:.1f}s".format(
+                index, p.pid, p.exitcode, delay))
+            metrics.shard_restarts.inc(shard=index)
+            metrics.log('restart', shard=index, pid=p.pid, exitcode=p.exitcode)
+            self.restart_at[index] = now + delay
+
+    # Load reports received within timeout seconds
+    def collect(self, timeout):
+        try:
+            item = self.reports.get(timeout=timeout)
+            while (True):
+                self.record(*item)
+                item = self.reports.get_nowait()
+        except queue.Empty:
+            pass
+
+    def record(self, index, pid, load):
+        now = time.monotonic()
+        last = self.last.get(index)
+        self.last[index] = (now, pid, load)
+        metrics.shard_rss.set(load['rss'], shard=index)
+        # Rates from two reports of the same worker
+        if (last is None or last[1] != pid):
+            return
+        seconds = now - last[0]
+        cpu = (load['cpu'] - last[2]['cpu']) / seconds
+        panels = (load['panels'] - last[2]['panels']) / seconds
+        metrics.shard_cpu.set(round(cpu, 3), shard=index)
+        metrics.shard_panels.set(round(panels, 2), shard=index)
+        if (self.debug_output):
+            commands = (load['commands'] - last[2]['commands']) / seconds
+            print("Shard {} (pid {}): {} displays, cpu {:.0%}, {:.1f} panels/s, {:.0f} commands/s, "
+                  "rss {:.1f}MB".format(index, pid, load['devices'], cpu, panels, commands, load['rss'] / 2 ** 20))
+
+    def stop(self):
+        for p in self.workers:
+            if (p is not None and p.is_alive()):
+                p.terminate()
+        for p in self.workers:
+            if (p is not None):
+                p.join(5)
+        self.gateway.server.shutdown()
+        self.gateway.server.server_close()
+
+    def run(self):
+        threading.Thread(target=self.gateway.server.serve_forever, daemon=True).start()
+        print("{} displays in {} shards, OpenWeather gateway on {}".format(sum(len(s) for s in self.shards),
+                                                                          len(self.shards), self.gateway.url))
+        # Stop workers on SIGTERM too
+        if (threading.current_thread() is threading.main_thread()):
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while (len(self.done) < len(self.shards)):
+                self.check()
+                self.collect(1.0)
+        except KeyboardInterrupt:
+            eprint("Exiting...")
+            return 0
+        finally:
+            self.stop()
+        print("All displays released - exiting")
+        return 0
@@ -0,0 +1,15 @@
+import os
+
+import ow_cache
+
+
+def test_save_has_a_temporary_file_of_its_own(tmp_path):
+    path = str(tmp_path / 'onecall.json')
+    # Another writer's temporary file under the old fixed name
+    os.mkdir(path + '.tmp')
+    cache = ow_cache.jsonCache(path)
+    cache.entries = {'key': 'value'}
+    cache.save()
+    cache.save()
+    assert ow_cache.jsonCache(path).entries == {'key': 'value'}
+    assert sorted(os.listdir(str(tmp_path))) == ['onecall.json', 'onecall.json.tmp']
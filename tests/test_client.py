@@ -0,0 +1,76 @@
+import sys
+import types
+import threading
+
+import pytest
+
+import ow_client
+import ow_schedule
+
+
+class response:
+    status_code = 200
+    headers = {}
+
+
+class session:
+    def get(self, url, **kwargs):
+        return response()
+
+
+# requests as far as owClient uses it
+@pytest.fixture
+def client(monkeypatch):
+    requests = types.ModuleType('requests')
+    requests.Session = session
+    requests.RequestException = OSError
+    monkeypatch.setitem(sys.modules, 'requests', requests)
+    return ow_client.owClient('appid', 'http://127.0.0.1:1')
+
+
+def test_session_per_thread(client):
+    sessions = []
+    threads = [threading.Thread(target=lambda: sessions.extend([client.session(), client.session()]))
+               for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(map(id, sessions))) == 4
+    assert all(a is b for a, b in zip(sessions[::2], sessions[1::2]))
+
+
+def test_stats_counted_from_threads(client):
+    def fetch():
+        for i in range(500):
+            client.get('/data/2.5/onecall', {})
+    threads = [threading.Thread(target=fetch) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert client.stats['requests'] == 8 * 500
+    assert client.stats['failures'] == 0
+
+
+class failing(session):
+    def get(self, url, **kwargs):
+        raise OSError("unreachable")
+
+
+def test_budget_charged_for_every_attempt(client, monkeypatch):
+    monkeypatch.setattr(client, 'session', failing)
+    monkeypatch.setattr(client, 'jitter', lambda n: 0)
+    client.budget = ow_schedule.callBudget(10)
+    with pytest.raises(OSError):
+        client.get('/data/2.5/onecall', {})
+    assert len(client.budget.calls) == client.retries + 1
+
+
+def test_no_retry_once_budget_spent(client, monkeypatch):
+    monkeypatch.setattr(client, 'session', failing)
+    monkeypatch.setattr(client, 'jitter', lambda n: 0)
+    client.budget = ow_schedule.callBudget(2)
+    with pytest.raises(OSError):
+        client.get('/data/2.5/onecall', {})
+    assert len(client.budget.calls) == 2
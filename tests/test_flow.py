@@ -0,0 +1,48 @@
+import sb_session
+
+
+def flow():
+    return sb_session.sbFlow('test')
+
+
+def test_window_limits_commands_in_flight():
+    f = flow()
+    f.sending(f.window, 0.0)
+    assert f.free() == 0
+    f.acked(3, 0.01)
+    assert f.free() == 3
+
+
+def test_late_prompts_after_timeout_are_not_samples():
+    f = flow()
+    f.sending(4, 0.0)
+    f.expire()
+    assert f.window == 4
+    assert f.free() == 4
+    # New commands, then the four prompts owed from before the timeout
+    f.sending(2, 10.0)
+    f.acked(4, 10.001)
+    assert f.min_rtt is None
+    assert len(f.sent) == 2
+    f.acked(2, 10.05)
+    assert abs(f.min_rtt - 0.05) < 1e-9
+
+
+def test_base_rtt_ages_out():
+    f = flow()
+    f.period_start = 0.0
+    f.sending(1, 1.0)
+    f.acked(1, 1.001)
+    assert abs(f.min_rtt - 0.001) < 1e-9
+    # Only the last period's least RTT is kept
+    for t in range(2, 2 + int(2 * f.base_age)):
+        f.sending(1, t)
+        f.acked(1, t + 0.01)
+    assert abs(f.min_rtt - 0.01) < 1e-9
+
+
+def test_closed_flow_does_not_block():
+    f = flow()
+    f.sending(f.window, 0.0)
+    f.close()
+    assert f.room() == f.window_max
@@ -0,0 +1,54 @@
+import time
+import threading
+
+import pytest
+
+import ow_cache
+import ow_weather
+import ow_gateway
+
+
+@pytest.fixture
+def gateway():
+    gw = ow_gateway.owGateway(None, ow_cache.weatherCache(60), port=0)
+    yield gw
+    gw.server.server_close()
+
+
+# Leader's upstream query answers code, once a follower waits for it
+def coalesce(gateway, monkeypatch, code, body=None):
+    go = threading.Event()
+    calls = []
+
+    def onecall(lat, lon, units, client, debug_output=False, cache=None, exclude='alerts'):
+        calls.append(lat)
+        go.wait(5)
+        return (code, body)
+    monkeypatch.setattr(ow_weather, 'onecall', onecall)
+
+    results = {}
+    threads = [threading.Thread(target=lambda name=name: results.update({name: gateway.fetch(42.36, -71.06, 'metric')}))
+               for name in ('leader', 'follower')]
+    threads[0].start()
+    while (not gateway.inflight):
+        time.sleep(0.01)
+    threads[1].start()
+    time.sleep(0.1)
+    go.set()
+    for t in threads:
+        t.join(5)
+    assert len(calls) == 1
+    return results
+
+
+def test_follower_gets_leader_error(gateway, monkeypatch):
+    results = coalesce(gateway, monkeypatch, 401)
+    assert results == {'leader': ('miss', 401), 'follower': ('coalesced', 401)}
+
+
+def test_follower_gets_leader_stale_data(gateway, monkeypatch):
+    key = gateway.cache.key(42.36, -71.06, 'metric')
+    gateway.cache.put(key, '{}')
+    gateway.cache.entries[key]['time'] -= 3600
+    results = coalesce(gateway, monkeypatch, 503)
+    assert results == {'leader': ('stale', 200), 'follower': ('coalesced', 200)}
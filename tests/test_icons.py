@@ -0,0 +1,87 @@
+import os
+import importlib.util
+
+import pytest
+
+from sb_sim import sbSim
+from draw_icon import wi_icons
+
+
+icons = wi_icons()
+names = sorted(f[:-4] for f in os.listdir(os.path.join(os.path.dirname(__file__), '..', 'pbm'))
+               if f.endswith('.pbm'))
+
+
+@pytest.fixture(scope='module')
+def sim():
+    sim = sbSim(2)
+    # Room for the tallest icon
+    sim.height = 40
+    yield sim
+    sim.server.server_close()
+
+
+def bitmap(sizex, sizey, segs):
+    rows = [[0] * sizex for y in range(sizey)]
+    for x, y, cnt in segs:
+        rows[y][x:x + cnt] = [1] * cnt
+    return rows
+
+
+# Icon drawn with its cover commands, as the Soundbridge would show it
+@pytest.mark.parametrize('name', names)
+def test_commands_draw_the_icon(sim, name):
+    sizex, sizey, segs = wi_icons.parse('pbm/' + name + '.pbm')
+    sim.clear()
+    sim.color = 1
+    for r in wi_icons.cover(sizex, sizey, segs):
+        assert sim.command(None, wi_icons.command(r[0] + 3, r[1], r[2], r[3]).encode())
+    drawn = [[1 if (sim.fb[y][x]) else 0 for x in range(3, 3 + sizex)] for y in range(sizey)]
+    assert drawn == bitmap(sizex, sizey, segs)
+    # Nothing outside the icon
+    assert not any(sim.fb[y][x] for y in range(sim.height) for x in range(sim.width)
+                   if not (3 <= x < 3 + sizex and y < sizey))
+
+
+def test_bundle_not_used_for_changed_icon(tmp_path, monkeypatch):
+    import shutil
+    import icon_bundle
+
+    shutil.copytree('pbm', tmp_path / 'pbm')
+    monkeypatch.chdir(tmp_path)
+    icon_bundle.pack()
+    assert wi_icons().runs('32') == wi_icons.parse('pbm/32.pbm')
+    # Flip the middle pixel
+    with open('pbm/32.pbm') as f:
+        tokens = [t for line in f if not line.startswith('#') for t in line.split()]
+    middle = 3 + (len(tokens) - 3) // 2
+    tokens[middle] = '0' if (tokens[middle] == '1') else '1'
+    with open('pbm/32.pbm', 'w') as f:
+        f.write(' '.join(tokens) + '\n')
+    icons = wi_icons()
+    assert icons.runs('32') == wi_icons.parse('pbm/32.pbm')
+    assert icons.runs('32') != icons.bundle.runs('32')
+
+
+def test_cache_keeps_hand_made_sets(monkeypatch):
+    icons = wi_icons(cache_size=4)
+    icons.preload(1)
+    icons.preload(2)
+    loaded = len(icons.cache)
+    assert loaded > 2 * icons.cache_size
+    # Scaled icons come and go without evicting the sets
+    for name in ('32', '26', '11', '12', '30', '28'):
+        icons.load(name, 2, 24)
+    assert len(icons.cache) == loaded
+    assert len(icons.scaled) == 4
+    monkeypatch.setattr(icons, 'runs', None)
+    icons.load('32', 1)
+    icons.load('28', 2, 24)
+
+
+@pytest.mark.skipif(importlib.util.find_spec('numpy') is None, reason="numpy is not installed")
+@pytest.mark.parametrize('height', [8, 24, 48])
+def test_scale_same_with_and_without_numpy(height):
+    for name in names:
+        runs = icons.runs(name)
+        assert wi_icons.scale(*runs, height) == wi_icons.scale(*runs, height, vectorize=False)
@@ -0,0 +1,45 @@
+import pytest
+
+import ir_keys
+from ir_keys import panelCursor
+
+
+def test_keymap_overrides():
+    keys = ir_keys.keymap({'CK_MENU': 'refresh', 'CK_EAST': 'ignore'})
+    assert keys['CK_MENU'] == 'refresh' and keys['CK_EAST'] == 'ignore'
+    assert ir_keys.action('CK_POWER', keys) == 'exit'
+    assert ir_keys.action('TIMEOUT', keys) == 'next'
+    with pytest.raises(ValueError):
+        ir_keys.keymap({'CK_MENU': 'jump'})
+
+
+def test_cursor_screens():
+    cursor = panelCursor(5)
+    # Screen of panels 0 and 1 (0 not held)
+    cursor.skip()
+    cursor.move('next')
+    assert cursor.index == 2
+    cursor.move('next')
+    assert cursor.index == 3
+    # Back to the screen before, then the one before that
+    cursor.move('previous')
+    assert cursor.index == 2
+    cursor.move('previous')
+    assert cursor.index == 0
+    cursor.move('previous')
+    assert cursor.index == 0
+
+
+def test_cursor_wraps_and_repeats():
+    cursor = panelCursor(3)
+    cursor.index = 2
+    cursor.move('next')
+    assert cursor.index == 0
+    cursor.skip()
+    # refresh/ignore show the same screen again
+    cursor.move('refresh')
+    assert cursor.index == 0
+    cursor.skip()
+    cursor.skip()
+    cursor.skip()
+    assert cursor.index == 0
@@ -0,0 +1,29 @@
+import json
+import time
+
+import pytest
+
+import ow_stub
+import ow_model
+import panels
+from draw_icon import wi_icons
+from sketch_frame import sketchFrame, dpy_size
+
+
+icons = wi_icons()
+
+
+@pytest.mark.parametrize('dpytype', [1, 2])
+@pytest.mark.parametrize('panel', panels.display_panels, ids=lambda p: p.__name__)
+def test_panel_draws_on_display(panel, dpytype):
+    body = json.dumps(ow_stub.onecall(42.36, -71.06, 'imperial', time.time())).encode()
+    wx = ow_model.parse(body, 'imperial')
+    frame = sketchFrame(dpytype)
+    panel(frame, wx, icons)
+    width, height = dpy_size[dpytype]
+    for p in frame.prims:
+        if (p[0] == 'line'):
+            assert 0 <= min(p[1], p[3]) and max(p[1], p[3]) < width, p
+            assert 0 <= min(p[2], p[4]) and max(p[2], p[4]) < height, p
+        elif (p[0] in ('point', 'rect')):
+            assert 0 <= p[1] < width and 0 <= p[2] < height, p
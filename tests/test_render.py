@@ -0,0 +1,47 @@
+import metrics
+from roku_tn import rokuSB
+from draw_icon import wi_icons
+from sketch_frame import sketchFrame, frameRenderer
+
+
+# Records commands instead of sending them
+class recordingSB(rokuSB):
+    def __init__(self, dtype):
+        super().__init__(dtype)
+        self.lines = []
+
+    def write(self, data):
+        self.lines.extend(data.decode('utf-8').splitlines())
+
+
+def frame(text, code=800):
+    f = sketchFrame(2).clear()
+    f.icon(icons, code, 0, 0)
+    f.msg(text=text, x=40, y=0, font=10)
+    return f
+
+
+icons = wi_icons()
+
+
+def test_delta_leaves_unchanged_icon():
+    sb = recordingSB(2)
+    renderer = frameRenderer(sb, icons)
+    renderer.render(frame("72F"))
+    draws = metrics.icon_draws.total()
+    sb.lines.clear()
+    assert renderer.render(frame("73F")) == len(sb.lines)
+    # Plans are compared without building icon commands
+    assert metrics.icon_draws.total() == draws
+    assert not any(c.startswith("sketch -c clear") for c in sb.lines)
+
+
+def test_full_plan_draws_icon_once():
+    sb = recordingSB(2)
+    renderer = frameRenderer(sb, icons)
+    renderer.render(frame("72F"))
+    draws = metrics.icon_draws.total()
+    sb.lines.clear()
+    count = renderer.render(frame("73F", 200))
+    assert metrics.icon_draws.total() == draws + 1
+    assert count == len(sb.lines)
@@ -0,0 +1,38 @@
+import socket
+
+import sb_session
+from roku_tn import rokuSB
+
+
+def test_greet_refuses_options_and_keeps_text_after_prompt():
+    sb = rokuSB(2)
+    ours, theirs = socket.socketpair()
+    # DO echo, then the prompt and an IR key in the same read
+    theirs.sendall(bytes([sb_session.IAC, sb_session.DO, 1]) + b'SoundBridge> irman: CK_EAST\n')
+    assert sb.greet(ours, 1) == b'irman: CK_EAST\n'
+    assert theirs.recv(16) == bytes([sb_session.IAC, sb_session.WONT, 1])
+    ours.close()
+    theirs.close()
+
+
+def test_greet_times_out_without_prompt():
+    ours, theirs = socket.socketpair()
+    theirs.sendall(b'login: ')
+    assert rokuSB(2).greet(ours, 0.05) is None
+    ours.close()
+    theirs.close()
+
+
+def test_scan_counts_prompts_and_keeps_partial_line():
+    n, keys, rest = sb_session.scan(b'sketch> irman: CK_MENU\r\nSoundBridge> irma')
+    assert (n, keys, rest) == (2, ['CK_MENU'], b'irma')
+
+
+def test_send_doubles_iac():
+    sb = rokuSB(2, flow_control=False)
+    sb.sock, theirs = socket.socketpair()
+    sb.send(b'a\xffb')
+    assert theirs.recv(16) == b'a\xff\xffb'
+    sb.abort()
+    assert sb.sock is None
+    theirs.close()
@@ -0,0 +1,25 @@
+import ow_schedule
+from ow_schedule import callBudget, day
+
+
+def test_floor_spreads_budget_over_day():
+    budget = callBudget(1000)
+    assert budget.floor() == day / 1000
+    budget.users = 4
+    assert budget.floor() == 4 * day / 1000
+
+
+def test_wait_when_budget_spent():
+    budget = callBudget(3)
+    for t in (0, 10, 20):
+        budget.record(t)
+    assert budget.wait(30) == day - 30
+    # Calls older than a day no longer count
+    assert budget.wait(day + 5) == 0
+    assert list(budget.calls) == [10, 20]
+    budget.record(day + 5)
+    assert budget.wait(day + 6) == 4
+
+
+def test_fixed_policy_interval():
+    assert ow_schedule.fixedPolicy(600).interval(None, 0) == 600
@@ -0,0 +1,49 @@
+import json
+import time
+
+import pytest
+
+import ow_stub
+import ow_stream
+
+
+keep = {'current': None, 'daily': (None, 2), 'hourly': (('dt', 'temp'), None), 'minutely': None}
+
+
+# A onecall response with a large part that is not kept
+def document():
+    doc = ow_stub.onecall(42.36, -71.06, 'metric', time.time())
+    doc['alerts'] = {'text': 'xé' * 20000, 'areas': [{'id': i, 'name': 'zürich'} for i in range(2000)]}
+    doc['extra'] = [1.5e3, -2, True, None, "a\"b", {'nested': [1, [2, {'deep': 3}]]}] * 200
+    return doc
+
+
+def expected(doc):
+    return {'current': doc['current'], 'daily': doc['daily'][:2],
+            'hourly': [{'dt': h['dt'], 'temp': h['temp']} for h in doc['hourly']], 'minutely': doc['minutely']}
+
+
+@pytest.mark.parametrize('size', [1, 7, 8192])
+def test_read_on_chunk_boundaries(size):
+    doc = document()
+    body = json.dumps(doc, ensure_ascii=False).encode('utf-8')
+    chunks = [body[i:i + size] for i in range(0, len(body), size)]
+    assert ow_stream.read(chunks, keep) == expected(doc)
+
+
+def test_numbers_split_across_chunks():
+    assert ow_stream.read([b'{"a": 1', b'2.', b'5e', b'1, "b": [1', b'0]}'], {'a': None, 'b': None}) == \
+        {'a': 125.0, 'b': [10]}
+
+
+def test_large_value_decoded_a_few_times(monkeypatch):
+    calls = []
+    decode = ow_stream.decoder.raw_decode
+
+    def counting(s, idx=0):
+        calls.append(idx)
+        return decode(s, idx)
+    monkeypatch.setattr(ow_stream.decoder, 'raw_decode', counting)
+    body = json.dumps({'current': {'text': 'x' * 100000}}).encode()
+    ow_stream.read([body[i:i + 1] for i in range(len(body))], {'current': None})
+    assert len(calls) < 40
@@ -0,0 +1,68 @@
+import supervisor
+
+
+def device(host, lat, lon=-71.06, units='imperial'):
+    return {'host': host, 'lat': lat, 'lon': lon, 'units': units}
+
+
+def hosts(shards):
+    return [[d['host'] for d in s] for s in shards]
+
+
+def test_shard_keeps_forecast_groups_together():
+    devices = [device('h{}'.format(i), 42.36) for i in range(4)] + [device('x', 40.71)]
+    assert hosts(supervisor.shard(devices, 2)) == [['h0', 'h1', 'h2', 'h3'], ['x']]
+
+
+def test_shard_units_are_part_of_the_forecast():
+    devices = [device('a', 42.36), device('b', 42.36, units='metric'), device('c', 42.36)]
+    assert hosts(supervisor.shard(devices, 2)) == [['a', 'c'], ['b']]
+
+
+def test_shard_balances_groups():
+    devices = ([device('a{}'.format(i), 1) for i in range(3)] + [device('b{}'.format(i), 2) for i in range(2)] +
+               [device('c{}'.format(i), 3) for i in range(2)] + [device('d', 4)])
+    sizes = sorted(len(s) for s in supervisor.shard(devices, 2))
+    assert sizes == [4, 4]
+
+
+def test_shard_no_empty_shards():
+    devices = [device('a', 1), device('b', 2)]
+    shards = supervisor.shard(devices, 8)
+    assert len(shards) == 2
+    assert sorted(d['host'] for s in shards for d in s) == ['a', 'b']
+
+
+class exited:
+    pid = 1
+
+    def __init__(self, exitcode):
+        self.exitcode = exitcode
+
+    def is_alive(self):
+        return False
+
+    def join(self, timeout=None):
+        pass
+
+
+class gateway:
+    url = 'http://127.0.0.1:1'
+
+
+def test_check_restarts_crashed_worker_only():
+    sup = supervisor.supervisor([[device('a', 1)], [device('b', 2)], [device('c', 3)]], {}, gateway())
+    sup.workers = [exited(-9), exited(supervisor.config_error), exited(0)]
+    sup.check()
+    assert sup.workers == [None, None, None]
+    assert sup.done == {1, 2}
+    assert sup.restart_at[0] > 0
+
+
+def test_budget_shares_stay_within_budget():
+    devices = [device('h{}'.format(i), i) for i in range(5)]
+    shards, share = supervisor.split_budget(devices, 3, 1000)
+    assert (len(shards), share) == (3, 333)
+    # Fewer queries a day than workers: one shard per query
+    shards, share = supervisor.split_budget(devices, 3, 2)
+    assert (len(shards), share) == (2, 1)